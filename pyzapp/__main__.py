@@ -36,7 +36,7 @@ internal_modules = {
                    'test.py', 'test_v3.py', 'test_v37.py',
                    ),
         'antipathy': ('LICENSE', 'README', '__init__.py', 'path.py'),
-        'dbf': ('LICENSE', '__init__.py'),
+        'dbf': ('LICENSE', '__init__.py', 'bench.py', 'test_dbf.py'),
         'pandaemonium': ('LICENSE', '__init__.py'),
         'scription': ('LICENSE', '__init__.py'),
         'stonemark': ('LICENSE', '__init__.py', '__main__.py'),
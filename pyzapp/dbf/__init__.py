@@ -32,28 +32,45 @@ ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 from __future__ import with_statement, print_function
 
+import ast
 import codecs
 import csv
 import datetime
 import decimal
+import hashlib
+import io
+import mmap
+import multiprocessing
 import os
+import pickle
+import shutil
 import struct
 import sys
+import tempfile
+import threading
 import time
 import traceback
 import warnings
 import weakref
 
 from array import array
-from bisect import bisect_left, bisect_right
-from collections import defaultdict, deque
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict, deque, namedtuple, OrderedDict
 from functools import partial
 from aenum import Enum, IntEnum, IntFlag, export
 from glob import glob
+from heapq import nlargest, nsmallest
+from itertools import chain, islice
 from math import floor
+from operator import itemgetter
 from os import SEEK_END
 from textwrap import dedent
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 try:
     import pytz
 except ImportError:
@@ -65,6 +82,7 @@ if py_ver < (3, 0):
     unicode = unicode
     basestring = bytes, unicode
     baseinteger = int, long
+    unichr = unichr
     import collections as collections_abc
 else:
     bytes = bytes
@@ -72,6 +90,7 @@ else:
     basestring = unicode,
     baseinteger = int,
     long = int
+    unichr = chr
     xrange = range
     import collections.abc as collections_abc
 
@@ -98,10 +117,42 @@ default_type = 'db3'
 
 temp_dir = os.environ.get("DBF_TEMP") or os.environ.get("TMP") or os.environ.get("TEMP") or ""
 
+## bytes of memo contents to keep cached per table (0 to disable)
+memo_cache_size = 1024 * 1024
+
+## read dBase III memos back after writing to verify they were saved
+memo_verify = True
+
+## hold an exclusive fcntl lock on the table file while writing records and
+## the header (where fcntl is available); appending rereads the record count
+## and next memo block under the lock, so several processes can add records
+## to a table; see also Table.lock()
+lock_files = False
+
+## number of recently used records of each on-disk table to keep in memory
+## (0 keeps only the records still in use), unless the table was given its
+## own record_cache_size; takes effect when a table is opened
+record_cache_size = 0
+
 ## user-defined pql functions  (pql == primitive query language)
 ## it is not real sql and won't be for a long time (if ever)
 pql_user_functions = dict()
 
+## number of compiled pql criteria and commands to keep (0 to disable);
+## changes take effect at the next pql_cache_clear()
+pql_cache_size = 256
+
+## called with a table's file name and stats() when the table is closed, for
+## exporting the counters to a metrics system
+stats_hook = None
+
+## counters kept for each table and returned by Table.stats()
+_table_stat_names = (
+        'record_reads', 'record_writes', 'bytes_read', 'bytes_written',
+        'cache_hits', 'cache_misses', 'memo_reads', 'memo_writes',
+        'header_writes', 'index_updates', 'pql_compiles', 'pql_compile_time',
+        )
+
 ## signature:_meta of template records
 _Template_Records = dict()
 
@@ -3091,9 +3142,17 @@ class Record(object):
         elif type(kamikaze) == bytes:
             if kamikaze:
                 record._data = array('B', kamikaze)
+        elif type(kamikaze) == memoryview:
+            if _fromdisk:
+                # view into a memory-mapped table; copied by _start_flux
+                record._data = kamikaze
+            else:
+                record._data = array('B', kamikaze.tobytes())
         else:
             raise BadDataError("%r recieved for record data" % kamikaze)
         if record._data[0] == NULL:
+            if type(record._data) == memoryview:
+                record._data = array('B', record._data.tobytes())
             record._data[0] = SPACE
         if record._data[0] not in (SPACE, ASTERISK):
             # TODO: log warning instead
@@ -3318,6 +3377,34 @@ class Record(object):
             if fieldtype != _NULLFLAG:    # ignore the nullflags field
                 data_types.append("%s_%s_%s" % (fieldtype.symbol, defs['Empty'], defs['Class']))
         layout.record_sig = ('___'.join(signature), '___'.join(data_types))
+        cls._compile_codec(layout)
+
+    @classmethod
+    def _compile_codec(cls, layout):
+        """
+        precomputes what is needed to convert each field; stored in layout.codec
+        as name:(start, end, retrieve, update, fielddef, null_byte, null_mask)
+        """
+        codec = {}
+        null_start = None
+        if '_NULLFLAGS' in layout:
+            null_start = layout['_NULLFLAGS'][START]
+        for name in layout.fields:
+            if name == '_NULLFLAGS':
+                continue
+            fielddef = layout[name]
+            null_byte = null_mask = None
+            if fielddef[FLAGS] & NULLABLE and null_start is not None:
+                byte, bit = divmod(fielddef[NUL], 8)
+                null_byte = null_start + byte
+                null_mask = 1 << bit
+            field_type = layout.fieldtypes[fielddef[TYPE]]
+            codec[name] = (
+                    fielddef[START], fielddef[END],
+                    field_type['Retrieve'], field_type['Update'],
+                    fielddef, null_byte, null_mask,
+                    )
+        layout.codec = codec
 
     def _reindex_record(self):
         """
@@ -3328,6 +3415,7 @@ class Record(object):
         elif not self._write_to_disk:
             raise DbfError("unable to reindex record until it is written to disk")
         for dbfindex in self._meta.table()._indexen:
+            _count(self._meta, 'index_updates')
             dbfindex(self)
 
     def _retrieve_field_value(self, name):
@@ -3335,31 +3423,11 @@ class Record(object):
         calls appropriate routine to convert value stored in field from array
         """
         # check nullable here, binary is handled in the appropriate retrieve_* functions
-        # index = self._meta.fields.index(name)
-        fielddef = self._meta[name]
-        flags = fielddef[FLAGS]
-        nullable = flags & NULLABLE and '_NULLFLAGS' in self._meta
-        if nullable:
-            index = fielddef[NUL]
-            byte, bit = divmod(index, 8)
-            null_def = self._meta['_NULLFLAGS']
-            null_data = self._data[null_def[START]:null_def[END]]
-            try:
-                if null_data[byte] >> bit & 1:
-                    return Null
-            except IndexError:
-                print(null_data)
-                print(index)
-                print(byte, bit)
-                print(len(self._data), self._data)
-                print(null_def)
-                print(null_data)
-                raise
-        record_data = self._data[fielddef[START]:fielddef[END]]
-        field_type = fielddef[TYPE]
-        retrieve = self._meta.fieldtypes[field_type]['Retrieve']
-        datum = retrieve(record_data, fielddef, self._meta.memo, self._meta.decoder)
-        return datum
+        meta = self._meta
+        start, end, retrieve, update, fielddef, null_byte, null_mask = meta.codec[name]
+        if null_byte is not None and self._data[null_byte] & null_mask:
+            return Null
+        return retrieve(self._data[start:end], fielddef, meta.memo, meta.decoder)
 
     def _rollback_flux(self):
         """
@@ -3383,6 +3451,9 @@ class Record(object):
             raise DbfError("record has been packed; unable to update")
         elif not self._write_to_disk:
             raise DbfError("record already in a state of flux")
+        if type(self._data) == memoryview:
+            # copy-on-write for records from a memory-mapped table
+            self._data = array('B', self._data.tobytes())
         self._old_data = self._data[:]
         self._write_to_disk = False
 
@@ -3391,30 +3462,20 @@ class Record(object):
         calls appropriate routine to convert value to bytes, and save it in record
         """
         # check nullabel here, binary is handled in the appropriate update_* functions
-        fielddef = self._meta[name]
-        index = fielddef[NUL]
-        field_type = fielddef[TYPE]
-        flags = fielddef[FLAGS]
-        nullable = flags & NULLABLE and '_NULLFLAGS' in self._meta
-        update = self._meta.fieldtypes[field_type]['Update']
-        if nullable:
-            byte, bit = divmod(index, 8)
-            null_def = self._meta['_NULLFLAGS']
-            null_data = self._data[null_def[START]:null_def[END]]
+        meta = self._meta
+        start, end, retrieve, update, fielddef, null_byte, null_mask = meta.codec[name]
+        if null_byte is not None:
             if value is Null:
-                null_data[byte] |= 1 << bit
+                self._data[null_byte] |= null_mask
                 value = None
             else:
-                null_data[byte] &= 0xff ^ 1 << bit
-            self._data[null_def[START]:null_def[END]] = null_data
+                self._data[null_byte] &= 0xff ^ null_mask
         if value is not Null:
-            bytes = array('B', update(value, fielddef, self._meta.memo, self._meta.input_decoder, self._meta.encoder))
-            size = fielddef[LENGTH]
+            bytes = array('B', update(value, fielddef, meta.memo, meta.input_decoder, meta.encoder))
+            size = end - start
             if len(bytes) > size:
                 raise DataOverflowError("tried to store %d bytes in %d byte field" % (len(bytes), size))
             blank = array('B', b' ' * size)
-            start = fielddef[START]
-            end = start + size
             blank[:len(bytes)] = bytes[:]
             self._data[start:end] = blank[:]
         self._dirty = True
@@ -3429,19 +3490,75 @@ class Record(object):
                 location = self._recnum * header.record_length + header.start
             if data is None:
                 data = self._data
-            layout.dfd.seek(location)
-            layout.dfd.write(data)
+            _write_at(layout, location, data)
+            _count(layout, 'record_writes')
             self._dirty = False
         table = layout.table()
         if table is not None:  # is None when table is being destroyed
             for index in table._indexen:
+                _count(layout, 'index_updates')
                 index(self)
 
     def _write(self):
         for field, value in self._memos.items():
             self._update_field_value(field, value)
+        if self._memos and self._meta.memo is not None:
+            # memo pointers must be on disk before the record refers to them
+            self._meta.memo.flush()
         self._update_disk()
 
+    def as_dict(self, fields=None):
+        """
+        returns a dict of field names:values for fields (default is all fields)
+        """
+        return _record_as_dict(self, fields)
+
+    def as_tuple(self, fields=None):
+        """
+        returns a tuple of the values in fields (default is all fields)
+        """
+        return _record_as_tuple(self, fields)
+
+
+def _record_as_dict(record, fields):
+    """
+    returns a dict of field names:values of record (a Record or
+    RecordTemplate) for fields (default is all fields); names are upper-cased
+    """
+    if fields is None:
+        fields = record._meta.user_fields
+    else:
+        fields = FieldnameList(fields)
+    return dict(zip(fields, _record_as_tuple(record, fields)))
+
+def _record_as_tuple(record, fields):
+    """
+    returns a tuple of the values of record (a Record or RecordTemplate) in
+    fields (default is all fields), decoded through the table's codec
+    """
+    meta = record._meta
+    if fields is None:
+        fields = meta.user_fields
+    codec = meta.codec
+    memos = record._memos
+    data = record._data
+    memo, decoder = meta.memo, meta.decoder
+    values = []
+    for name in fields:
+        name = name.upper()
+        if name in memos:
+            values.append(memos[name])
+            continue
+        try:
+            start, end, retrieve, update, fielddef, null_byte, null_mask = codec[name]
+        except KeyError:
+            raise FieldMissingError(name)
+        if null_byte is not None and data[null_byte] & null_mask:
+            values.append(Null)
+        else:
+            values.append(retrieve(data[start:end], fielddef, memo, decoder))
+    return tuple(values)
+
 
 class RecordTemplate(object):
     """
@@ -3468,20 +3585,11 @@ class RecordTemplate(object):
         """
         # check nullable here, binary is handled in the appropriate retrieve_* functions
         fielddef = self._meta[name]
-        flags = fielddef[FLAGS]
-        nullable = flags & NULLABLE and '_NULLFLAGS' in self._meta
-        if nullable:
-            index = fielddef[NUL]
-            byte, bit = divmod(index, 8)
-            null_def = self._meta['_NULLFLAGS']
-            null_data = self._data[null_def[START]:null_def[END]]
-            if null_data[byte] >> bit & 1:
-                return Null
-        record_data = self._data[fielddef[START]:fielddef[END]]
-        field_type = fielddef[TYPE]
-        retrieve = self._meta.fieldtypes[field_type]['Retrieve']
-        datum = retrieve(record_data, fielddef, self._meta.memo, self._meta.decoder)
-        return datum
+        meta = self._meta
+        start, end, retrieve, update, fielddef, null_byte, null_mask = meta.codec[name]
+        if null_byte is not None and self._data[null_byte] & null_mask:
+            return Null
+        return retrieve(self._data[start:end], fielddef, meta.memo, meta.decoder)
 
     def _rollback_flux(self):
         """
@@ -3508,33 +3616,35 @@ class RecordTemplate(object):
         calls appropriate routine to convert value to ascii bytes, and save it in record
         """
         # check nullabel here, binary is handled in the appropriate update_* functions
-        fielddef = self._meta[name]
-        index = fielddef[NUL]
-        field_type = fielddef[TYPE]
-        flags = fielddef[FLAGS]
-        nullable = flags & NULLABLE and '_NULLFLAGS' in self._meta
-        update = self._meta.fieldtypes[field_type]['Update']
-        if nullable:
-            byte, bit = divmod(index, 8)
-            null_def = self._meta['_NULLFLAGS']
-            null_data = self._data[null_def[START]:null_def[END]] #.tostring()
+        meta = self._meta
+        start, end, retrieve, update, fielddef, null_byte, null_mask = meta.codec[name]
+        if null_byte is not None:
             if value is Null:
-                null_data[byte] |= 1 << bit
+                self._data[null_byte] |= null_mask
                 value = None
             else:
-                null_data[byte] &= 0xff ^ 1 << bit
-            self._data[null_def[START]:null_def[END]] = null_data
+                self._data[null_byte] &= 0xff ^ null_mask
         if value is not Null:
-            bytes = array('B', update(value, fielddef, self._meta.memo, self._meta.input_decoder, self._meta.encoder))
-            size = fielddef[LENGTH]
+            bytes = array('B', update(value, fielddef, meta.memo, meta.input_decoder, meta.encoder))
+            size = end - start
             if len(bytes) > size:
                 raise DataOverflowError("tried to store %d bytes in %d byte field" % (len(bytes), size))
             blank = array('B', b' ' * size)
-            start = fielddef[START]
-            end = start + size
             blank[:len(bytes)] = bytes[:]
             self._data[start:end] = blank[:]
 
+    def as_dict(self, fields=None):
+        """
+        returns a dict of field names:values for fields (default is all fields)
+        """
+        return _record_as_dict(self, fields)
+
+    def as_tuple(self, fields=None):
+        """
+        returns a tuple of the values in fields (default is all fields)
+        """
+        return _record_as_tuple(self, fields)
+
     def __new__(cls, layout, original_record=None, defaults=None):
         """
         record = ascii array of entire record; layout=record specification
@@ -3558,7 +3668,10 @@ class RecordTemplate(object):
         if original_record is None:
             record._data = layout.blankrecord[:]
         else:
-            record._data = original_record._data[:]
+            if type(original_record._data) == memoryview:
+                record._data = array('B', original_record._data.tobytes())
+            else:
+                record._data = original_record._data[:]
             for name in layout.memofields:
                 record._memos[name] = original_record[name]
         for field in field_names(defaults or {}):
@@ -3803,11 +3916,163 @@ class RecordVaporWare(object):
             return self._recno
 
 
+class _MemoCache(object):
+    """
+    least-recently-used cache of memo contents, limited to maxbytes
+    """
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.memos = OrderedDict()
+
+    def add(self, block, data):
+        if not self.maxbytes or len(data) > self.maxbytes:
+            return
+        old = self.memos.pop(block, None)
+        if old is not None:
+            self.size -= len(old)
+        self.memos[block] = data
+        self.size += len(data)
+        while self.size > self.maxbytes:
+            block, old = self.memos.popitem(last=False)
+            self.size -= len(old)
+
+    def clear(self):
+        self.memos.clear()
+        self.size = 0
+
+    def discard(self, first):
+        """
+        drops the memos in blocks first and later, as those blocks will be reused
+        """
+        for block in [b for b in self.memos if b >= first]:
+            self.size -= len(self.memos.pop(block))
+
+    def get(self, block):
+        data = self.memos.pop(block, None)
+        if data is not None:
+            # move to most-recently-used
+            self.memos[block] = data
+        return data
+
+
+_pread = getattr(os, 'pread', None)
+_pwrite = getattr(os, 'pwrite', None)
+
+def _count(meta, name, amount=1):
+    """
+    adds amount to the table's name counter
+    """
+    with meta.stats_lock:
+        meta.stats[name] += amount
+
+def _read_at(meta, offset, size):
+    """
+    reads size bytes at offset of the table's data file, without using (or
+    moving) the shared file position where os.pread is available
+
+    all reads and writes of the data file go through _read_at and _write_at,
+    so with os.pread and os.pwrite the file object never buffers any data
+    """
+    dfd = meta.dfd
+    if _pread is None:
+        with meta.io_lock:
+            dfd.seek(offset)
+            data = dfd.read(size)
+        _count(meta, 'bytes_read', len(data))
+        return data
+    data = _pread(dfd.fileno(), size, offset)
+    while len(data) < size:
+        more = _pread(dfd.fileno(), size - len(data), offset + len(data))
+        if not more:
+            break
+        data += more
+    _count(meta, 'bytes_read', len(data))
+    return data
+
+def _write_at(meta, offset, data):
+    """
+    writes data at offset of the table's data file, without using (or
+    moving) the shared file position where os.pwrite is available
+    """
+    dfd = meta.dfd
+    _count(meta, 'bytes_written', len(data))
+    with _FileLock(meta, active=lock_files):
+        if _pwrite is None:
+            with meta.io_lock:
+                dfd.seek(offset)
+                dfd.write(data)
+            return
+        data = memoryview(data).cast('B')
+        while data:
+            written = _pwrite(dfd.fileno(), data, offset)
+            data = data[written:]
+            offset += written
+
+def _replace_file(source, target):
+    """
+    renames source to target, replacing target (atomically where os.replace
+    is available)
+    """
+    if _os_replace is not None:
+        _os_replace(source, target)
+        return
+    if os.name == 'nt' and os.path.exists(target):
+        os.remove(target)
+    os.rename(source, target)
+
+_os_replace = getattr(os, 'replace', None)
+
+class _FileLock(object):
+    """
+    shared or exclusive fcntl lock on a table's data file; reentrant, and
+    shared by the threads of this process (does nothing without fcntl, or
+    if not active)
+    """
+
+    def __init__(self, meta, shared=False, active=True):
+        self.meta = meta
+        self.shared = shared
+        self.active = active
+
+    def __enter__(self):
+        if self.active:
+            self._change(+1)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.active:
+            self._change(-1)
+        return False
+
+    def _change(self, step):
+        meta = self.meta
+        # not io_lock: flock may wait on another process, and reads and writes
+        # in other threads must not wait with it
+        with meta.flock_lock:
+            counts = meta.file_locks
+            before = self._mode(counts)
+            counts[not self.shared] += step
+            after = self._mode(counts)
+            if fcntl is not None and before != after and meta.dfd is not None:
+                fcntl.flock(meta.dfd.fileno(), after)
+
+    @staticmethod
+    def _mode(counts):
+        shared, exclusive = counts
+        if exclusive:
+            return fcntl and fcntl.LOCK_EX
+        elif shared:
+            return fcntl and fcntl.LOCK_SH
+        return fcntl and fcntl.LOCK_UN
+
+
 class _DbfMemo(object):
     """
     Provides access to memo fields as dictionaries
-    Must override _init, _get_memo, and _put_memo to
-    store memo contents to disk
+    Must override _init, _get_memo, _put_memo, _next_memo, _write_next, and
+    _flush to store memo contents to disk
     """
 
     def _init(self):
@@ -3815,16 +4080,31 @@ class _DbfMemo(object):
         Initialize disk file usage
         """
 
+    def _flush(self):
+        """
+        Write pending memos and the next memo pointer to disk
+        """
+
     def _get_memo(self, block):
         """
         Retrieve memo contents from disk
         """
 
+    def _next_memo(self, data):
+        """
+        Returns the next memo pointer stored in data (the file's first bytes)
+        """
+
     def _put_memo(self, data):
         """
         Store memo contents to disk
         """
 
+    def _write_next(self):
+        """
+        Write the next memo pointer to disk
+        """
+
     def _zap(self):
         """
         Resets memo structure back to zero memos
@@ -3836,9 +4116,58 @@ class _DbfMemo(object):
         self.meta = meta
         self.memory = {}
         self.nextmemo = 1
+        self.cache = _MemoCache(memo_cache_size)
+        self.pending = []       # (block, length, bytes) of memos not yet on disk
         self._init()
         self.meta.newmemofile = False
 
+    def flush(self):
+        """
+        Writes any pending memos and the next memo pointer to disk
+        """
+        if self.pending:
+            self._flush()
+
+    def refresh(self):
+        """
+        Writes any pending memos, then rereads the next memo pointer from
+        disk, as another process may have added memos
+        """
+        meta = self.meta
+        if meta.location != ON_DISK or meta.ignorememos:
+            return
+        with meta.io_lock:
+            self.flush()
+            meta.mfd.flush()
+            if _pread is not None:
+                data = _pread(meta.mfd.fileno(), 4, 0)
+            else:
+                # the file object may answer from a stale buffer
+                with open(meta.memoname, 'rb') as fh:
+                    data = fh.read(4)
+            self.nextmemo = self._next_memo(data)
+
+    def rollback(self, nextmemo):
+        """
+        Forgets the memos stored since the next memo block was nextmemo, as the
+        records that would refer to them were not written; their blocks are
+        reused
+        """
+        if nextmemo == self.nextmemo:
+            return
+        if self.meta.location == IN_MEMORY:
+            for block in [b for b in self.memory if b >= nextmemo]:
+                del self.memory[block]
+            self.nextmemo = nextmemo
+            return
+        # pending memos follow each other, so any not pending were flushed
+        flushed = not self.pending or self.pending[0][0] > nextmemo
+        self.pending = [p for p in self.pending if p[0] < nextmemo]
+        self.cache.discard(nextmemo)
+        self.nextmemo = nextmemo
+        if flushed:
+            self._write_next()
+
     def get_memo(self, block):
         """
         Gets the memo in block
@@ -3846,7 +4175,15 @@ class _DbfMemo(object):
         if self.meta.ignorememos or not block:
             return ''
         if self.meta.location == ON_DISK:
-            return self._get_memo(block)
+            with self.meta.io_lock:
+                data = self.cache.get(block)
+                if data is None:
+                    if self.pending and block >= self.pending[0][0]:
+                        self.flush()
+                    data = self._get_memo(block)
+                    self.cache.add(block, data)
+                    _count(self.meta, 'memo_reads')
+            return data
         else:
             return self.memory[block]
 
@@ -3862,6 +4199,8 @@ class _DbfMemo(object):
             self.memory[thismemo] = data
         else:
             thismemo = self._put_memo(data)
+            self.cache.add(thismemo, data)
+            _count(self.meta, 'memo_writes')
         return thismemo
 
 
@@ -3888,46 +4227,70 @@ class _Db3Memo(_DbfMemo):
                     exc = sys.exc_info()[1]
                     raise DbfError("memo file appears to be corrupt: %r" % exc.args).from_exc(None)
 
+    def _flush(self):
+        pending, self.pending = self.pending, []
+        mfd = self.meta.mfd
+        mfd.seek(pending[0][0] * self.meta.memo_size)
+        mfd.write(b''.join([p[2] for p in pending]))
+        self._write_next()
+        if not memo_verify:
+            return
+        for thismemo, length, data in pending:
+            double_check = self._get_memo(thismemo)
+            if len(double_check) != length:
+                uhoh = open('dbf_memo_dump.err', 'wb')
+                uhoh.write(('thismemo: %d\n' % thismemo).encode('ascii'))
+                uhoh.write(('nextmemo: %d\n' % self.nextmemo).encode('ascii'))
+                uhoh.write(('saved: %d bytes\n' % length).encode('ascii'))
+                uhoh.write(data[:length])
+                uhoh.write(('retrieved: %d bytes\n' % len(double_check)).encode('ascii'))
+                uhoh.write(double_check)
+                uhoh.close()
+                raise DbfError("unknown error: memo not saved")
+
+    def _next_memo(self, data):
+        return unpack_long_int(data)
+
+    def _write_next(self):
+        mfd = self.meta.mfd
+        mfd.seek(0)
+        mfd.write(pack_long_int(self.nextmemo))
+
     def _get_memo(self, block):
         block = int(block)
         self.meta.mfd.seek(block * self.meta.memo_size)
-        eom = -1
-        data = b''
-        while eom == -1:
+        chunks = []
+        tail = b''
+        while "looking for end of memo":
             newdata = self.meta.mfd.read(self.meta.memo_size)
             if not newdata:
-                return data
-            data += newdata
-            eom = data.find(b'\x1a\x1a')
-        return data[:eom]
+                return b''.join(chunks)
+            # the ^Z^Z marker may straddle two reads
+            eom = (tail + newdata).find(b'\x1a\x1a')
+            if eom != -1:
+                eom -= len(tail)
+                if eom < 0:
+                    chunks[-1] = chunks[-1][:eom]
+                else:
+                    chunks.append(newdata[:eom])
+                return b''.join(chunks)
+            chunks.append(newdata)
+            tail = newdata[-1:]
 
     def _put_memo(self, data):
-        data = data
         length = len(data) + self.record_header_length  # room for two ^Z at end of memo
         blocks = length // self.meta.memo_size
         if length % self.meta.memo_size:
             blocks += 1
         thismemo = self.nextmemo
         self.nextmemo = thismemo + blocks
-        self.meta.mfd.seek(0)
-        self.meta.mfd.write(pack_long_int(self.nextmemo))
-        self.meta.mfd.seek(thismemo * self.meta.memo_size)
-        self.meta.mfd.write(data)
-        self.meta.mfd.write(b'\x1a\x1a')
-        double_check = self._get_memo(thismemo)
-        if len(double_check) != len(data):
-            uhoh = open('dbf_memo_dump.err', 'wb')
-            uhoh.write('thismemo: %d' % thismemo)
-            uhoh.write('nextmemo: %d' % self.nextmemo)
-            uhoh.write('saved: %d bytes' % len(data))
-            uhoh.write(data)
-            uhoh.write('retrieved: %d bytes' % len(double_check))
-            uhoh.write(double_check)
-            uhoh.close()
-            raise DbfError("unknown error: memo not saved")
+        padding = b'\x00' * (blocks * self.meta.memo_size - length)
+        self.pending.append((thismemo, len(data), data + b'\x1a\x1a' + padding))
         return thismemo
 
     def _zap(self):
+        self.pending = []
+        self.cache.clear()
         if self.meta.location == ON_DISK and not self.meta.ignorememos:
             mfd = self.meta.mfd
             mfd.seek(0)
@@ -3967,6 +4330,21 @@ class _VfpMemo(_DbfMemo):
                     exc = sys.exc_info()[1]
                     raise DbfError("memo file appears to be corrupt: %r" % exc.args).from_exc(None)
 
+    def _flush(self):
+        pending, self.pending = self.pending, []
+        mfd = self.meta.mfd
+        mfd.seek(pending[0][0] * self.meta.memo_size)
+        mfd.write(b''.join([p[2] for p in pending]))
+        self._write_next()
+
+    def _next_memo(self, data):
+        return unpack_long_int(data, bigendian=True)
+
+    def _write_next(self):
+        mfd = self.meta.mfd
+        mfd.seek(0)
+        mfd.write(pack_long_int(self.nextmemo, bigendian=True))
+
     def _get_memo(self, block):
         self.meta.mfd.seek(block * self.meta.memo_size)
         header = self.meta.mfd.read(8)
@@ -3974,20 +4352,23 @@ class _VfpMemo(_DbfMemo):
         return self.meta.mfd.read(length)
 
     def _put_memo(self, data):
-        data = data
-        self.meta.mfd.seek(0)
-        thismemo = unpack_long_int(self.meta.mfd.read(4), bigendian=True)
-        self.meta.mfd.seek(0)
         length = len(data) + self.record_header_length
         blocks = length // self.meta.memo_size
         if length % self.meta.memo_size:
             blocks += 1
-        self.meta.mfd.write(pack_long_int(thismemo + blocks, bigendian=True))
-        self.meta.mfd.seek(thismemo * self.meta.memo_size)
-        self.meta.mfd.write(b'\x00\x00\x00\x01' + pack_long_int(len(data), bigendian=True) + data)
+        thismemo = self.nextmemo
+        self.nextmemo = thismemo + blocks
+        padding = b'\x00' * (blocks * self.meta.memo_size - length)
+        self.pending.append((
+                thismemo,
+                len(data),
+                b'\x00\x00\x00\x01' + pack_long_int(len(data), bigendian=True) + data + padding,
+                ))
         return thismemo
 
     def _zap(self):
+        self.pending = []
+        self.cache.clear()
         if self.meta.location == ON_DISK and not self.meta.ignorememos:
             mfd = self.meta.mfd
             mfd.seek(0)
@@ -4837,15 +5218,41 @@ class Iter(_Navigation):
     Provides iterable behavior for a table
     """
 
-    def __init__(self, table, include_vapor=False):
+    def __init__(self, table, include_vapor=False, block_size=None):
         """
         Return a Vapor record as the last record in the iteration
         if include_vapor is True
+
+        If block_size is given and table is an on-disk Table, records are
+        read block_size at a time
         """
         self._table = table
         self._record = None
         self._include_vapor = include_vapor
         self._exhausted = False
+        self._block = []
+        self._block_start = 0
+        if (
+                block_size is not None
+                and isinstance(table, Table)
+                and table._meta.location == ON_DISK
+            ):
+            self._block_size = block_size
+        else:
+            self._block_size = None
+
+    def _get_record(self, index):
+        """
+        returns record at index, reading ahead a block at a time if enabled
+        """
+        if self._block_size is None:
+            return self._table[index]
+        offset = index - self._block_start
+        if not 0 <= offset < len(self._block):
+            self._block = self._table._table._read_block(index, index + self._block_size)
+            self._block_start = index
+            offset = 0
+        return self._block[offset]
 
     def __iter__(self):
         return self
@@ -4861,7 +5268,7 @@ class Iter(_Navigation):
                         return RecordVaporWare('eof', self._table)
                     break
                 self._index += 1
-                record = self._table[self._index]
+                record = self._get_record(self._index)
                 return record
             self._exhausted = True
             raise StopIteration
@@ -4876,7 +5283,7 @@ class Iter(_Navigation):
                         return RecordVaporWare('eof', self._table)
                     break
                 self._index += 1
-                record = self._table[self._index]
+                record = self._get_record(self._index)
                 return record
             self._exhausted = True
             raise StopIteration
@@ -4976,6 +5383,11 @@ class Table(_Navigation):
         blankrecord = None
         codepage = None           # code page being used (can be overridden when table is opened)
         dfd = None                # file handle
+        io_lock = None            # serializes seek+read/write when positional I/O is unavailable
+        file_locks = None         # [shared, exclusive] counts of Table.lock() holders
+        flock_lock = None         # serializes changes to file_locks and the fcntl lock
+        stats = None              # counters reported by Table.stats()
+        stats_lock = None         # guards the counters
         fields = None             # field names
         field_count = 0           # number of fields
         field_types = None        # dictionary of dbf type field specs
@@ -4986,6 +5398,8 @@ class Table(_Navigation):
         mfd = None                # file handle
         memo = None               # memo object
         memofields = None         # field names of Memo type
+        mmap = False              # True when records are read through a memory map
+        record_cache_size = None  # recently used records kept (None for the module default)
         newmemofile = False       # True when memo file needs to be created
         nulls = None              # non-None when Nullable fields present
         user_fields = None        # not counting SYSTEM fields
@@ -5172,9 +5586,16 @@ class Table(_Navigation):
         def __init__(self, count, meta):
             self._meta = meta
             self._max_count = count
-            self._weakref_list = {}
-            self._accesses = 0
-            self._dead_check = 1024
+            # records in use, so each record number has one Record
+            self._weakref_list = weakref.WeakValueDictionary()
+            # the most recently used records, kept alive (record_cache_size)
+            self._recent = OrderedDict()
+            self._recent_size = meta.record_cache_size
+            if self._recent_size is None:
+                self._recent_size = record_cache_size
+            self._mmap = None
+            self._mmview = None
+            self._lock = threading.RLock()
 
         def __getitem__(self, index):
             # maybe = self._weakref_list[index]()
@@ -5184,55 +5605,186 @@ class Table(_Navigation):
                 index = self._max_count + index
             if index >= self._max_count:
                 raise IndexError('index %d greater than available records' % index)
-            maybe = self._weakref_list.get(index)
-            if maybe:
-                maybe = maybe()
-            self._accesses += 1
-            if self._accesses >= self._dead_check:
-                for key, value in list(self._weakref_list.items()):
-                    if value() is None:
-                        del self._weakref_list[key]
-            if not maybe:
+            # the lock keeps threads from creating two records for one index
+            with self._lock:
+                maybe = self._weakref_list.get(index)
                 meta = self._meta
-                if meta.status == CLOSED:
-                    raise DbfError("%s is closed; record %d is unavailable" % (meta.filename, index))
-                header = meta.header
-                if index < 0:
-                    index += header.record_count
-                size = header.record_length
-                location = index * size + header.start
-                meta.dfd.seek(location)
-                if meta.dfd.tell() != location:
-                    raise ValueError("unable to seek to offset %d in file" % location)
-                bytes = meta.dfd.read(size)
-                if not bytes:
-                    raise ValueError("unable to read record data from %s at location %d" % (meta.filename, location))
-                maybe = Record(recnum=index, layout=meta, kamikaze=bytes, _fromdisk=True)
-                self._weakref_list[index] = weakref.ref(maybe)
-            return maybe
+                if maybe is not None:
+                    _count(meta, 'cache_hits')
+                else:
+                    _count(meta, 'cache_misses')
+                    _count(meta, 'record_reads')
+                    if meta.status == CLOSED:
+                        raise DbfError("%s is closed; record %d is unavailable" % (meta.filename, index))
+                    header = meta.header
+                    if index < 0:
+                        index += header.record_count
+                    size = header.record_length
+                    location = index * size + header.start
+                    if meta.mmap:
+                        bytes = self._map(location + size)[location:location+size]
+                        _count(meta, 'bytes_read', size)
+                    else:
+                        bytes = _read_at(meta, location, size)
+                    if not bytes:
+                        raise ValueError("unable to read record data from %s at location %d" % (meta.filename, location))
+                    maybe = Record(recnum=index, layout=meta, kamikaze=bytes, _fromdisk=True)
+                    self._weakref_list[index] = maybe
+                if self._recent_size:
+                    self._remember(index, maybe)
+                return maybe
+
+        def _map(self, end):
+            """
+            returns the memory map (a memoryview of it in Python 3), creating or
+            growing it so that offset `end` is available
+            """
+            meta = self._meta
+            if _pwrite is None and meta.status == READ_WRITE:
+                # pending writes must reach the file before the map sees them
+                meta.dfd.flush()
+            mmview = self._mmview
+            if mmview is not None and len(mmview) >= end:
+                return mmview
+            with self._lock:
+                return self._remap(end)
+
+        def _remap(self, end):
+            """
+            (re)creates the memory map if it does not reach `end`
+            """
+            meta = self._meta
+            if self._mmap is None or len(self._mmap) < end:
+                # records may still hold views of an outgrown map, so it is
+                # left for the garbage collector instead of being closed
+                self._mmap = mmap.mmap(meta.dfd.fileno(), 0, access=mmap.ACCESS_READ)
+                if len(self._mmap) < end:
+                    raise ValueError("unable to read record data from %s at location %d" % (meta.filename, end))
+                if py_ver < (3, 0):
+                    self._mmview = self._mmap
+                else:
+                    self._mmview = memoryview(self._mmap)
+            return self._mmview
+
+        def _unmap(self):
+            """
+            detaches live records from the memory map and releases it; must be
+            called before the file shrinks or is closed
+            """
+            if self._mmap is None:
+                return
+            for maybe in list(self._weakref_list.values()):
+                if type(maybe._data) == memoryview:
+                    maybe._data = array('B', maybe._data.tobytes())
+            if self._mmview is not self._mmap:
+                self._mmview.release()
+            try:
+                self._mmap.close()
+            except BufferError:
+                # a dead record still holds a view; the map is freed with it
+                pass
+            self._mmap = self._mmview = None
+
+        def _read_block(self, start, stop):
+            """
+            returns records start through stop-1 using a single read of the
+            file; records already in use are returned as-is
+            """
+            stop = min(stop, self._max_count)
+            if start >= stop:
+                return []
+            meta = self._meta
+            size = meta.header.record_length
+            block = self._read_raw(start, stop)
+            records = []
+            offset = 0
+            with self._lock:
+                for index in range(start, stop):
+                    maybe = self._weakref_list.get(index)
+                    if maybe is None:
+                        maybe = Record(recnum=index, layout=meta, kamikaze=block[offset:offset+size], _fromdisk=True)
+                        self._weakref_list[index] = maybe
+                        _count(meta, 'record_reads')
+                    if self._recent_size:
+                        self._remember(index, maybe)
+                    records.append(maybe)
+                    offset += size
+            return records
+
+        def _read_raw(self, start, stop):
+            """
+            returns the bytes of records start through stop-1 from a single
+            read of the file
+            """
+            meta = self._meta
+            if meta.status == CLOSED:
+                raise DbfError("%s is closed; records %d - %d are unavailable" % (meta.filename, start, stop-1))
+            header = meta.header
+            location = start * header.record_length + header.start
+            length = (stop - start) * header.record_length
+            if meta.mmap:
+                block = self._map(location + length)[location:location+length]
+                _count(meta, 'bytes_read', length)
+            else:
+                block = _read_at(meta, location, length)
+            if len(block) != length:
+                raise ValueError("unable to read record data from %s at location %d" % (meta.filename, location))
+            return block
+
+        def _forget(self):
+            """
+            drops all records (the records themselves are not changed)
+            """
+            with self._lock:
+                self._weakref_list.clear()
+                self._recent.clear()
+
+        def _remember(self, index, record):
+            """
+            makes record the most recently used, dropping the least recently
+            used one if the cache is full (the lock must be held)
+            """
+            recent = self._recent
+            recent.pop(index, None)
+            recent[index] = record
+            if len(recent) > self._recent_size:
+                recent.popitem(last=False)
 
         def append(self, record):
-            self._weakref_list[self._max_count] = weakref.ref(record)
-            self._max_count += 1
+            with self._lock:
+                self._weakref_list[self._max_count] = record
+                if self._recent_size:
+                    self._remember(self._max_count, record)
+                self._max_count += 1
 
         def clear(self):
-            for key in list(self._weakref_list.keys()):
-                del self._weakref_list[key]
+            self._unmap()
+            self._forget()
             self._max_count = 0
 
         def flush(self):
-            for maybe in self._weakref_list.values():
-                maybe = maybe()
-                if maybe and not maybe._write_to_disk:
+            for maybe in list(self._weakref_list.values()):
+                if not maybe._write_to_disk:
                     raise DbfError("some records have not been written to disk")
 
         def pop(self):
             if not self._max_count:
                 raise IndexError('no records exist')
-            self._max_count -= 1
-            record = self._weakref_list[self._max_count]
-            del self._weakref_list[self._max_count]
-            return record
+            with self._lock:
+                self._max_count -= 1
+                self._recent.pop(self._max_count, None)
+                return self._weakref_list.pop(self._max_count, None)
+
+    def _backup_filename(self):
+        """
+        name of the on-disk backup made by create_backup() and by changes to
+        the table's structure
+        """
+        upper = self.filename.isupper()
+        directory, filename = os.path.split(self.filename)
+        name, ext = os.path.splitext(filename)
+        extra = ('_backup', '_BACKUP')[upper]
+        return os.path.join(temp_dir or directory, name + extra + ext)
 
     def _build_header_fields(self):
         """
@@ -5308,6 +5860,51 @@ class Table(_Navigation):
         meta.user_field_count = len(meta.user_fields)
         Record._create_blank_data(meta)
 
+    def _can_stream(self, nulls=False):
+        """
+        whether a structure change can copy the records in a single pass with
+        _stream_records, instead of through a backup table; tables with null
+        flags (or gaining them with nulls) and ignored memos cannot
+        """
+        meta = self._meta
+        return (
+                meta.location == ON_DISK
+                and len(self) > 0
+                and not meta.ignorememos
+                and not nulls
+                and '_NULLFLAGS' not in meta.fields
+                )
+
+    def _check_fit(self, chosen, new_size):
+        """
+        raises DataOverflowError if a value of the chosen fields would not fit
+        in new_size characters
+        """
+        meta = self._meta
+        header = meta.header
+        size = header.record_length
+        spans = [
+                (meta[name][START] + new_size, meta[name][END], name)
+                for name in chosen
+                if meta[name][LENGTH] > new_size
+                ]
+        if not spans:
+            return
+        count = header.record_count
+        batch = max(1, (1 << 20) // size)
+        for start in range(0, count, batch):
+            stop = min(start + batch, count)
+            block = _read_at(meta, header.start + start * size, (stop - start) * size)
+            offset = 0
+            for rec_num in range(start, stop):
+                for first, end, name in spans:
+                    if block[offset+first:offset+end].strip():
+                        raise DataOverflowError(
+                                "record %d: %s does not fit in %d characters -- resize aborted"
+                                % (rec_num, name, new_size)
+                                )
+                offset += size
+
     def _check_memo_integrity(self):
         """
         checks memo file for problems
@@ -5351,6 +5948,35 @@ class Table(_Navigation):
             description = "%s %s(%d)%s" % (name, type.symbol, length, flags)
         return description
 
+    def _fill_record(self, record, row, drop=False):
+        """
+        stores row (tuple, dict, record, or template) in record without
+        writing record to disk
+        """
+        meta = self._meta
+        if isinstance(row, (Record, RecordTemplate)):
+            if row._meta.record_sig[0] == meta.record_sig[0]:
+                record._data[:] = array('B', to_bytes(row._data))
+                for field in meta.memofields:
+                    record._update_field_value(field, row[field])
+                return
+            row = dict(zip(field_names(row), row.as_tuple()))
+        if isinstance(row, dict):
+            for key, value in row.items():
+                key = ensure_unicode(key).upper()
+                if key not in meta.user_fields:
+                    if drop:
+                        continue
+                    raise FieldMissingError(key)
+                record._update_field_value(key, value)
+        elif isinstance(row, tuple):
+            if len(row) > self.field_count:
+                raise DbfError("incoming data has too many values")
+            for field, value in zip(meta.user_fields, row):
+                record._update_field_value(field, ensure_unicode(value))
+        else:
+            raise TypeError("data to append must be a tuple, dict, record, or template; not a %r" % type(row))
+
     def _list_fields(self, specs, sep=','):
         """
         standardizes field specs
@@ -5390,26 +6016,181 @@ class Table(_Navigation):
         year += 1900
         return Date(year, month, day)
 
+    def _link_backup(self):
+        """
+        saves the table's files under the backup name (the data file as a
+        link where possible, as it is about to be replaced), and returns the
+        current layout for _stream_records
+        """
+        meta = self._meta
+        header = meta.header
+        if meta.memo is not None:
+            meta.memo.flush()
+        meta.dfd.flush()
+        backup = self._backup_filename()
+        if os.path.exists(backup):
+            os.remove(backup)
+        try:
+            os.link(meta.filename, backup)
+        except (AttributeError, OSError):
+            shutil.copyfile(meta.filename, backup)
+        memo_backup = os.path.splitext(backup)[0] + os.path.splitext(meta.memoname)[1]
+        if meta.memo is not None:
+            # the memo file stays in use, so it is copied
+            shutil.copyfile(meta.memoname, memo_backup)
+        elif os.path.exists(memo_backup):
+            os.remove(memo_backup)
+        self.backup = backup
+        return dict(
+                fields=dict((name, meta[name]) for name in meta.fields),
+                order=list(meta.fields),
+                header=array('B', header._data),
+                memo=memo_backup if meta.memo is not None else None,
+                start=header.start,
+                length=header.record_length,
+                count=header.record_count,
+                )
+
+    def _restore_layout(self, old_layout):
+        """
+        puts back the layout saved by _link_backup after a restructure failed
+        before the new file replaced the table's file
+        """
+        meta = self._meta
+        meta.clear()
+        meta.update(old_layout['fields'])
+        meta.fields = list(old_layout['order'])
+        meta.header._data = old_layout['header']
+        meta.user_fields = FieldnameList([f for f in meta.fields if not meta[f][FLAGS] & SYSTEM])
+        meta.user_field_count = len(meta.user_fields)
+        meta.newmemofile = False
+        if old_layout['memo'] is None and meta.memo is not None:
+            # the memo file was created for the new layout
+            meta.mfd.close()
+            meta.mfd = None
+            meta.memo = None
+            os.remove(meta.memoname)
+        elif old_layout['memo'] is not None and meta.memo is None:
+            # the memo file was removed for the new layout
+            shutil.copyfile(old_layout['memo'], meta.memoname)
+            meta.memo = self._memoClass(meta)
+        if meta.dfd.closed:
+            meta.dfd = open(meta.filename, 'r+b')
+        Record._create_blank_data(meta)
+
+    def _stream_records(self, old_layout):
+        """
+        writes the records in the structure just built to a new file, in one
+        pass, and replaces the table's file with it; the bytes of unchanged
+        fields are copied, resized character fields are cut or padded with
+        spaces, and new fields are blank -- no field is decoded
+        """
+        meta = self._meta
+        header = meta.header
+        old_fields = old_layout['fields']
+        old_size = old_layout['length']
+        count = old_layout['count']
+        # (old start, old end, new start, new length) of each kept field, with
+        # neighbours that did not change merged into one copy
+        copies = []
+        for name in meta.fields:
+            if name not in old_fields:
+                continue
+            old, new = old_fields[name], meta[name]
+            if (
+                    copies and copies[-1][1] == old[START]
+                    and sum(copies[-1][2:]) == new[START]
+                    and copies[-1][1] - copies[-1][0] == copies[-1][3]
+                    and old[LENGTH] == new[LENGTH]
+                ):
+                first = copies.pop()
+                copies.append((first[0], old[END], first[2], first[3] + new[LENGTH]))
+            else:
+                copies.append((old[START], old[END], new[START], new[LENGTH]))
+        blank = bytearray(meta.blankrecord)
+        temp = meta.filename + '.tmp'
+        try:
+            with open(temp, 'wb') as out:
+                out.write(header.data)
+                batch = max(1, (1 << 20) // old_size)
+                for start in range(0, count, batch):
+                    stop = min(start + batch, count)
+                    block = _read_at(meta, old_layout['start'] + start * old_size, (stop - start) * old_size)
+                    if len(block) != (stop - start) * old_size:
+                        raise DbfError('unable to read records %d - %d of %s' % (start, stop-1, meta.filename))
+                    data = bytearray()
+                    for offset in range(0, len(block), old_size):
+                        record = bytearray(blank)
+                        record[0:1] = block[offset:offset+1]
+                        for first, end, new_start, length in copies:
+                            value = block[offset+first:offset+end]
+                            if end - first != length:
+                                value = value[:length].ljust(length)
+                            record[new_start:new_start+length] = value
+                        data.extend(record)
+                    out.write(bytes(data))
+                if self._versionabbr in ('db3', 'clp'):
+                    out.write(b'\x1a')        # required for dBase III compatibility
+        except Exception:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        table = self._table
+        table._unmap()
+        # records read in the old structure cannot be used
+        table._forget()
+        meta.dfd.close()
+        _replace_file(temp, meta.filename)
+        meta.dfd = open(meta.filename, 'r+b')
+        if fcntl is not None and any(meta.file_locks):
+            fcntl.flock(meta.dfd.fileno(), _FileLock._mode(meta.file_locks))
+        self.reindex()
+
+    def _refresh_end(self):
+        """
+        with lock_files set, and the exclusive lock held, rereads the record
+        count and the next memo block so that records and memos added by
+        other processes are not overwritten
+        """
+        meta = self._meta
+        if not lock_files or fcntl is None or meta.location != ON_DISK:
+            return
+        self.refresh()
+        if meta.memo is not None:
+            meta.memo.refresh()
+
     def _update_disk(self, headeronly=False):
         """
         synchronizes the disk file with current data
         """
         if self._meta.location == IN_MEMORY:
             return
+        _count(self._meta, 'header_writes')
+        with _FileLock(self._meta, active=lock_files):
+            self._write_header(headeronly)
+
+    def _write_header(self, headeronly):
+        """
+        writes the header and, unless headeronly, all records, then fixes
+        the end of the file
+        """
         meta = self._meta
         header = meta.header
         fd = meta.dfd
-        fd.seek(0)
-        fd.write(header.data)
+        _write_at(meta, 0, header.data)
         eof = header.start + header.record_count * header.record_length
         if not headeronly:
             for record in self:
                 record._update_disk()
             fd.flush()
+            self._table._unmap()
             fd.truncate(eof)
         if self._versionabbr in ('db3', 'clp'):
             fd.seek(0, SEEK_END)
-            fd.write(b'\x1a')        # required for dBase III compatibility
+            if fd.tell() > eof:
+                # the file shrinks below, which the memory map must not see
+                self._table._unmap()
+            _write_at(meta, eof, b'\x1a')      # required for dBase III compatibility
             fd.flush()
             fd.truncate(eof + 1)
 
@@ -5471,7 +6252,8 @@ class Table(_Navigation):
 
     def __init__(self, filename, field_specs=None, memo_size=128, ignore_memos=False,
                  codepage=None, default_data_types=None, field_data_types=None,    # e.g. 'name':str, 'age':float
-                 dbf_type=None, on_disk=True, unicode_errors='strict'
+                 dbf_type=None, on_disk=True, unicode_errors='strict', mmap=False,
+                 record_cache_size=None,
                  ):
         """
         open/create dbf file
@@ -5483,6 +6265,10 @@ class Table(_Navigation):
         keep_memos will also load any memo fields into memory
         meta_only will ignore all records, keeping only basic table information
         codepage will override whatever is set in the table itself
+        mmap will read records through a read-only memory map of the file;
+          records share the mapped data until they are modified
+        record_cache_size is the number of recently used records to keep in
+          memory (the module's record_cache_size if None)
         """
         if not on_disk:
             if field_specs is None:
@@ -5509,6 +6295,13 @@ class Table(_Navigation):
         meta.input_decoder = codecs.getdecoder(input_decoding)      # from ascii to unicode
         meta.output_encoder = codecs.getencoder(input_decoding)     # and back to ascii
         meta.unicode_errors = unicode_errors
+        meta.mmap = bool(mmap) and on_disk
+        meta.record_cache_size = record_cache_size
+        meta.io_lock = threading.RLock()
+        meta.flock_lock = threading.Lock()
+        meta.file_locks = [0, 0]
+        meta.stats = dict.fromkeys(_table_stat_names, 0)
+        meta.stats_lock = threading.Lock()
         meta.header = header = self._TableHeader(self._dbfTableHeader, self._pack_date, self._unpack_date)
         header.extra = self._dbfTableHeaderExtra
         if default_data_types is None:
@@ -5640,6 +6433,7 @@ class Table(_Navigation):
                     ):
                 classes.append(result_type)
             meta[field] = meta[field][:Field.CLASS] + tuple(classes) + meta[field][Field.NUL:]
+        Record._compile_codec(meta)
         self.close()
 
     def __iter__(self):
@@ -5656,7 +6450,8 @@ class Table(_Navigation):
 
     def __new__(cls, filename, field_specs=None, memo_size=128, ignore_memos=False,
                  codepage=None, default_data_types=None, field_data_types=None,    # e.g. 'name':str, 'age':float
-                 dbf_type=None, on_disk=True, unicode_errors='strict',
+                 dbf_type=None, on_disk=True, unicode_errors='strict', mmap=False,
+                 record_cache_size=None,
                  ):
         if dbf_type is None and isinstance(filename, Table):
             return filename
@@ -5807,7 +6602,8 @@ class Table(_Navigation):
         """
         adds field(s) to the table layout; format is Name Type(Length,Decimals)[; Name Type(Length,Decimals)[...]]
         backup table is created with _backup appended to name
-        then zaps table, recreates current structure, and copies records back from the backup
+        then the records are copied into the new structure (see _stream_records),
+        or the table is zapped, and the records copied back from the backup
         """
         # for python 2, convert field_specs from bytes to unicode if necessary
         if isinstance(field_specs, bytes):
@@ -5835,86 +6631,98 @@ class Table(_Navigation):
                     "Adding %d more field%s would exceed the limit of %d"
                     % (len(fields), ('','s')[len(fields)==1], meta.max_fields)
                     )
-        old_table = None
-        if self:
+        stream = self._can_stream(nulls=null_fields)
+        old_table = old_layout = None
+        if stream:
+            old_layout = self._link_backup()
+        elif self:
             old_table = self.create_backup()
             self.zap()
-        if meta.mfd is not None and not meta.ignorememos:
-            meta.mfd.close()
-            meta.mfd = None
-            meta.memo = None
-        if not meta.ignorememos:
-            meta.newmemofile = True
-        offset = 1
-        for name in meta.fields:
-            del meta[name]
-        meta.fields[:] = []
+        try:
+            if meta.mfd is not None and not meta.ignorememos and not stream:
+                meta.mfd.close()
+                meta.mfd = None
+                meta.memo = None
+            if not meta.ignorememos:
+                # streaming keeps the memo file; only a table without one needs it created
+                meta.newmemofile = not stream or meta.memo is None
+            offset = 1
+            for name in meta.fields:
+                del meta[name]
+            meta.fields[:] = []
 
-        meta.blankrecord = None
-        null_index = -1
-        for field_seq, field in enumerate(fields):
-            if not field:
-                continue
-            field = field.upper()
-            pieces = field.split()
-            name = pieces.pop(0)
-            try:
-                if '(' in pieces[0]:
-                    loc = pieces[0].index('(')
-                    pieces.insert(0, pieces[0][:loc])
-                    pieces[1] = pieces[1][loc:]
-                format = FieldType(pieces.pop(0))
-                if pieces and '(' in pieces[0]:
-                    for i, p in enumerate(pieces):
-                        if ')' in p:
-                            pieces[0:i+1] = [''.join(pieces[0:i+1])]
+            meta.blankrecord = None
+            null_index = -1
+            for field_seq, field in enumerate(fields):
+                if not field:
+                    continue
+                field = field.upper()
+                pieces = field.split()
+                name = pieces.pop(0)
+                try:
+                    if '(' in pieces[0]:
+                        loc = pieces[0].index('(')
+                        pieces.insert(0, pieces[0][:loc])
+                        pieces[1] = pieces[1][loc:]
+                    format = FieldType(pieces.pop(0))
+                    if pieces and '(' in pieces[0]:
+                        for i, p in enumerate(pieces):
+                            if ')' in p:
+                                pieces[0:i+1] = [''.join(pieces[0:i+1])]
+                                break
+                except IndexError:
+                    raise FieldSpecError('bad field spec: %r' % field)
+                if field_seq >= original_fields and (name[0] == '_' or name[0].isdigit() or not name.replace('_', '').isalnum()):
+                    # find appropriate line to point warning to
+                    for i, frame in enumerate(reversed(traceback.extract_stack()), start=1):
+                        if frame[0] == __file__ and frame[2] == 'resize_field':
+                            # ignore
                             break
-            except IndexError:
-                raise FieldSpecError('bad field spec: %r' % field)
-            if field_seq >= original_fields and (name[0] == '_' or name[0].isdigit() or not name.replace('_', '').isalnum()):
-                # find appropriate line to point warning to
-                for i, frame in enumerate(reversed(traceback.extract_stack()), start=1):
-                    if frame[0] == __file__ and frame[2] == 'resize_field':
-                        # ignore
-                        break
-                    elif frame[0] != __file__ or frame[2] not in ('__init__','add_fields'):
-                        warnings.warn('%r is invalid:  field names should start with a letter, and only contain letters, digits, and _' % name, FieldNameWarning, stacklevel=i)
-                        break
-            if name in meta.fields:
-                raise DbfError("Field '%s' already exists" % name)
-            field_type = format
-            if len(name) > 10:
-                raise FieldSpecError("Maximum field name length is 10.  '%s' is %d characters long." % (name, len(name)))
-            if not field_type in meta.fieldtypes.keys():
-                raise FieldSpecError("Unknown field type:  %s" % field_type)
-            init = self._meta.fieldtypes[field_type]['Init']
-            flags = self._meta.fieldtypes[field_type]['flags']
-            try:
-                length, decimals, flags = init(pieces, flags)
-            except FieldSpecError:
-                exc = sys.exc_info()[1]
-                raise FieldSpecError(exc.message + ' (%s:%s)' % (meta.filename, name)).from_exc(None)
-            nullable = flags & NULLABLE
-            if nullable:
-                null_index += 1
-            start = offset
-            end = offset + length
-            offset = end
-            meta.fields.append(name)
-            cls = meta.fieldtypes[field_type]['Class']
-            empty = meta.fieldtypes[field_type]['Empty']
-            meta[name] = (
-                    field_type,
-                    start,
-                    length,
-                    end,
-                    decimals,
-                    flags,
-                    cls,
-                    empty,
-                    nullable and null_index,
-                    )
-        self._build_header_fields()
+                        elif frame[0] != __file__ or frame[2] not in ('__init__','add_fields'):
+                            warnings.warn('%r is invalid:  field names should start with a letter, and only contain letters, digits, and _' % name, FieldNameWarning, stacklevel=i)
+                            break
+                if name in meta.fields:
+                    raise DbfError("Field '%s' already exists" % name)
+                field_type = format
+                if len(name) > 10:
+                    raise FieldSpecError("Maximum field name length is 10.  '%s' is %d characters long." % (name, len(name)))
+                if not field_type in meta.fieldtypes.keys():
+                    raise FieldSpecError("Unknown field type:  %s" % field_type)
+                init = self._meta.fieldtypes[field_type]['Init']
+                flags = self._meta.fieldtypes[field_type]['flags']
+                try:
+                    length, decimals, flags = init(pieces, flags)
+                except FieldSpecError:
+                    exc = sys.exc_info()[1]
+                    raise FieldSpecError(exc.message + ' (%s:%s)' % (meta.filename, name)).from_exc(None)
+                nullable = flags & NULLABLE
+                if nullable:
+                    null_index += 1
+                start = offset
+                end = offset + length
+                offset = end
+                meta.fields.append(name)
+                cls = meta.fieldtypes[field_type]['Class']
+                empty = meta.fieldtypes[field_type]['Empty']
+                meta[name] = (
+                        field_type,
+                        start,
+                        length,
+                        end,
+                        decimals,
+                        flags,
+                        cls,
+                        empty,
+                        nullable and null_index,
+                        )
+            self._build_header_fields()
+            if stream:
+                self._stream_records(old_layout)
+                return
+        except Exception:
+            if stream:
+                self._restore_layout(old_layout)
+            raise
         self._update_disk()
         if old_table is not None:
             old_table.open()
@@ -5941,8 +6749,6 @@ class Table(_Navigation):
         tupledata = False
         header = meta.header
         kamikaze = b''
-        if header.record_count == meta.max_records:
-            raise DbfError("table %r is full; unable to add any more records" % self)
         if isinstance(data, (Record, RecordTemplate)):
             if data._meta.record_sig[0] == self._meta.record_sig[0]:
                 kamikaze = data._data
@@ -5957,57 +6763,64 @@ class Table(_Navigation):
                 data = b''
             elif data:
                 raise TypeError("data to append must be a tuple, dict, record, or template; not a %r" % type(data))
-        newrecord = Record(recnum=header.record_count, layout=meta, kamikaze=kamikaze)
-        if kamikaze and meta.memofields:
-            newrecord._start_flux()
-            for field in meta.memofields:
-                newrecord[field] = data[field]
-            newrecord._commit_flux()
-
-        self._table.append(newrecord)
-        header.record_count += 1
-        if not kamikaze:
-            try:
-                if dictdata:
-                    gather(newrecord, dictdata, drop=drop)
-                elif tupledata:
-                    newrecord._start_flux()
-                    for index, item in enumerate(tupledata):
-                        item = ensure_unicode(item)
-                        newrecord[index] = item
-                    newrecord._commit_flux()
-                elif data:
-                    newrecord._start_flux()
-                    data_fields = field_names(data)
-                    my_fields = self.field_names
-                    for field in data_fields:
-                        if field not in my_fields:
-                            if not drop:
-                                raise DbfError("field %r not in table %r" % (field, self))
-                        else:
-                            newrecord[field] = data[field]
-                    newrecord._commit_flux()
-            except Exception:
-                self._table.pop()     # discard failed record
-                header.record_count = header.record_count - 1
-                self._update_disk()
-                raise
-        multiple -= 1
-        if multiple:
-            data = newrecord._data
-            single = header.record_count
-            total = single + multiple
-            while single < total:
-                multi_record = Record(single, meta, kamikaze=data)
-                multi_record._start_flux()
-                self._table.append(multi_record)
+        # the end of the table is found, and claimed, under the lock
+        with _FileLock(meta, active=lock_files):
+            self._refresh_end()
+            if header.record_count == meta.max_records:
+                raise DbfError("table %r is full; unable to add any more records" % self)
+            newrecord = Record(recnum=header.record_count, layout=meta, kamikaze=kamikaze)
+            if kamikaze and meta.memofields:
+                newrecord._start_flux()
                 for field in meta.memofields:
-                    multi_record[field] = newrecord[field]
-                single += 1
-                multi_record._commit_flux()
-            header.record_count = total   # += multiple
-            newrecord = multi_record
-        self._update_disk(headeronly=True)
+                    newrecord[field] = data[field]
+                newrecord._commit_flux()
+
+            self._table.append(newrecord)
+            header.record_count += 1
+            if not kamikaze:
+                try:
+                    if dictdata:
+                        gather(newrecord, dictdata, drop=drop)
+                    elif tupledata:
+                        newrecord._start_flux()
+                        for index, item in enumerate(tupledata):
+                            item = ensure_unicode(item)
+                            newrecord[index] = item
+                        newrecord._commit_flux()
+                    elif data:
+                        newrecord._start_flux()
+                        data_fields = field_names(data)
+                        my_fields = self.field_names
+                        for field in data_fields:
+                            if field not in my_fields:
+                                if not drop:
+                                    raise DbfError("field %r not in table %r" % (field, self))
+                            else:
+                                newrecord[field] = data[field]
+                        newrecord._commit_flux()
+                except Exception:
+                    self._table.pop()     # discard failed record
+                    header.record_count = header.record_count - 1
+                    self._update_disk()
+                    raise
+            multiple -= 1
+            if multiple:
+                data = newrecord._data
+                single = header.record_count
+                total = single + multiple
+                while single < total:
+                    multi_record = Record(single, meta, kamikaze=data)
+                    multi_record._start_flux()
+                    self._table.append(multi_record)
+                    for field in meta.memofields:
+                        multi_record[field] = newrecord[field]
+                    single += 1
+                    multi_record._commit_flux()
+                header.record_count = total   # += multiple
+                newrecord = multi_record
+            if lock_files and meta.memo is not None:
+                meta.memo.flush()
+            self._update_disk(headeronly=True)
 
     def close(self):
         """
@@ -6015,8 +6828,12 @@ class Table(_Navigation):
         ensures table data is available if keep_table
         ensures memo data is available if keep_memos
         """
-        if self._meta.location == ON_DISK and self._meta.status != CLOSED:
+        was_open = self._meta.status != CLOSED
+        if self._meta.location == ON_DISK and was_open:
             self._table.flush()
+            self._table._unmap()
+            if self._meta.memo is not None and self._meta.mfd is not None:
+                self._meta.memo.flush()
             if self._meta.mfd is not None:
                 self._meta.mfd.close()
                 self._meta.mfd = None
@@ -6024,6 +6841,96 @@ class Table(_Navigation):
                 self._meta.dfd.close()
                 self._meta.dfd = None
         self._meta.status = CLOSED
+        if was_open and stats_hook is not None:
+            stats_hook(self._meta.filename, self.stats())
+
+    def columns(self, fields, start=0, stop=None, batch=1024, as_numpy=False):
+        """
+        returns a dictionary of field name -> values for records start through
+        stop-1, decoding each field a block of batch records at a time
+
+        numeric fields (N, F, B, I, Y) are returned as floats in an array('d'),
+        or a numpy array if as_numpy, with blank and null values as nan; other
+        fields are returned as lists of their usual values
+        """
+        self._nav_check()
+        meta = self._meta
+        if isinstance(fields, basestring):
+            fields = fields.split(',')
+        names = [f.strip() for f in fields]
+        length = len(self)
+        if stop is None or stop > length:
+            stop = length
+        size = meta.header.record_length
+        nan = float('nan')
+        null_start = None
+        if '_NULLFLAGS' in meta:
+            null_start = meta['_NULLFLAGS'][START]
+        columns = {}
+        decoders = []
+        for name in names:
+            if name.upper() not in meta.user_fields:
+                raise FieldMissingError(name)
+            fielddef = meta[name.upper()]
+            field_type = fielddef[TYPE]
+            null_bit = None
+            if fielddef[FLAGS] & NULLABLE and null_start is not None:
+                null_bit = divmod(fielddef[NUL], 8)
+            if field_type in (NUMERIC, FLOAT, DOUBLE, INTEGER, CURRENCY):
+                column = array('d')
+            else:
+                column = []
+            columns[name] = column
+            decoders.append((column, field_type, fielddef, null_bit))
+        unpack_double = struct.Struct('<d').unpack_from
+        unpack_integer = struct.Struct('<i').unpack_from
+        unpack_currency = struct.Struct('<q').unpack_from
+        while start < stop:
+            end = min(start + batch, stop)
+            if meta.location == IN_MEMORY:
+                block = b''.join([to_bytes(r._data) for r in self._table[start:end]])
+            else:
+                block = self._table._read_raw(start, end)
+            block = to_bytes(block)
+            data = array('B', block)
+            starts = range(0, len(block), size)
+            for column, field_type, fielddef, null_bit in decoders:
+                base = len(column)
+                offset = fielddef[START]
+                field_end = fielddef[END]
+                if field_type in (NUMERIC, FLOAT):
+                    append = column.append
+                    for rs in starts:
+                        string = block[rs+offset:rs+field_end].replace(b'\x00', b'').strip()
+                        if not string or string[0:1] == b'*':
+                            append(nan)
+                        else:
+                            append(float(string))
+                elif field_type == DOUBLE:
+                    column.extend([unpack_double(block, rs+offset)[0] for rs in starts])
+                elif field_type == INTEGER:
+                    column.extend([unpack_integer(block, rs+offset)[0] for rs in starts])
+                elif field_type == CURRENCY:
+                    column.extend([unpack_currency(block, rs+offset)[0] / 10000.0 for rs in starts])
+                else:
+                    retrieve = meta.fieldtypes[field_type]['Retrieve']
+                    column.extend([
+                            retrieve(data[rs+offset:rs+field_end], fielddef, meta.memo, meta.decoder)
+                            for rs in starts
+                            ])
+                if null_bit is not None:
+                    byte, bit = null_bit
+                    for i, rs in enumerate(starts):
+                        if data[rs + null_start + byte] >> bit & 1:
+                            column[base+i] = nan if type(column) is array else Null
+            start = end
+        if as_numpy:
+            # only imported when asked for, as it is slow to import
+            import numpy
+            for name, column in columns.items():
+                if type(column) is array:
+                    columns[name] = numpy.array(column, dtype=float)
+        return columns
 
     def create_backup(self, new_name=None, on_disk=None):
         """
@@ -6038,11 +6945,7 @@ class Table(_Navigation):
         if not on_disk and new_name is None:
             new_name = self.filename + '_backup'
         if new_name is None:
-            upper = self.filename.isupper()
-            directory, filename = os.path.split(self.filename)
-            name, ext = os.path.splitext(filename)
-            extra = ('_backup', '_BACKUP')[upper]
-            new_name = os.path.join(temp_dir or directory, name + extra + ext)
+            new_name = self._backup_filename()
         memo_size = meta.memo_size
         bkup = Table(
                 new_name, self.structure(), memo_size,
@@ -6062,14 +6965,29 @@ class Table(_Navigation):
             self.close()
         return bkup
 
-    def create_index(self, key):
+    def create_index(self, key, filename=None, kind='sorted'):
         """
-        creates an in-memory index using the function key
+        creates an in-memory index using the function key, or of the field(s)
+        named by key; an index of a single field is used by query() to find
+        matching records without scanning the table;
+        if filename is given the index is saved there, and reloaded from there
+        instead of rebuilt as long as the table has not changed;
+        kind is 'sorted' (an Index), 'prefix' (a PrefixIndex, for searching
+        one string field by prefix), or 'hash' (a HashIndex, for exact matches
+        only, which cannot be saved)
         """
         meta = self._meta
         if meta.status == CLOSED:
             raise DbfError('%s is closed' % meta.filename)
-        return Index(self, key)
+        if kind == 'hash':
+            if filename is not None:
+                raise DbfError('hash indexes cannot be saved')
+            return HashIndex(self, key)
+        elif kind == 'prefix':
+            return PrefixIndex(self, key, filename=filename)
+        elif kind != 'sorted':
+            raise ValueError("kind must be 'sorted', 'prefix', or 'hash', not %r" % (kind, ))
+        return Index(self, key, filename=filename)
 
     def create_template(self, record=None, defaults=None):
         """
@@ -6090,33 +7008,44 @@ class Table(_Navigation):
         for victim in doomed:
             if victim not in meta.user_fields:
                 raise DbfError("field %s not in table -- delete aborted" % victim)
-        old_table = None
-        if self:
+        stream = self._can_stream()
+        old_table = old_layout = None
+        if stream:
+            old_layout = self._link_backup()
+        elif self:
             old_table = self.create_backup()
             self.zap()
-        if meta.mfd is not None and not meta.ignorememos:
-            meta.mfd.close()
-            meta.mfd = None
-            meta.memo = None
-        if not meta.ignorememos:
-            meta.newmemofile = True
-        if '_NULLFLAGS' in meta.fields:
-            doomed.append('_NULLFLAGS')
-        for victim in doomed:
-            layout = meta[victim]
-            meta.fields.pop(meta.fields.index(victim))
-            start = layout[START]
-            end = layout[END]
-            for field in meta.fields:
-                if meta[field][START] == end:
-                    specs = list(meta[field])
-                    end = specs[END]                    #self._meta[field][END]
-                    specs[START] = start                #self._meta[field][START] = start
-                    specs[END] = start + specs[LENGTH]  #self._meta[field][END] = start + self._meta[field][LENGTH]
-                    start = specs[END]                  #self._meta[field][END]
-                    meta[field] =  tuple(specs)
-        self._build_header_fields()
-        self._update_disk()
+        try:
+            if meta.mfd is not None and not meta.ignorememos and not stream:
+                meta.mfd.close()
+                meta.mfd = None
+                meta.memo = None
+            if not meta.ignorememos:
+                meta.newmemofile = not stream
+            if '_NULLFLAGS' in meta.fields:
+                doomed.append('_NULLFLAGS')
+            for victim in doomed:
+                layout = meta[victim]
+                meta.fields.pop(meta.fields.index(victim))
+                start = layout[START]
+                end = layout[END]
+                for field in meta.fields:
+                    if meta[field][START] == end:
+                        specs = list(meta[field])
+                        end = specs[END]                    #self._meta[field][END]
+                        specs[START] = start                #self._meta[field][START] = start
+                        specs[END] = start + specs[LENGTH]  #self._meta[field][END] = start + self._meta[field][LENGTH]
+                        start = specs[END]                  #self._meta[field][END]
+                        meta[field] =  tuple(specs)
+            self._build_header_fields()
+            if stream:
+                self._stream_records(old_layout)
+        except Exception:
+            if stream:
+                self._restore_layout(old_layout)
+            raise
+        if not stream:
+            self._update_disk()
         for name in list(meta):
             if name not in meta.fields:
                 del meta[name]
@@ -6160,6 +7089,89 @@ class Table(_Navigation):
                 self.append(scatter(record))
             old_table.close()
 
+    def extend(self, rows, batch_size=1000, drop=False):
+        """
+        appends rows of tuples, dicts, records, or templates; each batch of
+        batch_size records is written with a single call, and the header and
+        indices are updated once per batch
+
+        if a row fails the rows before it are kept; returns the number of
+        records added
+        """
+        meta = self._meta
+        if meta.status != READ_WRITE:
+            raise DbfError('%s not in read/write mode, unable to append records' % meta.filename)
+        if not self.field_count:
+            raise DbfError("No fields defined, cannot append")
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1, not %r" % (batch_size, ))
+        added = 0
+        if meta.location == IN_MEMORY:
+            for row in rows:
+                self.append(row, drop=drop)
+                added += 1
+            return added
+        header = meta.header
+        rows = iter(rows)
+        while "more rows":
+            records = []
+            error = None
+            # readers in other processes see the whole batch or none of it, and
+            # other writers wait to find the new end of the table
+            with _FileLock(meta, active=lock_files):
+                self._refresh_end()
+                memo = meta.memo
+                if memo is not None:
+                    batch_memo = memo.nextmemo
+                for row in rows:
+                    recnum = header.record_count + len(records)
+                    if recnum == meta.max_records:
+                        error = DbfError("table %r is full; unable to add any more records" % self)
+                        break
+                    record = Record(recnum, meta, kamikaze=meta.blankrecord, _fromdisk=True)
+                    if memo is not None:
+                        row_memo = memo.nextmemo
+                    try:
+                        self._fill_record(record, row, drop)
+                    except Exception:
+                        error = sys.exc_info()[1]
+                        if memo is not None:
+                            # memos already stored for the failed row are not kept
+                            memo.rollback(row_memo)
+                        break
+                    records.append(record)
+                    if len(records) == batch_size:
+                        break
+                if records:
+                    data = array('B')
+                    for record in records:
+                        data.extend(record._data)
+                    record_count = header.record_count
+                    try:
+                        if memo is not None:
+                            memo.flush()
+                        _write_at(meta, header.start + record_count * header.record_length, data)
+                        header.record_count += len(records)
+                        self._update_disk(headeronly=True)
+                    except Exception:
+                        # the batch was not added, so neither are its memos
+                        header.record_count = record_count
+                        if memo is not None:
+                            memo.rollback(batch_memo)
+                        raise
+                    for record in records:
+                        self._table.append(record)
+            if records:
+                _count(meta, 'record_writes', len(records))
+                for dbfindex in self._indexen:
+                    _count(meta, 'index_updates')
+                    dbfindex._bulk_append(records)
+                added += len(records)
+            if error is not None:
+                raise error
+            if len(records) < batch_size:
+                return added
+
     def field_info(self, field):
         """
         returns (field type, size, dec, class) of field
@@ -6190,6 +7202,57 @@ class Table(_Navigation):
         else:
             raise NotFoundError("dbf.Table.index(x): x not in table", data=record)
 
+    def lock(self, shared=False):
+        """
+        returns a context manager holding an exclusive (or shared) fcntl lock
+        on the table file; locks nest, and are held for the whole process
+        (without fcntl it does nothing)
+
+        writers take the exclusive lock automatically when lock_files is set
+        """
+        meta = self._meta
+        if meta.status == CLOSED:
+            raise DbfError('%s is closed' % meta.filename)
+        return _FileLock(meta, shared)
+
+    def map_ranges(self, func, workers=None, chunks=None):
+        """
+        calls func(table, start, stop) for contiguous ranges of record numbers
+        and returns the results in record order
+
+        each range is handled by a worker process that reopens the table
+        read-only, so func must be picklable (a module-level function, or a
+        functools.partial of one); workers defaults to the number of cpus,
+        and chunks (the number of ranges) to four per worker; in-memory
+        tables, and a single worker, are handled in this process
+        """
+        meta = self._meta
+        if meta.status == CLOSED:
+            raise DbfError('%s is closed' % meta.filename)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if chunks is None:
+            chunks = workers * 4
+        length = len(self)
+        chunk = max(1, -(-length // max(chunks, 1)))
+        ranges = [(start, min(start + chunk, length)) for start in range(0, length, chunk)]
+        if workers < 2 or len(ranges) < 2 or meta.location == IN_MEMORY:
+            return [func(self, start, stop) for start, stop in ranges]
+        if meta.status == READ_WRITE:
+            if meta.memo is not None:
+                meta.memo.flush()
+            meta.dfd.flush()
+        spec = (
+                meta.filename, self._versionabbr, meta.header.codepage(),
+                meta._default_data_types, meta._field_data_types, meta.mmap,
+                )
+        pool = multiprocessing.Pool(min(workers, len(ranges)))
+        try:
+            return pool.map(_map_range, [(spec, func, start, stop) for start, stop in ranges], 1)
+        finally:
+            pool.close()
+            pool.join()
+
     def new(self, filename, field_specs=None, memo_size=None, ignore_memos=None, codepage=None, default_data_types=None, field_data_types=None, on_disk=True):
         """
         returns a new table of the same type
@@ -6223,19 +7286,25 @@ class Table(_Navigation):
             raise FieldMissingError(field)
         return bool(self._meta[field][FLAGS] & NULLABLE)
 
-    def open(self, mode=READ_ONLY):
+    def open(self, mode=READ_ONLY, mmap=None):
         """
         (re)opens disk table, (re)initializes data structures
+        mmap, if not None, turns memory-mapped record access on or off
         """
         if mode not in (READ_WRITE, READ_ONLY):
             raise DbfError("mode for open must be dbf.READ_ONLY or dbf.READ_WRITE, not %r" % mode)
         meta = self._meta
+        if mmap is not None and meta.location == ON_DISK:
+            if meta.mmap and not mmap and '_table' in dir(self):
+                self._table._unmap()
+            meta.mmap = bool(mmap)
         if meta.status == mode:
             return self     # no-op
         meta.status = mode
         if meta.location == IN_MEMORY:
             return self
         if '_table' in dir(self):
+            self._table._unmap()
             del self._table
         mode = ('rb', 'r+b')[meta.status is READ_WRITE]
         dfd = meta.dfd = open(meta.filename, mode)
@@ -6266,42 +7335,129 @@ class Table(_Navigation):
     def pack(self):
         """
         physically removes all deleted records
+
+        returns an array mapping each old record number to its new one (-1 for
+        removed records); indexes are renumbered with it, and List.remap()
+        can use it to keep a List of this table's records valid
         """
         meta = self._meta
         if meta.status != READ_WRITE:
             raise DbfError('%s not in read/write mode, unable to pack records' % meta.filename)
-        for dbfindex in self._indexen:
-            dbfindex._clear()
-        newtable = []
-        index = 0
-        for record in self._table:
-            if is_deleted(record):
-                record._recnum = -1
-            else:
-                record._recnum = index
-                newtable.append(record)
-                index += 1
-        if meta.location == ON_DISK:
-            self._table.clear()
+        if meta.location == IN_MEMORY:
+            mapping = array('l')
+            survivors = []
+            for record in self._table:
+                if is_deleted(record):
+                    record._recnum = -1
+                    mapping.append(-1)
+                else:
+                    record._recnum = len(survivors)
+                    mapping.append(len(survivors))
+                    survivors.append(record)
+            self._table[:] = survivors
+            meta.header.record_count = len(survivors)
         else:
-            self._table[:] = []
-        for record in newtable:
-            self._table.append(record)
+            with _FileLock(meta, active=lock_files):
+                mapping = self._pack_disk()
         self._pack_count += 1
-        self._meta.header.record_count = index
         self._index = -1
-        self._update_disk()
-        self.reindex()
+        for dbfindex in self._indexen:
+            dbfindex._remap(mapping)
+        return mapping
 
-    def query(self, criteria):
+    def _pack_disk(self):
+        """
+        moves the live records forward over the deleted ones, a block at a
+        time, then truncates the file; returns the record number mapping
+        """
+        meta = self._meta
+        header = meta.header
+        table = self._table
+        size = header.record_length
+        count = header.record_count
+        deleted = ASTERISK.byte
+        # records must not keep views of bytes that are about to move
+        table._unmap()
+        mapping = array('l', [-1]) * count
+        batch = max(1, (1 << 20) // size)   # about a megabyte per read
+        new = 0
+        for start in range(0, count, batch):
+            stop = min(start + batch, count)
+            location = header.start + start * size
+            block = _read_at(meta, location, (stop - start) * size)
+            if len(block) != (stop - start) * size:
+                raise DbfError('unable to read records %d - %d of %s' % (start, stop-1, meta.filename))
+            first = new
+            chunks = []
+            offset = 0
+            for rec_num in range(start, stop):
+                if block[offset:offset+1] != deleted:
+                    chunks.append(block[offset:offset+size])
+                    mapping[rec_num] = new
+                    new += 1
+                offset += size
+            if chunks and (first != start or new - first != stop - start):
+                # survivors only move once something at or before them is gone
+                _write_at(meta, header.start + first * size, b''.join(chunks))
+        with table._lock:
+            moved = weakref.WeakValueDictionary()
+            for rec_num, record in list(table._weakref_list.items()):
+                record._recnum = mapping[rec_num]
+                if record._recnum != -1:
+                    moved[record._recnum] = record
+            table._weakref_list = moved
+            table._recent = OrderedDict(
+                    (mapping[rec_num], record)
+                    for rec_num, record in table._recent.items()
+                    if mapping[rec_num] != -1
+                    )
+            table._max_count = new
+            header.record_count = new
+        meta.dfd.flush()
+        meta.dfd.truncate(header.start + new * size)
+        self._update_disk(headeronly=True)
+        return mapping
+
+    def query(self, criteria, parallel=None, projection=False):
         """
         criteria is a string that will be converted into a function that returns
         a List of all matching records
+
+        if parallel is greater than one, that many worker processes search
+        (and aggregate) ranges of the table; if projection, a select returns
+        a ResultSet of namedtuples of the selected fields
         """
         meta = self._meta
         if meta.status == CLOSED:
             raise DbfError('%s is closed' % meta.filename)
-        return pql(self, criteria)
+        return pql(self, criteria, parallel=parallel, projection=projection)
+
+    def refresh(self):
+        """
+        rereads the record count from the header on disk so records appended
+        by another process are available; returns the number of new records
+        """
+        meta = self._meta
+        if meta.status == CLOSED:
+            raise DbfError('%s is closed' % meta.filename)
+        if meta.location == IN_MEMORY:
+            return 0
+        with _FileLock(meta, shared=True):
+            if _pread is not None:
+                count = _read_at(meta, 4, 4)
+            else:
+                # the file object may answer from a stale buffer
+                with open(meta.filename, 'rb') as fh:
+                    fh.seek(4)
+                    count = fh.read(4)
+        count = unpack_long_int(to_bytes(count))
+        old_count = len(self)
+        if count < old_count:
+            raise DbfError('%s has fewer records than when opened; reopen it' % meta.filename)
+        with self._table._lock:
+            meta.header.record_count = count
+            self._table._max_count = count
+        return count - old_count
 
     def reindex(self):
         """
@@ -6340,7 +7496,8 @@ class Table(_Navigation):
     def resize_field(self, chosen, new_size):
         """
         resizes field (C only at this time)
-        creates backup file, then modifies current structure
+        creates backup file, then modifies current structure; values that
+        do not fit the new size raise DataOverflowError
         """
         meta = self._meta
         if meta.status != READ_WRITE:
@@ -6357,6 +7514,24 @@ class Table(_Navigation):
                 raise DbfError("field %s not in table -- resize aborted" % candidate)
             elif self.field_info(candidate).field_type != FieldType.CHAR:
                 raise DbfError("field %s is not Character -- resize aborted" % candidate)
+        if self._can_stream() and self._versionabbr != 'clp':
+            self._check_fit(chosen, new_size)
+            old_layout = self._link_backup()
+            try:
+                offset = 1
+                for name in meta.fields:
+                    specs = list(meta[name])
+                    if name in chosen:
+                        specs[LENGTH] = new_size
+                    specs[START] = offset
+                    specs[END] = offset = offset + specs[LENGTH]
+                    meta[name] = tuple(specs)
+                self._build_header_fields()
+                self._stream_records(old_layout)
+            except Exception:
+                self._restore_layout(old_layout)
+                raise
+            return
         old_table = None
         if self:
             old_table = self.create_backup()
@@ -6382,6 +7557,39 @@ class Table(_Navigation):
                 self.append(scatter(record), drop=True)
             old_table.close()
 
+    def scan_blocks(self, batch=1024, start=0, stop=None):
+        """
+        yields lists of up to batch records, reading each list from the
+        disk file in one call
+        """
+        self._nav_check()
+        if batch < 1:
+            raise ValueError("batch must be at least 1, not %r" % (batch, ))
+        length = len(self)
+        if stop is None or stop > length:
+            stop = length
+        while start < stop:
+            end = min(start + batch, stop)
+            if self._meta.location == IN_MEMORY:
+                yield self._table[start:end]
+            else:
+                yield self._table._read_block(start, end)
+            start = end
+
+    def stats(self, reset=False):
+        """
+        returns a dict of this table's counters: records and bytes read and
+        written, record cache hits and misses, memos read and written, header
+        writes, index updates, and pql compilations and the seconds they took;
+        if reset, the counters start over from zero
+        """
+        meta = self._meta
+        with meta.stats_lock:
+            result = dict(meta.stats)
+            if reset:
+                meta.stats.update(dict.fromkeys(_table_stat_names, 0))
+        return result
+
     def structure(self, fields=None):
         """
         return field specification list suitable for creating same table layout
@@ -7503,6 +8711,33 @@ class List(_Navigation):
         """
         return pql(self, criteria)
 
+    def remap(self, table, mapping):
+        """
+        renumbers the records of table after table.pack(), which returned
+        mapping, so the list stays valid; records removed by the pack are
+        dropped from the list
+        """
+        items = []
+        values = set()
+        found = False
+        for item in self._list:
+            source, rec_num, value = item
+            if source is table:
+                found = True
+                new = mapping[rec_num]
+                if new == -1:
+                    continue
+                if isinstance(value, tuple) and len(value) == 2 and value[0] is table and value[1] == rec_num:
+                    # the default key is the record number itself
+                    value = table, new
+                item = source, new, value
+            items.append(item)
+            values.add(value)
+        self._list = items
+        self._set = values
+        if found:
+            self._tables[table] = table._pack_count
+
     def remove(self, data):
         self._still_valid_check()
         if not isinstance(data, (Record, RecordTemplate, dict, tuple)):
@@ -7524,47 +8759,96 @@ class List(_Navigation):
         return self._list.sort(key=lambda item: key(item[0][item[1]]), reverse=reverse)
 
 
+class ResultSet(list):
+    """
+    rows of values computed by a pql command, such as an aggregate or a
+    projection; field_names names the columns of each row
+    """
+
+    def __init__(self, rows=(), field_names=None):
+        super(ResultSet, self).__init__(rows)
+        self.field_names = list(field_names or [])
+        self.modified = 0, 'records'
+
+    def __reduce__(self):
+        # namedtuple rows are pickled as tuples and rebuilt when loaded
+        named = bool(self) and hasattr(self[0], '_fields')
+        return _rebuild_result_set, (self.field_names, [tuple(r) for r in self], self.modified, named)
+
+    def __repr__(self):
+        return '%s(%s, field_names=%r)' % (
+                self.__class__.__name__, list.__repr__(self), self.field_names,
+                )
+
+def _rebuild_result_set(field_names, rows, modified, named):
+    if named:
+        rows = map(_row_type(field_names)._make, rows)
+    result = ResultSet(rows, field_names)
+    result.modified = modified
+    return result
+
+_row_types = {}
+
+def _row_type(field_names):
+    """
+    returns the namedtuple class for rows of field_names
+    """
+    field_names = tuple(field_names)
+    row = _row_types.get(field_names)
+    if row is None:
+        row = _row_types[field_names] = namedtuple(
+                'Row', [str(f.lower()) for f in field_names], rename=True,
+                )
+    return row
+
+
 class Index(_Navigation):
     """
-    non-persistent index for a table
+    in-memory index for a table, optionally saved to a file
     """
 
-    def __init__(self, table, key):
+    def __init__(self, table, key, filename=None):
+        """
+        key is a function, or a string naming the field(s) to index;
+        if filename is given the index is loaded from it (when it was saved
+        against the table as it is now), otherwise it is built and saved there
+        """
         self._table = table
-        self._values = []             # ordered list of values
-        self._rec_by_val = []         # matching record numbers
-        self._records = {}            # record numbers:values
+        self._fields = None
+        if isinstance(key, basestring):
+            self._fields = tuple(table._list_fields(key))
+            key = _field_key(self._fields)
         self.__doc__ = key.__doc__ or 'unknown'
         self._key = key
         self._previous_status = []
-        for record in table:
-            value = key(record)
-            if value is DoNotIndex:
-                continue
-            rec_num = recno(record)
-            if not isinstance(value, tuple):
-                value = (value, )
-            vindex = bisect_right(self._values, value)
-            self._values.insert(vindex, value)
-            self._rec_by_val.insert(vindex, rec_num)
-            self._records[rec_num] = value
+        self._filename = filename
+        if filename is not None and table._meta.location != ON_DISK:
+            raise DbfError("unable to save index of in-memory table %s" % table.filename)
+        if filename is None or self._signature() != self._saved_signature():
+            self._build()
+            if filename is not None:
+                self.save()
+        # else _values, _rec_by_val, and _records are loaded on first use
         table._indexen.add(self)
 
+    def __getattr__(self, name):
+        if name in ('_values', '_rec_by_val', '_records'):
+            self._load()
+        return object.__getattribute__(self, name)
+
     def __call__(self, record):
         rec_num = recno(record)
         key = self.key(record)
         if rec_num in self._records:
             if self._records[rec_num] == key:
                 return
-            old_key = self._records[rec_num]
-            vindex = bisect_left(self._values, old_key)
+            vindex = self._position(self._records[rec_num], rec_num)
             self._values.pop(vindex)
             self._rec_by_val.pop(vindex)
             del self._records[rec_num]
-            assert rec_num not in self._records
         if key == (DoNotIndex, ):
             return
-        vindex = bisect_right(self._values, key)
+        vindex = self._position(key, rec_num)
         self._values.insert(vindex, key)
         self._rec_by_val.insert(vindex, rec_num)
         self._records[rec_num] = key
@@ -7634,6 +8918,43 @@ class Index(_Navigation):
     def __len__(self):
         return len(self._records)
 
+    def _build(self):
+        """
+        creates the index from the table's records
+        """
+        key = self.key
+        pairs = []
+        for record in self._table:
+            value = key(record)
+            if value == (DoNotIndex, ):
+                continue
+            pairs.append((value, recno(record)))
+        # stable, so equal values stay in record order
+        pairs.sort(key=itemgetter(0))
+        self._values = [p[0] for p in pairs]        # ordered list of values
+        self._rec_by_val = [p[1] for p in pairs]    # matching record numbers
+        self._records = dict((r, v) for v, r in pairs)  # record numbers:values
+
+    def _bulk_append(self, records):
+        """
+        adds newly appended records to the index with a single merge
+        """
+        pairs = []
+        for record in records:
+            value = self.key(record)
+            if value == (DoNotIndex, ):
+                continue
+            pairs.append((value, recno(record)))
+        if not pairs:
+            return
+        pairs.sort(key=itemgetter(0))
+        # two sorted runs, which sort() merges in linear time
+        merged = list(zip(self._values, self._rec_by_val)) + pairs
+        merged.sort(key=itemgetter(0))
+        self._values[:] = [p[0] for p in merged]
+        self._rec_by_val[:] = [p[1] for p in merged]
+        self._records.update((r, v) for v, r in pairs)
+
     def _clear(self):
         """
         removes all entries from index
@@ -7649,6 +8970,39 @@ class Index(_Navigation):
         self._still_valid_check()
         return source_table(record), recno(record)
 
+    def _load(self):
+        """
+        reads the saved index, rebuilding it if the file is unusable
+        """
+        try:
+            with open(self._filename, 'rb') as fh:
+                signature = pickle.load(fh)
+                values, rec_by_val = pickle.load(fh)
+            if signature != self._signature():
+                raise ValueError('index file %s is out of date' % self._filename)
+        except Exception:
+            self._build()
+            return
+        self._values = values
+        self._rec_by_val = rec_by_val
+        self._records = dict(zip(rec_by_val, values))
+
+    def _position(self, value, rec_num):
+        """
+        returns where rec_num is, or belongs, in _values and _rec_by_val;
+        records with equal values are kept in record order
+        """
+        rec_by_val = self._rec_by_val
+        lo = bisect_left(self._values, value)
+        hi = bisect_right(self._values, value, lo)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if rec_by_val[mid] < rec_num:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
     def _nav_check(self):
         """
         raises error if table is closed
@@ -7664,10 +9018,20 @@ class Index(_Navigation):
             target = tuple(target)
         return target == match
 
+    def _prefix_bounds(self, prefix):
+        """
+        (lo, hi) locations of the values whose first item starts with prefix
+        """
+        lo = self._search((prefix, ), where='left')
+        successor = _prefix_successor(prefix)
+        if successor is None:
+            return lo, len(self._values)
+        return lo, self._search((successor, ), lo, where='left')
+
     def _purge(self, rec_num):
         value = self._records.get(rec_num)
         if value is not None:
-            vindex = bisect_left(self._values, value)
+            vindex = self._position(value, rec_num)
             del self._records[rec_num]
             self._values.pop(vindex)
             self._rec_by_val.pop(vindex)
@@ -7676,8 +9040,53 @@ class Index(_Navigation):
         """
         reindexes all records
         """
-        for record in self._table:
-            self(record)
+        self._build()
+
+    def _remap(self, mapping):
+        """
+        renumbers the records after a pack; mapping[old] is the new record
+        number, or -1 for a removed record
+        """
+        if '_values' not in self.__dict__:
+            # not loaded yet, and the saved copy no longer matches the
+            # table, so it is rebuilt from the packed table when first used
+            return
+        values = []
+        rec_by_val = []
+        for value, rec_num in zip(self._values, self._rec_by_val):
+            rec_num = mapping[rec_num]
+            if rec_num != -1:
+                values.append(value)
+                rec_by_val.append(rec_num)
+        self._values[:] = values
+        self._rec_by_val[:] = rec_by_val
+        self._records = dict(zip(rec_by_val, values))
+
+    def _saved_signature(self):
+        """
+        returns the table signature stored in the index file, or None
+        """
+        try:
+            with open(self._filename, 'rb') as fh:
+                return pickle.load(fh)
+        except Exception:
+            return None
+
+    def _signature(self):
+        """
+        (mtime, size, record count, pack count, index class, key) of the
+        table, where key is the indexed fields or a digest of the key function
+        """
+        table = self._table
+        meta = table._meta
+        if meta.status == READ_WRITE:
+            meta.dfd.flush()
+        stat = os.stat(meta.filename)
+        if self._fields is not None:
+            key = self._fields
+        else:
+            key = _key_digest(self._key)
+        return stat.st_mtime, stat.st_size, len(table), table._pack_count, type(self).__name__, key
 
     def _search(self, match, lo=0, hi=None, where=None):
         if hi is None:
@@ -7745,6 +9154,27 @@ class Index(_Navigation):
         self._nav_check()
         return pql(self, criteria)
 
+    def save(self, filename=None):
+        """
+        writes the index to filename (default is the one given when created)
+        so it can be reused until the table changes
+        """
+        if filename is None:
+            filename = self._filename
+        if filename is None:
+            raise DbfError("no file name given for index")
+        if self._table._meta.location != ON_DISK:
+            raise DbfError("unable to save index of in-memory table %s" % self._table.filename)
+        values, rec_by_val = self._values, self._rec_by_val
+        signature = self._signature()
+        temp = filename + '.tmp'
+        with open(temp, 'wb') as fh:
+            # signature is stored first so it can be checked without loading the index
+            pickle.dump(signature, fh, 2)
+            pickle.dump((values, rec_by_val), fh, 2)
+        _replace_file(temp, filename)
+        self._filename = filename
+
     def search(self, match, partial=False):
         """
         returns dbf.List of all (partially) matching records
@@ -7768,6 +9198,303 @@ class Index(_Navigation):
         return result
 
 
+class PrefixIndex(Index):
+    """
+    in-memory index of one string per record (such as a character field),
+    kept as a flat sorted list of strings so a prefix search is two
+    bisections and a slice
+    """
+
+    def _search(self, match, lo=0, hi=None, where=None):
+        if isinstance(match, tuple):
+            [match] = match
+        return super(PrefixIndex, self)._search(match, lo, hi, where)
+
+    def index_search(self, match, start=None, stop=None, nearest=False, partial=False):
+        """
+        returns the index of match between start and stop
+        start and stop default to the first and last record.
+        if nearest is true returns the location of where the match should be
+        otherwise raises NotFoundError
+        """
+        self._nav_check()
+        if isinstance(match, tuple):
+            [match] = match
+        if start is None:
+            start = 0
+        if stop is None:
+            stop = len(self)
+        loc = self._search(match, start, stop, where='left')
+        if loc < len(self._values) and (
+                self._values[loc] == match
+                or partial and self._values[loc].startswith(match)
+            ):
+            return IndexLocation(loc, True)
+        elif nearest:
+            return IndexLocation(loc, False)
+        else:
+            raise NotFoundError("dbf.PrefixIndex.index_search(x): x not in Index", data=match)
+
+    def key(self, record):
+        result = self._key(record)
+        if isinstance(result, tuple) and len(result) == 1:
+            [result] = result
+        if result is DoNotIndex or result is None or result is Null:
+            return (DoNotIndex, )
+        if not isinstance(result, basestring):
+            raise DbfError('PrefixIndex key must be a string, not %r' % (result, ))
+        return result
+
+    def search(self, match, partial=False):
+        """
+        returns dbf.List of all records equal to match, or starting with it
+        if partial
+        """
+        self._nav_check()
+        if isinstance(match, tuple):
+            [match] = match
+        if partial:
+            lo, hi = self._prefix_bounds(match)
+        else:
+            lo = self._search(match, where='left')
+            hi = self._search(match, lo, where='right')
+        result = List()
+        table = self._table
+        for rec_num in self._rec_by_val[lo:hi]:
+            record = table[rec_num]
+            result._maybe_add(item=(table, rec_num, result.key(record)))
+        return result
+
+
+class HashIndex(object):
+    """
+    in-memory equality index for a table: lookups and upkeep take constant
+    time, but the records are not kept in key order
+    """
+
+    def __init__(self, table, key):
+        """
+        key is a function, or a string naming the field(s) to index
+        """
+        self._table = table
+        self._fields = None
+        if isinstance(key, basestring):
+            self._fields = tuple(table._list_fields(key))
+            key = _field_key(self._fields)
+        self.__doc__ = key.__doc__ or 'unknown'
+        self._key = key
+        self._build()
+        table._indexen.add(self)
+
+    def __call__(self, record):
+        rec_num = recno(record)
+        key = self.key(record)
+        old_key = self._records.get(rec_num, self)
+        if old_key == key:
+            return
+        if old_key is not self:
+            self._remove(rec_num, old_key)
+        if key == (DoNotIndex, ):
+            return
+        insort(self._buckets.setdefault(key, []), rec_num)
+        self._records[rec_num] = key
+
+    def __contains__(self, data):
+        if not isinstance(data, (Record, RecordTemplate, tuple, dict)):
+            raise TypeError("%r is not a record, templace, tuple, nor dict" % (data, ))
+        if isinstance(data, tuple):
+            return data in self._buckets
+        return self.key(data) in self._buckets
+
+    def __getitem__(self, match):
+        """
+        returns a List of the records matching match (a value, a tuple of
+        values, or a record); raises NotFoundError if there are none
+        """
+        result = self.search(match)
+        if not result:
+            raise NotFoundError(match)
+        return result
+
+    def __len__(self):
+        return len(self._records)
+
+    def _build(self):
+        """
+        creates the index from the table's records
+        """
+        self._buckets = {}      # values:[record numbers, in order]
+        self._records = {}      # record numbers:values
+        buckets, records = self._buckets, self._records
+        for record in self._table:
+            value = self.key(record)
+            if value == (DoNotIndex, ):
+                continue
+            rec_num = recno(record)
+            buckets.setdefault(value, []).append(rec_num)
+            records[rec_num] = value
+
+    def _bulk_append(self, records):
+        """
+        adds newly appended records to the index
+        """
+        for record in records:
+            self(record)
+
+    def _clear(self):
+        """
+        removes all entries from index
+        """
+        self._buckets.clear()
+        self._records.clear()
+
+    def _nav_check(self):
+        """
+        raises error if table is closed
+        """
+        if self._table._meta.status == CLOSED:
+            raise DbfError('indexed table %s is closed' % self._table.filename)
+
+    def _purge(self, rec_num):
+        value = self._records.get(rec_num, self)
+        if value is not self:
+            self._remove(rec_num, value)
+
+    def _rec_nums(self, match):
+        """
+        record numbers, in order, of match (not to be changed by the caller)
+        """
+        return self._buckets.get(match, ())
+
+    def _reindex(self):
+        """
+        reindexes all records
+        """
+        self._build()
+
+    def _remap(self, mapping):
+        """
+        renumbers the records after a pack; mapping[old] is the new record
+        number, or -1 for a removed record
+        """
+        buckets = {}
+        records = {}
+        for value, bucket in self._buckets.items():
+            # pack keeps the records in order, so the buckets stay sorted
+            bucket = [mapping[r] for r in bucket if mapping[r] != -1]
+            if bucket:
+                buckets[value] = bucket
+                for rec_num in bucket:
+                    records[rec_num] = value
+        self._buckets = buckets
+        self._records = records
+
+    def _remove(self, rec_num, value):
+        bucket = self._buckets[value]
+        del bucket[bisect_left(bucket, rec_num)]
+        if not bucket:
+            del self._buckets[value]
+        del self._records[rec_num]
+
+    def key(self, record):
+        result = self._key(record)
+        if not isinstance(result, tuple):
+            result = (result, )
+        return result
+
+    def search(self, match):
+        """
+        returns dbf.List of all records matching match (a value, a tuple of
+        values, or a record), in record order
+        """
+        self._nav_check()
+        if isinstance(match, (Record, RecordTemplate)):
+            match = self.key(match)
+        elif not isinstance(match, tuple):
+            match = (match, )
+        result = List()
+        table = self._table
+        for rec_num in self._rec_nums(match):
+            record = table[rec_num]
+            result._maybe_add(item=(table, rec_num, result.key(record)))
+        return result
+
+
+def _prefix_successor(prefix):
+    """
+    returns the smallest string that sorts after every string starting with
+    prefix, or None if there is no such string
+    """
+    if isinstance(prefix, unicode):
+        top, char = sys.maxunicode, unichr
+    else:
+        top, char = 255, chr
+    while prefix:
+        last = ord(prefix[-1])
+        if last < top:
+            return prefix[:-1] + char(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+def _field_key(fields):
+    """
+    returns a key function for an Index of fields
+    """
+    if len(fields) == 1:
+        [field] = fields
+        def key(record):
+            return record[field]
+    else:
+        def key(record):
+            return tuple([record[f] for f in fields])
+    key.__name__ = str('fields_' + '_'.join(fields).lower())
+    key.__doc__ = ', '.join(fields).lower()
+    return key
+
+def _key_digest(key):
+    """
+    returns the name of key and a digest of its code, defaults, and the
+    values it closes over (and those of any functions among them), so a
+    saved Index is not reused for a different key function of the same
+    name; raises DbfError if key is not a function, as it cannot be checked
+    """
+    function_type = type(_key_digest)
+    if not isinstance(key, function_type):
+        raise DbfError('unable to save an index keyed by %r: only a function can be matched to a saved index' % (key, ))
+    digest = hashlib.md5()
+    functions = [key]
+    seen = set()
+    while functions:
+        function = functions.pop()
+        if function in seen:
+            continue
+        seen.add(function)
+        values = list(function.__defaults__ or ())
+        values.extend(sorted((getattr(function, '__kwdefaults__', None) or {}).items()))
+        for cell in function.__closure__ or ():
+            try:
+                values.append(cell.cell_contents)
+            except ValueError:
+                # the closed over variable has not been assigned yet
+                values.append(None)
+        codes = [function.__code__]
+        while codes:
+            code = codes.pop()
+            digest.update(code.co_code)
+            digest.update(' '.join(code.co_names).encode('utf8'))
+            for const in code.co_consts:
+                if isinstance(const, type(code)):
+                    codes.append(const)
+                else:
+                    values.append(const)
+        for value in values:
+            if isinstance(value, function_type):
+                functions.append(value)
+            else:
+                digest.update(repr(value).encode('utf8'))
+    return key.__name__, digest.hexdigest()
+
+
 class Relation(object):
     """
     establishes a relation between two dbf tables (not persistent)
@@ -7953,7 +9680,7 @@ class IntBytesType(BytesType):
         self.one_based = one_based
 
     def from_bytes(self, byte_data):
-        if self.neg_one_is_none and byte_data == '\xff' * self.size:
+        if self.neg_one_is_none and byte_data == b'\xff' * self.size:
             return None
         if self.big_endian:
             value = struct.unpack('>%s' % self.code, byte_data)[0]
@@ -7967,7 +9694,7 @@ class IntBytesType(BytesType):
     def to_bytes(self, value):
         if value is None:
             if self.neg_one_is_none:
-                return '\xff\xff'
+                return b'\xff' * self.size
             raise DbfError('unable to store None in %r' % self.__name__)
         limit = 2 ** (self.size * 8) - 1
         if self.one_based:
@@ -8021,7 +9748,7 @@ class Bytes(BytesType):
 
     def from_bytes(self, byte_data):
         if self.strip_null:
-            return byte_data.rstrip('\x00')
+            return byte_data.rstrip(b'\x00')
         else:
             return byte_data
 
@@ -8029,7 +9756,7 @@ class Bytes(BytesType):
         if not isinstance(value, bytes):
             raise DbfError('value must be bytes [%r]' % value)
         if self.strip_null and len(value) < self.size:
-            value += '\x00' * (self.size - len(value))
+            value += b'\x00' * (self.size - len(value))
         return value
 
 
@@ -8062,7 +9789,7 @@ class DataBlock(object):
         if self.size and total_field_size > self.size:
             raise DbfError('Fields in %r are using %d bytes, but only %d allocated' % (cls, total_field_size, self.size))
         total_field_size = self.size or total_field_size
-        cls._data = str('\x00' * total_field_size)
+        cls._data = b'\x00' * total_field_size
         cls.__len__ = lambda s: len(s._data)
         cls._size_ = total_field_size
         if not initialized:
@@ -8112,10 +9839,23 @@ class LruCache(object):
         self.head = self.Link(self.tail)             # newest
         self.head.prev_link = self.tail
         self.func = func
+        self.hits = self.misses = 0
         if func is not None:
             self.__name__ = func.__name__
             self.__doc__ = func.__doc__
 
+    def __len__(self):
+        return len(self.mapping)
+
+    def clear(self):
+        """
+        forgets all items and resets the hit and miss counts
+        """
+        self.mapping.clear()
+        self.head.prev_link = self.tail
+        self.tail.next_link = self.head
+        self.hits = self.misses = 0
+
     def __call__(self, *func):
         if self.func is None:
             [self.func] = func
@@ -8125,6 +9865,7 @@ class LruCache(object):
         mapping, head, tail = self.mapping, self.head, self.tail
         link = mapping.get(func, head)
         if link is head:
+            self.misses += 1
             value = self.func(*func)
             if len(mapping) >= self.maxsize:
                 old_prev, old_next, old_key, old_value = tail.next_link
@@ -8135,6 +9876,7 @@ class LruCache(object):
             link = self.Link(behind, head, func, value)
             mapping[func] = behind.next_link = head.prev_link = link
         else:
+            self.hits += 1
             link_prev, link_next, func, value = link
             link_prev.next_link = link_next
             link_next.prev_link = link_prev
@@ -8196,22 +9938,22 @@ class Idx(object):
         self.table = weakref.ref(table)
         self.filename = filename
         self.limit = size_limit
-        with open(filename, 'rb') as idx:
-            self.header = header = self.Header(idx.read(512))
-            # offset = 512
-            @DataBlock(header.key_length+4)
-            class NodeKey(object):
-                key = Bytes(0, header.key_length)
-                rec_no = Int32(header.key_length, big_endian=True)
-            @DataBlock(header.key_length+4)
-            class RecordKey(object):
-                key = Bytes(0, header.key_length)
-                rec_no = Int32(header.key_length, big_endian=True, one_based=True)
-            self.NodeKey = NodeKey
-            self.RecordKey = RecordKey
-            # set up root node
-            idx.seek(header.root_node)
-            self.root_node = self.Node(idx.read(512), self.NodeKey, self.RecordKey)
+        self._file = idx = open(filename, 'rb')
+        self.header = header = self.Header(idx.read(512))
+        # offset = 512
+        @DataBlock(header.key_length+4)
+        class NodeKey(object):
+            key = Bytes(0, header.key_length)
+            rec_no = Int32(header.key_length, big_endian=True)
+        @DataBlock(header.key_length+4)
+        class RecordKey(object):
+            key = Bytes(0, header.key_length)
+            rec_no = Int32(header.key_length, big_endian=True, one_based=True)
+        self.NodeKey = NodeKey
+        self.RecordKey = RecordKey
+        # set up root node
+        idx.seek(header.root_node)
+        self.root_node = self.Node(idx.read(512), self.NodeKey, self.RecordKey)
         # set up node reader
         self.read_node = LruCache(maxsize=size_limit, func=self.read_node)
         # set up iterating members
@@ -8241,13 +9983,109 @@ class Idx(object):
             node = self.read_node(next_node)
     forward = __iter__
 
+    def _key_bytes(self, match):
+        """
+        converts match to the bytes stored in the index
+        """
+        if isinstance(match, unicode):
+            table = self.table()
+            if table is None:
+                raise DbfError('the database linked to %r has been closed' % self.filename)
+            match = table._meta.encoder(match)[0]
+        if not isinstance(match, bytes):
+            raise DbfError('index keys must be bytes or unicode, not %r' % (match, ))
+        return match[:self.header.key_length]
+
+    def _seek(self, match):
+        """
+        returns the leaf node and position of the first key >= match
+        """
+        node = self.root_node
+        while "looking for a leaf":
+            keys = node.keys()
+            # interior keys are the last (highest) key of their child node
+            values = [k.key for k in keys]
+            position = bisect_left(values, match)
+            if node.is_leaf():
+                break
+            if position == len(keys):
+                position -= 1
+            node = self.read_node(keys[position].rec_no)
+        while position == len(keys) and node.right_peer is not None:
+            node = self.read_node(node.right_peer)
+            keys = node.keys()
+            position = 0
+        return node, position
+
+    def _scan(self, match):
+        """
+        yields leaf keys in order, starting with the first key >= match
+        """
+        if not self.root_node.num_keys:
+            return
+        node, position = self._seek(match)
+        while "traversing nodes":
+            keys = node.keys()
+            for key in keys[position:]:
+                yield key
+            if node.right_peer is None:
+                return
+            node = self.read_node(node.right_peer)
+            position = 0
+
+    def close(self):
+        """
+        closes the index file
+        """
+        self._file.close()
+
+    def range(self, lo=None, hi=None):
+        """
+        yields records with lo <= key < hi, in index order;
+        a missing bound is unlimited
+        """
+        table = self.table()
+        if table is None:
+            raise DbfError('the database linked to %r has been closed' % self.filename)
+        if lo is None:
+            lo = b''
+        else:
+            lo = self._key_bytes(lo)
+        if hi is not None:
+            hi = self._key_bytes(hi)
+        for key in self._scan(lo):
+            if hi is not None and key.key >= hi:
+                return
+            yield table[key.rec_no]
+
     def read_node(self, offset):
         """
         reads the sector indicated, and returns a Node object
         """
-        with open(self.filename, 'rb') as idx:
-            idx.seek(offset)
-            return self.Node(idx.read(512), self.NodeKey, self.RecordKey)
+        idx = self._file
+        idx.seek(offset)
+        return self.Node(idx.read(512), self.NodeKey, self.RecordKey)
+
+    def search(self, match, partial=False):
+        """
+        returns dbf.List of records whose key is match, or begins with match
+        if partial is True
+
+        Character keys are padded with spaces to the key length unless partial
+        """
+        table = self.table()
+        if table is None:
+            raise DbfError('the database linked to %r has been closed' % self.filename)
+        match = self._key_bytes(match)
+        if not partial:
+            match = match.ljust(self.header.key_length, b' ')
+        result = List(desc='match = %r' % (match, ))
+        for key in self._scan(match):
+            if not key.key.startswith(match):
+                break
+            record = table[key.rec_no]
+            result._maybe_add(item=(table, key.rec_no, result.key(record)))
+        return result
 
     def backward(self):
         # find the last leaf node
@@ -8387,16 +10225,140 @@ default_codepage = code_pages.get(default_codepage, code_pages.get(0x00))[0]
 # SQL functions
 
 def pql_select(records, chosen_fields, condition, field_names):
+    if _pql_aggregate_items(chosen_fields) is not None:
+        return pql_aggregate(records, chosen_fields, condition, field_names)
     if chosen_fields != '*':
         field_names = chosen_fields.replace(' ', '').split(',')
-    result = condition(records)
+    if condition.projection:
+        return pql_project(records, [f.upper() for f in field_names], condition)
+    if condition.order or condition.limit is not None:
+        result = pql_ordered(records, condition)
+    else:
+        result = condition(records)
     result.modified = 0, 'record' + ('', 's')[len(result)>1]
     result.field_names = field_names
     return result
 
+def pql_project(records, fields, condition):
+    """
+    returns a ResultSet of namedtuples of the fields of the matching records;
+    only those fields are decoded, and the rows do not refer to the table
+    """
+    known = field_names(records)
+    for field in fields:
+        if field not in known:
+            raise FieldMissingError(field)
+    Row = _row_type(fields)
+    if condition.order or condition.limit is not None:
+        matches = pql_ordered(records, condition)
+    elif condition.parallel:
+        project_range = partial(_pql_project_range, condition.where, fields)
+        rows = chain.from_iterable(records.map_ranges(project_range, workers=condition.parallel))
+        return ResultSet((Row._make(r) for r in rows), fields)
+    else:
+        matches = condition(records, stream=True)
+    return ResultSet((Row._make(r.as_tuple(fields)) for r in matches), fields)
+
+def _pql_project_range(where, fields, table, start, stop):
+    """
+    worker for a parallel pql_project: returns the fields of the records from
+    start to stop that match where
+    """
+    records = chain.from_iterable(table.scan_blocks(start=start, stop=stop))
+    if where is not None:
+        records = pql_criteria(table, where, stream=True)(records)
+    return [r.as_tuple(fields) for r in records]
+
+def _pql_sort_value(value):
+    """
+    sort key for a field value that puts blank values first
+    """
+    if value is None or value is Null:
+        return 0, 0
+    return 1, value
+
+def pql_ordered(records, condition):
+    """
+    returns a List of the records matching condition, sorted by condition.order,
+    and stopping at condition.limit; with a limit, only that many records are
+    kept while searching, and an Index of the single order field (if any) is
+    walked instead of searching every record
+    """
+    order, limit = condition.order, condition.limit
+    condition.ordered = True
+    fields = [f for f, _ in order]
+    known = field_names(records)
+    for field in fields:
+        if field not in known:
+            raise FieldMissingError(field)
+    if not order:
+        return List(islice(condition(records, stream=True), limit))
+    if (
+            limit is not None and len(order) == 1
+            and condition.candidates is None and not condition.parallel
+            and isinstance(records, Table)
+        ):
+        for dbfindex in records._indexen:
+            if dbfindex._fields == tuple(fields) and isinstance(dbfindex, Index):
+                return List(islice(_pql_index_walk(records, dbfindex, condition, order[0][1]), limit))
+    def key(record):
+        return tuple([_pql_sort_value(v) for v in record.as_tuple(fields)])
+    matches = condition(records, stream=True)
+    directions = set([descending for _, descending in order])
+    if len(directions) == 1:
+        descending = directions.pop()
+        if limit is None:
+            matches = sorted(matches, key=key, reverse=descending)
+        elif descending:
+            matches = nlargest(limit, matches, key=key)
+        else:
+            matches = nsmallest(limit, matches, key=key)
+    else:
+        matches = list(matches)
+        for field, descending in reversed(order):
+            matches.sort(key=lambda r: _pql_sort_value(r[field]), reverse=descending)
+        matches = matches[:limit]
+    return List(matches)
+
+def _pql_index_walk(records, dbfindex, condition, descending):
+    """
+    yields the records matching condition in dbfindex order; equal keys stay
+    in record order when descending, as they do with sorted(reverse=True)
+    """
+    rec_by_val = dbfindex._rec_by_val
+    if not descending:
+        ordered = (records[r] for r in rec_by_val)
+    else:
+        def ordered():
+            values = dbfindex._values
+            hi = len(values)
+            while hi > 0:
+                lo = bisect_left(values, values[hi-1], 0, hi)
+                for i in range(lo, hi):
+                    yield records[rec_by_val[i]]
+                hi = lo
+        ordered = ordered()
+    if condition.where is None:
+        return ordered
+    return pql_criteria(records, condition.where, stream=True)(ordered)
+
+def _pql_order_rows(rows, order, limit):
+    """
+    sorts the rows of a ResultSet by the named columns, keeping limit rows
+    """
+    names = [n.upper() for n in rows.field_names]
+    for field, descending in reversed(order):
+        if field not in names:
+            raise DbfError('ORDER BY %s: no such column in %r' % (field, rows.field_names))
+        column = names.index(field)
+        rows.sort(key=lambda r: _pql_sort_value(r[column]), reverse=descending)
+    if limit is not None:
+        del rows[limit:]
+    return rows
+
 def pql_update(records, command, condition, field_names):
     possible = condition(records)
-    modified = pql_cmd(command, field_names)(possible)
+    modified = pql_cmd(command, field_names, records)(possible)
     possible.modified = modified, 'record' + ('', 's')[modified>1]
     return possible
 
@@ -8472,11 +10434,295 @@ def pql_resize(records, fieldname_newsize, condition, field_names):
     possible.field_names = field_names
     return possible
 
-def pql_criteria(records, criteria):
+def _pql_unquoted(text):
+    """
+    returns text uppercased, with the contents of its quoted strings blanked
+    out, so clause keywords are only found outside literals (at the same
+    offsets as in text)
+    """
+    chars = []
+    quote = None
+    escaped = False
+    for ch in text:
+        if quote is None:
+            if ch in u'\'"':
+                quote = ch
+            upper = ch.upper()
+            chars.append(upper if len(upper) == 1 else ch)
+            continue
+        if escaped:
+            escaped = False
+        elif ch == u'\\':
+            escaped = True
+        elif ch == quote:
+            quote = None
+            chars.append(ch)
+            continue
+        chars.append(u'_')
+    return u''.join(chars)
+
+def _pql_aggregate_items(chosen_fields):
+    """
+    returns (items, group_by) if chosen_fields asks for aggregates, else None;
+    items is a list of (function, field) with function None for a group field
+    and field None for count(*) -- the other functions require a field
+    """
+    group_by = []
+    uc_chosen = u' ' + _pql_unquoted(chosen_fields)
+    if u' GROUP BY ' in uc_chosen:
+        index = uc_chosen.rfind(u' GROUP BY ')
+        group_by = [f.strip().upper() for f in chosen_fields[index+9:].split(',')]
+        chosen_fields = chosen_fields[:max(index-1, 0)]
+    items = []
+    for item in chosen_fields.split(','):
+        item = item.strip()
+        function = None
+        if item.endswith(')') and '(' in item:
+            function, field = item[:-1].split('(', 1)
+            function, field = function.strip().lower(), field.strip()
+            if function not in ('count', 'sum', 'min', 'max', 'avg'):
+                function = None
+        if function is not None:
+            if field == '*' and function != 'count':
+                raise DbfError('%s requires a field' % function.upper())
+            items.append((function, None if field == '*' else field.upper()))
+        elif item:
+            items.append((None, item.upper()))
+    if not group_by and not [f for f, _ in items if f is not None]:
+        return None
+    return items, group_by
+
+def pql_aggregate(records, chosen_fields, condition, field_names):
     """
-    creates a function matching the pql criteria
+    computes count, sum, min, max, and avg of the selected records, per
+    group if GROUP BY is given, in one pass without keeping the records
     """
-    function = """def func(records):
+    items, group_by = _pql_aggregate_items(chosen_fields)
+    for field in group_by:
+        if field not in field_names:
+            raise FieldMissingError(field)
+    for function, field in items:
+        if field is not None and field not in field_names:
+            raise FieldMissingError(field)
+        if function is None and field not in group_by:
+            raise DbfError('SQL SELECT: %s is neither aggregated nor in GROUP BY' % field)
+    needed = list(group_by)
+    for _, field in items:
+        if field is not None and field not in needed:
+            needed.append(field)
+    group_size = len(group_by)
+    # (function, position of field in needed) of each aggregate
+    aggregates = [(f, None if n is None else needed.index(n)) for f, n in items if f is not None]
+    groups = OrderedDict()
+    if not group_by:
+        groups[()] = [0 if f == 'count' else None for f, _ in aggregates]
+    parallel = condition.parallel
+    if parallel:
+        aggregate_range = partial(
+                _pql_aggregate_range, condition.where, needed, group_size, aggregates,
+                )
+        for more_groups in records.map_ranges(aggregate_range, workers=parallel):
+            _pql_merge(groups, more_groups, aggregates)
+    else:
+        _pql_accumulate(groups, condition(records, stream=True), needed, group_size, aggregates)
+    result = ResultSet(field_names=[
+            field if function is None else '%s(%s)' % (function, field or '*')
+            for function, field in items
+            ])
+    for key, state in groups.items():
+        group = dict(zip(group_by, key))
+        totals = iter(state)
+        row = []
+        for function, field in items:
+            if function is None:
+                row.append(group[field])
+                continue
+            value = next(totals)
+            if function == 'avg' and value is not None:
+                total, count = value
+                if not isinstance(total, (float, Decimal)):
+                    total = float(total)
+                value = total / count
+            row.append(value)
+        result.append(tuple(row))
+    result.modified = 0, 'record' + ('', 's')[len(result)>1]
+    return result
+
+def _pql_accumulate(groups, records, needed, group_size, aggregates):
+    """
+    adds records to the per-group states of the aggregates
+    """
+    for record in records:
+        values = record.as_tuple(needed)
+        key = values[:group_size]
+        state = groups.get(key)
+        if state is None:
+            state = groups[key] = [0 if f == 'count' else None for f, _ in aggregates]
+        for i, (function, position) in enumerate(aggregates):
+            if position is None:
+                state[i] += 1
+                continue
+            value = values[position]
+            if value is None or value is Null:
+                continue
+            current = state[i]
+            if function == 'count':
+                state[i] = current + 1
+            elif function == 'sum':
+                state[i] = value if current is None else current + value
+            elif function == 'min':
+                if current is None or value < current:
+                    state[i] = value
+            elif function == 'max':
+                if current is None or value > current:
+                    state[i] = value
+            elif current is None:   # avg
+                state[i] = [value, 1]
+            else:
+                current[0] += value
+                current[1] += 1
+
+def _pql_merge(groups, more_groups, aggregates):
+    """
+    adds the accumulated states of more_groups into groups
+    """
+    for key, more in more_groups.items():
+        state = groups.get(key)
+        if state is None:
+            groups[key] = more
+            continue
+        for i, (function, _) in enumerate(aggregates):
+            current, value = state[i], more[i]
+            if value is None:
+                continue
+            elif current is None:
+                state[i] = value
+            elif function in ('count', 'sum'):
+                state[i] = current + value
+            elif function == 'min':
+                state[i] = min(current, value)
+            elif function == 'max':
+                state[i] = max(current, value)
+            else:   # avg
+                state[i] = [current[0] + value[0], current[1] + value[1]]
+
+def _pql_aggregate_range(where, needed, group_size, aggregates, table, start, stop):
+    """
+    worker for a parallel pql_aggregate: accumulates the matching records
+    from start to stop
+    """
+    records = chain.from_iterable(table.scan_blocks(start=start, stop=stop))
+    if where is not None:
+        records = pql_criteria(table, where, stream=True)(records)
+    groups = OrderedDict()
+    _pql_accumulate(groups, records, needed, group_size, aggregates)
+    return groups
+
+def _pql_match_range(where, table, start, stop):
+    """
+    worker for a parallel pql search: returns the numbers of the records
+    from start to stop that match where
+    """
+    records = chain.from_iterable(table.scan_blocks(start=start, stop=stop))
+    return array('l', [recno(r) for r in pql_criteria(table, where, stream=True)(records)])
+
+def _pql_aggregate_command(function):
+    """
+    returns the pql function for `FUNCTION [field[, field...]] [WHERE ...] [GROUP BY ...]`
+    """
+    def pql_function(records, command, condition, field_names):
+        group_by = []
+        uc_command = u' ' + _pql_unquoted(command)
+        if u' GROUP BY ' in uc_command:
+            index = uc_command.rfind(u' GROUP BY ')
+            group_by = [f.strip() for f in command[index+9:].split(',')]
+            command = command[:max(index-1, 0)]
+        fields = [f.strip() for f in command.split(',') if f.strip()] or ['*']
+        chosen = group_by + ['%s(%s)' % (function, f) for f in fields]
+        if group_by:
+            chosen[-1] += ' group by ' + ', '.join(group_by)
+        return pql_aggregate(records, ', '.join(chosen), condition, field_names)
+    pql_function.__name__ = str('pql_' + function)
+    return pql_function
+
+pql_count = _pql_aggregate_command('count')
+pql_sum = _pql_aggregate_command('sum')
+pql_min = _pql_aggregate_command('min')
+pql_max = _pql_aggregate_command('max')
+pql_avg = _pql_aggregate_command('avg')
+
+def _pql_compile(kind, text, fields, user_functions):
+    """
+    compiles text of kind ('criteria', 'filter', 'cmd', or 'plan') for fields
+    (user_functions is only part of the cache key)
+    """
+    if kind == 'criteria':
+        return _pql_compile_criteria(text, fields)
+    elif kind == 'filter':
+        return _pql_compile_criteria(text, fields, stream=True)
+    elif kind == 'cmd':
+        return _pql_compile_cmd(text, fields)
+    elif kind == 'plan':
+        return _pql_predicates(text, fields)
+    raise ValueError('unknown pql kind: %r' % (kind, ))
+
+_pql_cache = LruCache(maxsize=max(pql_cache_size, 1), func=_pql_compile)
+
+def _pql_compiled(kind, text, fields, records=None):
+    """
+    returns the cached compilation of text for fields; a compilation is
+    counted in the stats of records, if it is a table
+    """
+    fields = tuple(fields)
+    if pql_cache_size <= 0:
+        misses = None
+        start = time.time()
+        result = _pql_compile(kind, text, fields, None)
+    else:
+        misses = _pql_cache.misses
+        start = time.time()
+        # keyed on the functions themselves, which keeps them alive while cached;
+        # the id of a freed function can be reused by its replacement
+        user_functions = tuple(sorted(pql_user_functions.items(), key=lambda item: item[0]))
+        result = _pql_cache(kind, text, fields, user_functions)
+    if isinstance(records, Table) and misses != _pql_cache.misses:
+        _count(records._meta, 'pql_compiles')
+        _count(records._meta, 'pql_compile_time', time.time() - start)
+    return result
+
+def pql_cache_info():
+    """
+    returns (hits, misses, current size, maximum size) of the compiled pql cache
+    """
+    return _pql_cache.hits, _pql_cache.misses, len(_pql_cache), _pql_cache.maxsize
+
+def pql_cache_clear():
+    """
+    empties the compiled pql cache, resets its counters, and applies pql_cache_size
+    """
+    _pql_cache.clear()
+    _pql_cache.maxsize = max(pql_cache_size, 1)
+
+def pql_criteria(records, criteria, stream=False):
+    """
+    creates a function matching the pql criteria; if stream, the function
+    yields the matching records instead of returning them in a List
+    """
+    kind = ('criteria', 'filter')[stream]
+    return _pql_compiled(kind, ensure_unicode(criteria).strip(), field_names(records), records)
+
+def _pql_compile_criteria(criteria, field_names, stream=False):
+    if stream:
+        function = """def func(records):
+    '''%s
+    '''
+    for _rec in records:
+        %s
+
+        if %s:
+            yield _rec"""
+    else:
+        function = """def func(records):
     '''%s
     '''
     _matched = dbf.List()
@@ -8487,9 +10733,8 @@ def pql_criteria(records, criteria):
             _matched.append(_rec)
     return _matched"""
     fields = []
-    criteria = ensure_unicode(criteria)
     uc_criteria = criteria.upper()
-    for field in field_names(records):
+    for field in field_names:
         if field in uc_criteria:
             fields.append(field)
     criteria = criteria.replace('recno()', 'recno(_rec)').replace('is_deleted()', 'is_deleted(_rec)')
@@ -8501,10 +10746,131 @@ def pql_criteria(records, criteria):
     execute(function, g)
     return g['func']
 
-def pql_cmd(command, field_names):
+def pql_plan(records, criteria):
+    """
+    returns the records that may match criteria, found with a field Index of
+    records, or None if records must be scanned
+
+    the conditions recognized are comparisons of a field with a constant
+    (==, <, <=, >, >=) and field.startswith(constant) joined with `and`;
+    the criteria still needs to be applied to the returned records
+    """
+    if not isinstance(records, Table):
+        return None
+    indices = {}
+    hashed = {}
+    for dbfindex in records._indexen:
+        if dbfindex._fields is not None and len(dbfindex._fields) == 1:
+            if isinstance(dbfindex, HashIndex):
+                hashed.setdefault(dbfindex._fields[0], dbfindex)
+            else:
+                indices.setdefault(dbfindex._fields[0], dbfindex)
+    if not indices and not hashed:
+        return None
+    predicates = _pql_compiled(
+            'plan', ensure_unicode(criteria).strip(), sorted(set(indices) | set(hashed)), records,
+            )
+    # an equality test on a field with a HashIndex is answered directly
+    for field in sorted(predicates):
+        if field in hashed:
+            for symbol, constant in predicates[field]:
+                if symbol == '==':
+                    try:
+                        rec_nums = hashed[field]._rec_nums((constant, ))
+                    except TypeError:
+                        # unhashable constant
+                        continue
+                    return [records[r] for r in rec_nums]
+    predicates = dict((f, p) for f, p in predicates.items() if f in indices)
+    if not predicates:
+        return None
+    # prefer an equality test, then a range, then a prefix
+    def rank(field):
+        symbols = [p[0] for p in predicates[field]]
+        return ('==' not in symbols, 'startswith' in symbols and len(symbols) == 1)
+    field = sorted(predicates, key=rank)[0]
+    dbfindex = indices[field]
+    try:
+        lo, hi = 0, len(dbfindex._values)
+        for symbol, constant in predicates[field]:
+            if symbol == '==':
+                lo = max(lo, dbfindex._search((constant, ), where='left'))
+                hi = min(hi, dbfindex._search((constant, ), where='right'))
+            elif symbol == '>':
+                lo = max(lo, dbfindex._search((constant, ), where='right'))
+            elif symbol == '>=':
+                lo = max(lo, dbfindex._search((constant, ), where='left'))
+            elif symbol == '<':
+                hi = min(hi, dbfindex._search((constant, ), where='left'))
+            elif symbol == '<=':
+                hi = min(hi, dbfindex._search((constant, ), where='right'))
+            else:   # startswith
+                start, stop = dbfindex._prefix_bounds(constant)
+                lo, hi = max(lo, start), min(hi, stop)
+    except (TypeError, AttributeError):
+        # constant not comparable with the indexed values
+        return None
+    rec_nums = sorted(dbfindex._rec_by_val[lo:hi])
+    return [records[r] for r in rec_nums]
+
+def _pql_predicates(criteria, indexed):
+    """
+    returns {field: [(operator, constant), ...]} for the conditions of
+    criteria on the indexed fields that an Index can answer
+    """
+    try:
+        tree = ast.parse(criteria, mode='eval').body
+    except SyntaxError:
+        return {}
+    if isinstance(tree, ast.BoolOp) and isinstance(tree.op, ast.And):
+        conditions = tree.values
+    else:
+        conditions = [tree]
+    predicates = defaultdict(list)
+    flip = {'==': '==', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+    symbols = {ast.Eq: '==', ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>='}
+    for condition in conditions:
+        if isinstance(condition, ast.Compare):
+            left = condition.left
+            for op, right in zip(condition.ops, condition.comparators):
+                symbol = symbols.get(type(op))
+                if symbol is not None:
+                    if isinstance(left, ast.Name) and left.id.upper() in indexed:
+                        field, constant = left.id.upper(), right
+                    elif isinstance(right, ast.Name) and right.id.upper() in indexed:
+                        field, constant, symbol = right.id.upper(), left, flip[symbol]
+                    else:
+                        field = None
+                    if field is not None:
+                        try:
+                            predicates[field].append((symbol, ast.literal_eval(constant)))
+                        except ValueError:
+                            pass
+                left = right
+        elif (
+                isinstance(condition, ast.Call)
+                and isinstance(condition.func, ast.Attribute)
+                and condition.func.attr == 'startswith'
+                and isinstance(condition.func.value, ast.Name)
+                and condition.func.value.id.upper() in indexed
+                and len(condition.args) == 1
+            ):
+            try:
+                prefix = ast.literal_eval(condition.args[0])
+            except ValueError:
+                continue
+            if isinstance(prefix, basestring):
+                predicates[condition.func.value.id.upper()].append(('startswith', prefix))
+    return dict(predicates)
+
+def pql_cmd(command, field_names, records=None):
     """
     creates a function matching to apply command to each record in records
+    (a compilation is counted in the stats of records, if it is a table)
     """
+    return _pql_compiled('cmd', command.strip(), field_names, records)
+
+def _pql_compile_cmd(command, field_names):
     function = """def func(records):
     '''%s
     '''
@@ -8539,39 +10905,123 @@ def pql_cmd(command, field_names):
     execute(function, g)
     return g['func']
 
-def pql(records, command):
+class _PqlQuery(object):
+    """
+    the clauses of a pql command that choose its records; calling it returns
+    the records matching where, in a List or (if stream) an iterator
     """
-    recognized pql commands are SELECT, UPDATE | REPLACE, DELETE, RECALL, ADD, DROP
+
+    def __init__(self, where, candidates, order, limit, projection, parallel):
+        self.where = where
+        self.candidates = candidates    # records found with an index, or None
+        self.order = order              # [(field, descending), ...]
+        self.limit = limit
+        self.projection = projection
+        self.parallel = parallel        # number of processes searching, or None
+        self.ordered = False            # set once pql_ordered has applied order and limit
+
+    def __call__(self, records, stream=False):
+        if self.where is None:
+            if not stream:
+                return records[:]
+            elif isinstance(records, Table):
+                return chain.from_iterable(records.scan_blocks())
+            return iter(records)
+        if self.parallel:
+            match_range = partial(_pql_match_range, self.where)
+            rec_nums = chain.from_iterable(records.map_ranges(match_range, workers=self.parallel))
+            matches = (records[r] for r in rec_nums)
+            if stream:
+                return matches
+            return List(matches)
+        matches = pql_criteria(records, self.where, stream)
+        if self.candidates is not None:
+            records = self.candidates
+        return matches(records)
+
+def pql(records, command, parallel=None, projection=False):
+    """
+    recognized pql commands are SELECT, UPDATE | REPLACE, DELETE, RECALL, ADD, DROP,
+    and the aggregates COUNT, SUM, MIN, MAX, AVG (SELECT and the aggregates
+    also accept GROUP BY, and ORDER BY field [DESC][, ...] and LIMIT n)
+
+    if parallel is greater than one and records is a table on disk, that many
+    processes search and aggregate it; changes are still made in this process
+
+    if projection, SELECT returns a ResultSet of namedtuples of the chosen
+    fields instead of a List of records
     """
     close_table = False
     if isinstance(records, basestring):
         records = Table(records)
         close_table = True
     try:
-        if not records:
+        if not records and not isinstance(records, (Table, Index)):
             return List()
         command = ensure_unicode(command)
         pql_command = command
-        uc_command = command.upper()
+        uc_command = _pql_unquoted(command)
+        limit = None
+        if u' LIMIT ' in uc_command:
+            index = uc_command.rfind(u' LIMIT ')
+            try:
+                limit = int(command[index+7:])
+            except ValueError:
+                raise DbfError('LIMIT must be an integer in %r' % (pql_command, ))
+            if limit < 0:
+                raise DbfError('LIMIT must not be negative in %r' % (pql_command, ))
+            command = command[:index]
+            uc_command = uc_command[:index]
+        order = []
+        if u' ORDER BY ' in uc_command:
+            index = uc_command.rfind(u' ORDER BY ')
+            for item in command[index+10:].split(','):
+                item = item.strip().upper().split()
+                if len(item) == 2 and item[1] in (u'ASC', u'DESC'):
+                    order.append((item[0], item[1] == u'DESC'))
+                elif len(item) == 1:
+                    order.append((item[0], False))
+                else:
+                    raise DbfError('invalid ORDER BY in %r' % (pql_command, ))
+            command = command[:index]
+            uc_command = uc_command[:index]
+        group_by = None
+        if u' GROUP BY ' in uc_command:
+            index = uc_command.rfind(u' GROUP BY ')
+            group_by = command[index+10:]
+            command = command[:index]
+            uc_command = uc_command[:index]
+        where = candidates = None
         if u' WHERE ' in uc_command:
             index = uc_command.find(u' WHERE ')
-            condition = command[index+7:]
+            where = command[index+7:]
             command = command[:index]
-            # command, condition = command.split(' where ', 1)
-            condition = pql_criteria(records, condition)
+            candidates = pql_plan(records, where)
+        if (
+                parallel is not None and parallel > 1 and candidates is None
+                and isinstance(records, Table) and records._meta.location == ON_DISK
+            ):
+            workers = parallel
         else:
-            def condition(records):
-                return records[:]
-        name, command = command.split(' ', 1)
+            workers = None
+        condition = _PqlQuery(where, candidates, order, limit, projection, workers)
+        name, command = (command + ' ').split(' ', 1)
         command = command.strip()
         name = name.upper()
+        if group_by is not None:
+            if name not in (u'SELECT', u'COUNT', u'SUM', u'MIN', u'MAX', u'AVG'):
+                raise DbfError('GROUP BY not supported by %s in %r' % (name, pql_command))
+            command = command + u' GROUP BY ' + group_by
+        if (order or limit is not None) and name not in (u'SELECT', u'COUNT', u'SUM', u'MIN', u'MAX', u'AVG'):
+            raise DbfError('ORDER BY and LIMIT not supported by %s in %r' % (name, pql_command))
+        if projection and name not in (u'SELECT', u'COUNT', u'SUM', u'MIN', u'MAX', u'AVG'):
+            raise DbfError('projection not supported by %s in %r' % (name, pql_command))
         fields = field_names(records)
         if pql_functions.get(name) is None:
             raise DbfError('unknown SQL command %r in %r' % (name.upper(), pql_command))
         result = pql_functions[name](records, command, condition, fields)
-        tables = set()
-        for record in result:
-            tables.add(source_table(record))
+        if isinstance(result, ResultSet) and (order or limit is not None) and not condition.ordered:
+            result = _pql_order_rows(result, order, limit)
     finally:
         if close_table:
             records.close()
@@ -8586,7 +11036,11 @@ pql_functions = {
         u'RECALL' : pql_recall,
         u'ADD'    : pql_add,
         u'DROP'   : pql_drop,
-        u'COUNT'  : None,
+        u'COUNT'  : pql_count,
+        u'SUM'    : pql_sum,
+        u'MIN'    : pql_min,
+        u'MAX'    : pql_max,
+        u'AVG'    : pql_avg,
         u'PACK'   : pql_pack,
         u'RESIZE' : pql_resize,
         }
@@ -8731,14 +11185,29 @@ def ensure_unicode(value):
         value = value.decode(input_decoding)
     return value
 
-def export(table_or_records, filename=None, field_names=None, format='csv', header=True, dialect='dbf', encoding=None):
+def export(table_or_records, filename=None, field_names=None, format='csv', header=True, dialect='dbf', encoding=None, processes=None):
     """
     writes the records using CSV or tab-delimited format, using the filename
     given if specified, otherwise the table name
     if table_or_records is a collection of records (not an actual table) they
-    should all be of the same format
+    should all be of the same format; any iterable of records may be used
+
+    if processes is greater than one and table_or_records is an on-disk table,
+    record ranges are encoded by that many worker processes and joined in order
+
+    returns the number of records written
     """
-    table = source_table(table_or_records[0])
+    if isinstance(table_or_records, Table):
+        table = table_or_records
+        records = table_or_records
+    else:
+        records = iter(table_or_records)
+        try:
+            first = next(records)
+        except StopIteration:
+            raise DbfError("no records to export")
+        table = source_table(first)
+        records = chain([first], records)
     if filename is None:
         filename = table.filename
     if field_names is None:
@@ -8756,68 +11225,150 @@ def export(table_or_records, filename=None, field_names=None, format='csv', head
     base, ext = os.path.splitext(filename)
     if ext.lower() in ('', '.dbf'):
         filename = base + "." + format
-    with codecs.open(filename, 'w', encoding=encoding) as fd:
-        if format == 'csv':
-            if header is True:
-                fd.write(','.join(header_names))
-                fd.write('\n')
-            elif header:
-                fd.write(','.join(header))
-                fd.write('\n')
-            for record in table_or_records:
-                fields = []
-                for fieldname in field_names:
-                    data = record[fieldname]
-                    if isinstance(data, basestring) and data:
-                        data = '"%s"' % data.replace('"','""')
-                    elif data is None:
-                        data = ''
-                    fields.append(unicode(data))
-                fd.write(','.join(fields))
-                fd.write('\n')
-        elif format == 'tab':
-            if header is True:
-                fd.write('\t'.join(header_names) + '\n')
-            elif header:
-                fd.write(','.join(header))
-            for record in table_or_records:
-                fields = []
-                for fieldname in field_names:
-                    data = record[fieldname]
-                    fields.append(unicode(data))
-                fd.write('\t'.join(fields) + '\n')
-        else: # format == 'fixed'
+    sizes = None
+    if format == 'txt':
+        if header is True:
+            header = False  # don't need it
+        elif header:
+            # names to use as field names
+            header = list(header)   # in case header is an iterator
+        sizes = []
+        for field in field_names:
+            info = table.field_info(field)
+            if info.field_type == ord('D'):
+                size = 10
+            elif info.field_type in (ord('T'), ord('@')):
+                size = 19
+            else:
+                size = info.length
+            sizes.append(size)
+    parallel = (
+            processes is not None and processes > 1
+            and records is table and table._meta.location == ON_DISK
+            )
+    # large buffer, as exports can run to many gigabytes
+    with io.open(filename, 'wb', buffering=1024 * 1024) as sink:
+        writer = _ExportWriter(sink, format, encoding, sizes)
+        if format == 'csv' and header:
             if header is True:
-                header = False  # don't need it
-            elif header:
-                # names to use as field names
-                header = list(header)   # in case header is an iterator
-            with codecs.open("%s_layout.txt" % os.path.splitext(filename)[0], 'w', encoding=encoding) as layout:
-                layout.write("%-15s  Size  Comment\n" % "Field Name")
-                layout.write("%-15s  ----  -------------------------\n" % ("-" * 15))
-                sizes = []
-                for i, field in enumerate(field_names):
-                    info = table.field_info(field)
-                    if info.field_type == ord('D'):
-                        size = 10
-                    elif info.field_type in (ord('T'), ord('@')):
-                        size = 19
-                    else:
-                        size = info.length
-                    sizes.append(size)
-                    comment = ''
-                    if header and i < len(header):
-                        # use overridden field name as comment
-                        comment = header[i]
-                    layout.write("%-15s  %4d  %s\n" % (field, size, comment))
-                layout.write('\nTotal Records in file: %d\n' % len(table_or_records))
-            for record in table_or_records:
-                fields = []
-                for i, fieldname in enumerate(field_names):
-                    data = record[fieldname]
-                    fields.append("%-*s" % (sizes[i], data))
-                fd.write(''.join(fields) + '\n')
-    return len(table_or_records)
+                header = header_names
+            writer.write_line(','.join(header) + '\n')
+        elif format == 'tab' and header is True:
+            writer.write_line('\t'.join(header_names) + '\n')
+        elif format == 'tab' and header:
+            # as export() always has, a given tab header is comma separated
+            # and shares its line with the first record
+            writer.write_line(','.join(header))
+        if parallel:
+            count = _export_parallel(table, sink, filename, field_names, format, encoding, sizes, processes)
+        else:
+            if records is table and table._meta.location == ON_DISK:
+                records = chain.from_iterable(table.scan_blocks())
+            count = 0
+            for record in records:
+                writer.write_row(record.as_tuple(field_names))
+                count += 1
+    if format == 'txt':
+        with codecs.open("%s_layout.txt" % os.path.splitext(filename)[0], 'w', encoding=encoding) as layout:
+            layout.write("%-15s  Size  Comment\n" % "Field Name")
+            layout.write("%-15s  ----  -------------------------\n" % ("-" * 15))
+            for i, field in enumerate(field_names):
+                comment = ''
+                if header and i < len(header):
+                    # use overridden field name as comment
+                    comment = header[i]
+                layout.write("%-15s  %4d  %s\n" % (field, sizes[i], comment))
+            layout.write('\nTotal Records in file: %d\n' % count)
+    return count
+
+def _export_parallel(table, sink, filename, field_names, format, encoding, sizes, processes):
+    """
+    has worker processes encode ranges of table into part files, which are
+    appended to sink in record order; the part files are kept in a
+    directory of their own next to filename, which is removed afterwards
+    """
+    parts = tempfile.mkdtemp(prefix='.export_', dir=os.path.dirname(os.path.abspath(filename)))
+    export_range = partial(
+            _export_range, list(field_names), format, encoding, sizes, parts,
+            )
+    count = 0
+    try:
+        for part, written in table.map_ranges(export_range, workers=processes):
+            with open(part, 'rb') as fh:
+                while True:
+                    data = fh.read(1024 * 1024)
+                    if not data:
+                        break
+                    sink.write(data)
+            os.remove(part)
+            count += written
+    finally:
+        shutil.rmtree(parts, True)
+    return count
+
+def _export_range(field_names, format, encoding, sizes, parts, table, start, stop):
+    """
+    worker for _export_parallel: writes records start through stop-1 to a
+    part file in the parts directory
+    """
+    part = os.path.join(parts, 'part%d' % start)
+    count = 0
+    with io.open(part, 'wb', buffering=1024 * 1024) as sink:
+        writer = _ExportWriter(sink, format, encoding, sizes)
+        for records in table.scan_blocks(start=start, stop=stop):
+            for record in records:
+                writer.write_row(record.as_tuple(field_names))
+                count += 1
+    return part, count
+
+def _map_range(job):
+    """
+    worker for Table.map_ranges: reopens the table read-only and applies
+    func to the range
+    """
+    (filename, dbf_type, codepage, default_data_types, field_data_types, mmap), func, start, stop = job
+    table = Table(
+            filename, dbf_type=dbf_type, codepage=codepage,
+            default_data_types=default_data_types, field_data_types=field_data_types,
+            mmap=mmap,
+            )
+    table.open(READ_ONLY)
+    try:
+        return func(table, start, stop)
+    finally:
+        table.close()
+
+class _ExportWriter(object):
+    """
+    writes rows of values to a binary file as csv, tab-delimited, or fixed
+    width text, quoted and encoded as export() has always written them
+    """
+
+    def __init__(self, sink, format, encoding, sizes=None):
+        self.sink = sink
+        self.format = format
+        self.encoding = encoding
+        self.sizes = sizes
+
+    def write_line(self, line):
+        self.sink.write(unicode(line).encode(self.encoding))
+
+    def write_row(self, values):
+        if self.format == 'csv':
+            # only non-empty strings are quoted, and None is left empty
+            fields = []
+            for value in values:
+                if isinstance(value, basestring) and value:
+                    value = '"%s"' % value.replace('"', '""')
+                elif value is None:
+                    value = ''
+                fields.append(unicode(value))
+            line = ','.join(fields)
+        elif self.format == 'tab':
+            line = '\t'.join([unicode(value) for value in values])
+        else:
+            line = ''.join(["%-*s" % (size, value) for size, value in zip(self.sizes, values)])
+        self.write_line(line + '\n')
 
 def field_names(thing):
     """
@@ -8864,7 +11415,7 @@ def reset(record, keep_fields=None):
     keep = {}
     for field in keep_fields:
         keep[field] = record[field]
-    record._data[:] = record._meta.blankrecord[:]
+    record._data = record._meta.blankrecord[:]
     for field in keep_fields:
         record[field] = keep[field]
     if not template:
@@ -9197,7 +11748,7 @@ def scatter(record, as_type=create_template, _mappings=getattr(collections_abc,
     returns as_type() of [fieldnames and] values.
     """
     if isinstance(as_type, type) and issubclass(as_type, _mappings):
-        return as_type(zip(field_names(record), record))
+        return as_type(zip(field_names(record), record.as_tuple()))
     else:
         return as_type(record)
 
@@ -9217,9 +11768,9 @@ class fake_module(object):
         sys.modules["%s.%s" % (__name__, self.name)] = self
 
 api = fake_module('api',
-    'Table', 'Record', 'List', 'Index', 'Relation', 'Iter', 'Null', 'Char', 'Date', 'DateTime', 'Time',
+    'Table', 'Record', 'List', 'Index', 'PrefixIndex', 'HashIndex', 'Relation', 'Iter', 'Null', 'Char', 'Date', 'DateTime', 'Time',
     'Logical', 'Quantum', 'CodePage', 'create_template', 'delete', 'field_names', 'gather', 'is_deleted',
-    'recno', 'source_table', 'reset', 'scatter', 'undelete',
+    'recno', 'source_table', 'reset', 'scatter', 'undelete', 'ResultSet',
     'NullDate', 'NullDateTime', 'NullTime', 'NoneType', 'NullType', 'Decimal', 'Vapor', 'Period',
     'Truth', 'Falsth', 'Unknown', 'On', 'Off', 'Other',
     'DbfError', 'DataOverflowError', 'BadDataError', 'FieldMissingError',
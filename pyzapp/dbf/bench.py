@@ -0,0 +1,190 @@
+"""
+times common dbf operations on synthetic tables and prints the results as
+JSON, so the performance of changes can be compared run to run
+
+    python -m dbf.bench run --records 50000 --types db3,vfp
+"""
+from __future__ import print_function
+
+import datetime
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from decimal import Decimal
+from scription import *
+from . import DbfError, FieldType, Process, READ_WRITE, Table, delete, export, pql_cache_clear, pql_plan, version
+
+timer = getattr(time, 'perf_counter', time.time)
+
+## default field mix of each table type; every mix has a memo field, and the
+## vfp mix has nullable fields
+field_mixes = {
+        'db3': 'name C(25); city C(20); qty N(8,0); price N(12,2); born D; active L; notes M',
+        'fp': 'name C(25); city C(20); qty N(8,0); price N(12,2); ratio F(12,4); born D; active L; notes M',
+        'vfp': 'name C(25); city C(20) null; qty I; price B; born D null; stamp T; active L; notes M',
+        }
+
+_letters = 'abcdefghijklmnopqrstuvwxyz'
+
+
+@Command(
+        records=Spec('number of records in each table', OPTION, type=int, force_default=10000),
+        types=Spec('table types to benchmark', MULTI, choices=sorted(field_mixes), force_default=('db3', 'fp', 'vfp')),
+        fields=Spec('field specs to use instead of the default mix of each type', OPTION),
+        seed=Spec('seed for the random data', OPTION, type=int, force_default=1),
+        output=Spec('file to write the JSON results to [default: stdout]', OPTION),
+        keep=Spec('keep the generated tables (their directory is in the results)', FLAG),
+        )
+def run(records, types, fields, seed, output, keep):
+    "times open, scans, random access, appends, updates, indexing, queries, export, and pack"
+    directory = tempfile.mkdtemp(prefix='dbf_bench_')
+    results = {}
+    try:
+        for table_type in types:
+            results[table_type] = bench_table(
+                    os.path.join(directory, 'bench_' + table_type),
+                    table_type, fields or field_mixes[table_type], records, seed,
+                    )
+    finally:
+        if not keep:
+            shutil.rmtree(directory)
+    report = {
+            'dbf_version': '.'.join(str(v) for v in version),
+            'python': sys.version.split()[0],
+            'records': records,
+            'seed': seed,
+            'directory': keep and directory or None,
+            'results': results,
+            }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as target:
+            target.write(text + '\n')
+    else:
+        echo(text)
+
+
+def bench_table(filename, table_type, specs, count, seed):
+    """
+    creates a table of count records of random data and times each operation
+    on it; returns a dict of operation:seconds, plus the table's stats()
+    """
+    rng = random.Random(seed)
+    timings = {}
+    table = Table(filename, specs, dbf_type=table_type)
+    table.open(READ_WRITE)
+    names = table.field_names
+    makers = [_value_maker(table, name) for name in names]
+    rows = [tuple(make(rng) for make in makers) for _ in range(count)]
+    timings['extend'] = _time(table.extend, rows)
+    singles = rows[:min(count, 1000)]
+    start = timer()
+    for row in singles:
+        table.append(row)
+    timings['append'] = timer() - start
+    table.close()
+    timings['open'] = _time(table.open, READ_WRITE)
+    start = timer()
+    for record in table:
+        tuple(record)
+    timings['scan'] = timer() - start
+    length = len(table)
+    picks = [rng.randrange(length) for _ in range(min(length, 10000))]
+    start = timer()
+    for rec_num in picks:
+        table[rec_num][0]
+    timings['random_access'] = timer() - start
+    number = _first_field(table, (FieldType.NUMERIC, FieldType.INTEGER, FieldType.FLOAT, FieldType.DOUBLE))
+    text = _first_field(table, (FieldType.CHAR, ))
+    if number is not None:
+        start = timer()
+        for record in Process(table):
+            record[number] = 1
+        timings['process_update'] = timer() - start
+    # the table only keeps weak references to its indexes, so this one is
+    # held here for the queries (and the pack) that follow
+    index = None
+    if text is not None:
+        start = timer()
+        index = table.create_index(text, kind='prefix')
+        timings['index'] = timer() - start
+        prefix = table[length // 2][text][:2]
+        where = '%s.startswith(%r)' % (text, str(prefix))
+        timings['pql_index'] = _time_query(table, 'select where ' + where)
+        if pql_plan(table, where) is None:
+            raise DbfError('the query planner did not use the index of %s' % text)
+    if number is not None:
+        timings['pql_scan'] = _time_query(table, 'select where %s > 0' % number)
+        timings['pql_count'] = _time_query(table, 'count %s where %s > 0' % (number, number))
+    timings['export'] = _time(export, table, filename + '.csv')
+    for record in table[::10]:
+        delete(record)
+    timings['pack'] = _time(table.pack)
+    del index
+    stats = table.stats()
+    table.close()
+    return {'seconds': timings, 'stats': stats}
+
+
+def _first_field(table, kinds):
+    for name in table.field_names:
+        if table.field_info(name).field_type in kinds:
+            return name.lower()
+    return None
+
+def _time(func, *args):
+    start = timer()
+    func(*args)
+    return timer() - start
+
+def _time_query(table, command):
+    # every query starts from an empty compile cache, so all of them include
+    # the time to compile their criteria
+    pql_cache_clear()
+    return _time(table.query, command)
+
+def _value_maker(table, name):
+    """
+    returns a function of a random.Random that makes a value for field name
+    """
+    kind, length, decimals = table.field_info(name)[:3]
+    nullable = table.nullable_field(name)
+    if kind == FieldType.CHAR:
+        make = lambda rng: _word(rng, rng.randint(1, length))
+    elif kind in (FieldType.NUMERIC, FieldType.FLOAT):
+        top = 10 ** min(length - decimals - (decimals and 1) - 1, 9)
+        if decimals:
+            make = lambda rng: round(rng.randrange(max(top - 1, 1)) + rng.random(), decimals)
+        else:
+            make = lambda rng: rng.randrange(top)
+    elif kind == FieldType.INTEGER:
+        make = lambda rng: rng.randint(-2**31 + 1, 2**31 - 1)
+    elif kind == FieldType.DOUBLE:
+        make = lambda rng: rng.uniform(-1e6, 1e6)
+    elif kind == FieldType.CURRENCY:
+        make = lambda rng: Decimal('%d.%04d' % (rng.randrange(10**9), rng.randrange(10**4)))
+    elif kind == FieldType.DATE:
+        make = lambda rng: datetime.date.fromordinal(730120 + rng.randrange(10000))
+    elif kind in (FieldType.DATETIME, FieldType.TIMESTAMP):
+        make = lambda rng: datetime.datetime(2000, 1, 1) + datetime.timedelta(seconds=rng.randrange(10**9))
+    elif kind == FieldType.LOGICAL:
+        make = lambda rng: rng.random() < 0.5
+    elif kind == FieldType.MEMO:
+        make = lambda rng: ' '.join(_word(rng, rng.randint(2, 12)) for _ in range(rng.randrange(40)))
+    else:
+        make = lambda rng: None
+    if nullable:
+        return lambda rng: None if rng.random() < 0.1 else make(rng)
+    return make
+
+def _word(rng, size):
+    return ''.join(rng.choice(_letters) for _ in range(size))
+
+
+if __name__ == '__main__':
+    Run()
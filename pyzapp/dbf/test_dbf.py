@@ -0,0 +1,1612 @@
+"""
+tests of the dbf package: each change to how tables are read, written,
+indexed, or queried is checked by comparing against the plain path, and
+by closing and reopening the table
+"""
+from __future__ import print_function
+
+import csv
+import multiprocessing
+import os
+import pickle
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import unittest
+from array import array
+from unittest import TestCase, main
+
+import dbf
+from dbf import Date, DbfError, DoNotIndex, READ_ONLY, READ_WRITE, Table, delete, is_deleted, recno
+
+
+class DbfTestCase(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='dbf_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, True)
+
+    def path(self, name):
+        return os.path.join(self.tempdir, name)
+
+    def make_table(self, name, specs, rows=(), dbf_type='db3', **kwds):
+        "creates a table holding rows, and returns it open read/write"
+        table = Table(self.path(name), specs, dbf_type=dbf_type, **kwds)
+        table.open(READ_WRITE)
+        for row in rows:
+            table.append(row)
+        return table
+
+    def reopen(self, table, mode=READ_WRITE, **kwds):
+        """
+        closes table, opens it again, and returns it opened afresh from disk
+        """
+        filename = table.filename
+        table.close()
+        table.open(mode)
+        table.close()
+        table = Table(filename, **kwds)
+        table.open(mode)
+        return table
+
+
+## a table of each type with most of its field types, and rows for it
+sample_specs = {
+        'db3': 'name C(20); age N(3,0); paid N(8,2); born D; note M; ok L',
+        'fp': 'name C(20); age N(3,0); paid N(8,2); born D; note M; ok L',
+        'vfp': 'name C(20) null; age N(3,0); paid N(8,2) null; born D; note M null; ok L; cnt I; amt Y; ts T; dbl B',
+        }
+
+def sample_rows(kind, count=60):
+    rows = []
+    for i in range(count):
+        row = ('name%02d' % (i % 17), i, i * 1.5, Date(2000, 1, 1 + i % 28), 'memo %d' % i * (i % 5), i % 2 == 0)
+        if kind == 'vfp':
+            row += (i, i * 2, dbf.DateTime(2001, 2, 3, 4, 5, 6), i / 3.0)
+        rows.append(row)
+    return rows
+
+
+class TestMmap(DbfTestCase):
+    "tables opened with mmap=True read the same records as those without"
+
+    def test_same_records(self):
+        for kind, specs in sorted(sample_specs.items()):
+            table = self.make_table('mmap_' + kind, specs, sample_rows(kind), dbf_type=kind)
+            if kind == 'vfp':
+                table.append({'name': dbf.Null, 'age': 7})
+            table.close()
+            plain = Table(table.filename)
+            mapped = Table(table.filename, mmap=True)
+            plain.open(READ_ONLY)
+            mapped.open(READ_ONLY)
+            self.assertEqual(len(mapped), len(plain))
+            for a, b in zip(plain, mapped):
+                self.assertEqual(tuple(a), tuple(b))
+            self.assertEqual(mapped[3].note, 'memo 3' * 3)
+            plain.close()
+            mapped.close()
+
+    def test_changes(self):
+        table = self.make_table('mmap_changes', sample_specs['db3'], sample_rows('db3'))
+        table.close()
+        table = Table(table.filename, mmap=True)
+        table.open(READ_WRITE)
+        for record in dbf.Process(table):
+            if record.age == 4:
+                record.paid = 99
+        table.append(('added', 100, 1, Date(2020, 2, 2), 'new memo', True))
+        self.assertEqual(table[4].paid, 99)
+        self.assertEqual(table[60].note, 'new memo')
+        for record in table:
+            if record.age % 3 == 0:
+                delete(record)
+        table.pack()
+        self.assertEqual(len(table), 41)
+        self.assertEqual([r.age for r in table][:4], [1, 2, 4, 5])
+        table = self.reopen(table, mmap=True)
+        self.assertEqual(len(table), 41)
+        self.assertEqual(table[2].paid, 99)
+        self.assertEqual(table[-1].name.strip(), 'added')
+        table.close()
+
+    def test_appends_keep_the_map(self):
+        table = self.make_table('mmap_appends', 'name C(10); n N(6,0)', [('r%d' % i, i) for i in range(100)])
+        table.close()
+        table = Table(table.filename, mmap=True)
+        table.open(READ_WRITE)
+        records = list(table)
+        mapped = table._table._mmap
+        for i in range(100, 150):
+            table.append(('a%d' % i, i))
+        table.extend([('e%d' % i, i) for i in range(150, 200)], batch_size=7)
+        self.assertTrue(table._table._mmap is mapped)
+        self.assertEqual([r.n for r in records], list(range(100)))
+        self.assertEqual([r.n for r in table], list(range(200)))
+        table = self.reopen(table, mmap=True)
+        self.assertEqual([r.n for r in table], list(range(200)))
+        table.close()
+
+
+class TestBlocks(DbfTestCase):
+    "scan_blocks and Iter(block_size=...) read many records per call"
+
+    def test_scan_blocks(self):
+        table = self.make_table('blocks', 'a C(5); b N(5,0)', [('x%d' % i, i) for i in range(1000)])
+        table.close()
+        for mmap in (False, True):
+            table = Table(table.filename, mmap=mmap)
+            table.open(READ_WRITE)
+            kept = table[500]
+            blocks = list(table.scan_blocks(batch=300))
+            self.assertEqual([len(b) for b in blocks], [300, 300, 300, 100])
+            self.assertTrue(blocks[1][200] is kept)
+            self.assertEqual([r.b for b in blocks for r in b], list(range(1000)))
+            self.assertEqual([recno(r) for r in blocks[3]], list(range(900, 1000)))
+            self.assertEqual([r.b for b in table.scan_blocks(batch=7, start=10, stop=20) for r in b], list(range(10, 20)))
+            table.close()
+
+    def test_iter(self):
+        table = self.make_table('iter', 'a C(5); b N(5,0)', [('x%d' % i, i) for i in range(1000)])
+        for record in table[::3]:
+            delete(record)
+        self.assertEqual([r.b for r in dbf.Iter(table, block_size=64)], list(range(1000)))
+        self.assertEqual(
+                [(recno(r), is_deleted(r)) for r in dbf.Iter(table, block_size=64)],
+                [(recno(r), is_deleted(r)) for r in dbf.Iter(table)],
+                )
+        records = list(dbf.Iter(table, include_vapor=True, block_size=100))
+        self.assertEqual(len(records), 1001)
+        self.assertTrue(isinstance(records[-1], dbf.RecordVaporWare))
+        table.close()
+
+
+class TestColumns(DbfTestCase):
+    "columns() decodes fields a block at a time into one sequence per field"
+
+    def test_columns_match_records(self):
+        names = ['a', 'b', 'c', 'd', 'e', 'f', 'g']
+        table = self.make_table(
+                'columns', 'a C(5) null; b N(6,2) null; c I; d B; e Y; f D; g F(8,3)',
+                [('x%d' % i, i / 4.0, i, i * 2.5, i * 3, Date(2020, 1, 1 + i % 28), i / 8.0) for i in range(100)],
+                dbf_type='vfp',
+                )
+        table.append({'a': dbf.Null, 'b': dbf.Null})
+        table.close()
+        for mmap in (False, True):
+            table = Table(table.filename, mmap=mmap)
+            table.open(READ_ONLY)
+            columns = table.columns(names, batch=17)
+            self.assertEqual(sorted(columns), names)
+            self.assertEqual([len(c) for c in columns.values()], [101] * 7)
+            for record in table[:100]:
+                for name in names:
+                    self.assertEqual(columns[name][recno(record)], record[name])
+            self.assertTrue(columns['a'][100] is dbf.Null)
+            # a null number is a NaN
+            self.assertTrue(columns['b'][100] != columns['b'][100])
+            self.assertEqual(list(table.columns('c', start=10, stop=13)['c']), [10, 11, 12])
+            self.assertEqual(type(columns['b']), array)
+            table.close()
+
+    def test_as_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest('numpy is not installed')
+        table = self.make_table('numpy', 'n N(6,2); name C(5)', [(i / 4.0, 'x%d' % i) for i in range(10)])
+        table.append(())
+        columns = table.columns('n, name', as_numpy=True)
+        self.assertTrue(isinstance(columns['n'], numpy.ndarray))
+        self.assertEqual(list(columns['n'][:10]), [i / 4.0 for i in range(10)])
+        self.assertTrue(numpy.isnan(columns['n'][10]))
+        self.assertEqual(type(columns['name']), list)
+        table.close()
+
+    def test_in_memory(self):
+        table = Table(':memory:', 'x N(5,1)', on_disk=False)
+        table.open(READ_WRITE)
+        table.append((1.5, ))
+        table.append(())
+        column = table.columns(['x'])['x']
+        self.assertEqual(column[0], 1.5)
+        self.assertTrue(column[1] != column[1])
+        table.close()
+
+
+def _by_name(record):
+    return record.name.strip()
+
+
+class TestSavedIndex(DbfTestCase):
+    "an Index saved to a file is reused until the table or key changes"
+
+    def setUp(self):
+        DbfTestCase.setUp(self)
+        table = self.make_table('saved', 'name C(10); n N(5,0)', [('n%03d' % (i % 50), i) for i in range(200)])
+        table.close()
+        self.table = Table(table.filename)
+        self.table.open(READ_WRITE)
+        self.filename = self.path('saved.idx')
+
+    def tearDown(self):
+        self.table.close()
+        DbfTestCase.tearDown(self)
+
+    def loaded(self, index):
+        "True if index was read from its file instead of built"
+        return '_values' not in index.__dict__
+
+    def test_reused_until_table_changes(self):
+        index = self.table.create_index(_by_name, filename=self.filename)
+        self.assertFalse(self.loaded(index))
+        self.assertFalse(os.path.exists(self.filename + '.tmp'))
+        self.table.close()
+        self.table.open(READ_WRITE)
+        index = self.table.create_index(_by_name, filename=self.filename)
+        self.assertTrue(self.loaded(index))
+        self.assertEqual([r.n for r in index.search('n007')], [7, 57, 107, 157])
+        self.table.append(('n007', 999))
+        self.assertEqual(len(index.search('n007')), 5)
+        index = self.table.create_index(_by_name, filename=self.filename)
+        self.assertFalse(self.loaded(index))
+        self.assertEqual(len(index.search('n007')), 5)
+
+    def test_different_key_is_rebuilt(self):
+        self.table.create_index(lambda r: r.name.strip(), filename=self.filename)
+        self.assertTrue(self.loaded(self.table.create_index(lambda r: r.name.strip(), filename=self.filename)))
+        index = self.table.create_index(lambda r: -r.n, filename=self.filename)
+        self.assertFalse(self.loaded(index))
+        self.assertEqual(index[0].n, 199)
+        index = self.table.create_index(lambda r: r.n * 2, filename=self.filename)
+        self.assertFalse(self.loaded(index))
+        self.assertEqual(index[0].n, 0)
+
+    def test_closures_and_defaults_are_part_of_the_key(self):
+        def remainder(modulus):
+            return lambda r: (r.n % modulus, r.n)
+        self.table.create_index(remainder(7), filename=self.filename)
+        self.assertTrue(self.loaded(self.table.create_index(remainder(7), filename=self.filename)))
+        index = self.table.create_index(remainder(5), filename=self.filename)
+        self.assertFalse(self.loaded(index))
+        self.assertEqual([r.n for r in index][:3], [0, 5, 10])
+        self.table.create_index(lambda r, modulus=7: (r.n % modulus, r.n), filename=self.filename)
+        index = self.table.create_index(lambda r, modulus=5: (r.n % modulus, r.n), filename=self.filename)
+        self.assertFalse(self.loaded(index))
+        self.assertEqual([r.n for r in index][:3], [0, 5, 10])
+
+    def test_index_kinds_are_told_apart(self):
+        self.table.create_index('name', filename=self.filename)
+        index = self.table.create_index('name', filename=self.filename, kind='prefix')
+        self.assertFalse(self.loaded(index))
+        self.assertTrue(isinstance(index, dbf.PrefixIndex))
+        self.assertEqual(len(index.search('n00', partial=True)), 40)
+        self.assertFalse(self.loaded(self.table.create_index('name', filename=self.filename)))
+
+    def test_unchecked_key_is_not_saved(self):
+        class Key(object):
+            def __call__(self, record):
+                return record.n
+        self.assertRaises(DbfError, self.table.create_index, Key(), filename=self.filename)
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertEqual(len(self.table.create_index(Key())), 200)
+
+
+def _skip_tens(record):
+    if record.n is None or record.n % 10 == 0:
+        return DoNotIndex
+    return record.n % 7
+
+
+class TestIndexBuild(DbfTestCase):
+    "an Index is built with one sort, and stays in order as records are added"
+
+    def expected(self, table):
+        records = [r for r in table if r.n % 10]
+        return [recno(r) for r in sorted(records, key=lambda r: r.n % 7)]
+
+    def test_build(self):
+        table = self.make_table('build', 'name C(10); n N(6,0)', [('r%d' % i, (i * 37) % 500) for i in range(500)])
+        index = table.create_index(_skip_tens)
+        self.assertEqual(len(index), 450)
+        self.assertEqual([recno(r) for r in index], self.expected(table))
+        self.assertEqual(index._values, sorted(index._values))
+        table.close()
+
+    def test_additions_match_a_fresh_build(self):
+        table = self.make_table('grow', 'name C(10); n N(6,0)', [('r%d' % i, i) for i in range(50)])
+        index = table.create_index(_skip_tens)
+        for i in range(50, 80):
+            table.append(('a%d' % i, (i * 37) % 500))
+        for i in range(80, 400):
+            table.append(('e%d' % i, (i * 13) % 500))
+        with table[3] as record:
+            record.n = 40
+        self.assertEqual([recno(r) for r in index], self.expected(table))
+        self.assertEqual(
+                [recno(r) for r in index],
+                [recno(r) for r in table.create_index(_skip_tens)],
+                )
+        table.close()
+
+
+class TestIdx(DbfTestCase):
+    "Idx finds keys by walking the B-tree of a FoxPro .idx file"
+
+    def setUp(self):
+        DbfTestCase.setUp(self)
+        self.table = self.make_table('idx', 'name C(10); n N(5,0)', [('k%03d' % ((i * 37) % 50), i) for i in range(100)], dbf_type='fp')
+        entries = sorted((r.name.encode('ascii'), recno(r)) for r in self.table)
+        # a root node over leaves of 30 keys each, with record numbers from 1
+        leaves = [entries[i:i+30] for i in range(0, len(entries), 30)]
+        offsets = [1024 + 512 * i for i in range(len(leaves))]
+        nodes = b''
+        for i, leaf in enumerate(leaves):
+            left = offsets[i-1] if i else -1
+            right = offsets[i+1] if i + 1 < len(leaves) else -1
+            nodes += self.node(2, [(k, r + 1) for k, r in leaf], left, right)
+        root = self.node(1, [(leaf[-1][0], offset) for leaf, offset in zip(leaves, offsets)], -1, -1)
+        header = struct.pack('<iiiHBB', 512, -1, 1024 + len(nodes), 10, 0, 0).ljust(512, b'\x00')
+        with open(self.path('idx.idx'), 'wb') as fh:
+            fh.write(header + root + nodes)
+        self.idx = dbf.Idx(self.table, self.path('idx.idx'))
+
+    def tearDown(self):
+        self.idx.close()
+        self.table.close()
+        DbfTestCase.tearDown(self)
+
+    def node(self, attributes, keys, left, right):
+        data = struct.pack('<HHii', attributes, len(keys), left, right)
+        for key, pointer in keys:
+            data += key + struct.pack('>L', pointer)
+        return data.ljust(512, b'\x00')
+
+    def test_search(self):
+        for key in (7, 29, 0, 49):
+            self.assertEqual(
+                    [r.n for r in self.idx.search('k%03d' % key)],
+                    [i for i in range(100) if (i * 37) % 50 == key],
+                    )
+        self.assertEqual(len(self.idx.search('k00', partial=True)), 20)
+        self.assertEqual(len(self.idx.search('zzz')), 0)
+        self.assertEqual(len(self.idx.search('a')), 0)
+
+    def test_range(self):
+        self.assertEqual([r.name.strip() for r in self.idx.range('k010', 'k012')], ['k010'] * 2 + ['k011'] * 2)
+        self.assertEqual(len(list(self.idx.range(hi='k002'))), 4)
+        self.assertEqual(len(list(self.idx.range('k048'))), 4)
+        self.assertEqual([r.name for r in self.idx], sorted(r.name for r in self.table))
+
+
+class TestCodec(DbfTestCase):
+    "as_tuple and as_dict decode fields through the table's compiled codec"
+
+    def test_as_tuple(self):
+        for kind, specs in sorted(sample_specs.items()):
+            table = self.make_table('codec_' + kind, specs, sample_rows(kind), dbf_type=kind)
+            for record in table:
+                self.assertEqual(record.as_tuple(), tuple(record))
+                self.assertEqual(record.as_tuple(['note', 'AGE']), (record.note, record.age))
+                self.assertEqual(record.as_dict(), dbf.scatter(record, dict))
+            table = self.reopen(table)
+            self.assertEqual([r.as_tuple() for r in table], [tuple(r) for r in table])
+            table.close()
+
+    def test_nulls_and_changes(self):
+        table = self.make_table(
+                'codec_null', 'a C(5) null; b N(6,2); m M null', [('hi', 1.5, 'memo')],
+                dbf_type='vfp', default_data_types='enhanced',
+                )
+        table.append({'a': dbf.Null, 'm': dbf.Null})
+        self.assertEqual(table[1].as_tuple(['a', 'm']), (dbf.Null, dbf.Null))
+        self.assertEqual(sorted(table[0].as_dict()), ['A', 'B', 'M'])
+        record = table[0]
+        with record:
+            record.m = 'changed'
+            record.a = dbf.Null
+            self.assertEqual(record.as_tuple(['m', 'a']), ('changed', dbf.Null))
+        self.assertEqual(dbf.create_template(record).as_tuple(), tuple(record))
+        table = self.reopen(table)
+        self.assertEqual(table[0].as_tuple(), (dbf.Null, 1.5, 'changed'))
+        table.close()
+
+    def test_dict_keys(self):
+        table = self.make_table('codec_keys', 'name C(10); age N(3,0)', [('abc', 5)])
+        for record in (table[0], dbf.create_template(table[0])):
+            everything = record.as_dict()
+            some = record.as_dict([str('Name'), u'age'])
+            self.assertEqual(some, everything)
+            self.assertEqual([type(k) for k in some], [type(k) for k in everything])
+            self.assertEqual(record.as_dict(['AGE']), {'AGE': 5})
+        table.close()
+
+
+class TestExtend(DbfTestCase):
+    "extend() writes each batch of records, the header, and indexes once"
+
+    def test_same_as_append(self):
+        for kind in ('db3', 'vfp'):
+            rows = [('r%d' % i, (i * 7) % 100, 'memo %d' % i) for i in range(1, 1000)]
+            rows[10] = {'name': 'dict', 'n': 5, 'm': 'dm'}
+            extended = self.make_table('extended_' + kind, 'name C(10); n N(6,0); m M', dbf_type=kind)
+            appended = self.make_table('appended_' + kind, 'name C(10); n N(6,0); m M', dbf_type=kind)
+            index = extended.create_index(lambda r: r.n)
+            self.assertEqual(extended.extend(rows, batch_size=300), 999)
+            for row in rows:
+                appended.append(row)
+            self.assertEqual(len(index), 999)
+            self.assertEqual([recno(r) for r in index], [recno(r) for r in appended.create_index(lambda r: r.n)])
+            extended = self.reopen(extended)
+            appended = self.reopen(appended)
+            self.assertEqual([tuple(r) for r in extended], [tuple(r) for r in appended])
+            extended.close()
+            appended.close()
+
+    def test_failure_keeps_earlier_rows(self):
+        table = self.make_table('failure', 'name C(10); n N(6,0); m M', [('first', 0, 'm0')])
+        self.assertRaises(Exception, table.extend, [('ok1', 1, ''), ('ok2', 2, ''), ('bad', 'x', ''), ('never', 3, '')])
+        self.assertEqual([r.name.strip() for r in table], ['first', 'ok1', 'ok2'])
+        self.assertEqual(table.extend([table[0]]), 1)
+        table = self.reopen(table)
+        self.assertEqual(len(table), 4)
+        self.assertEqual((table[-1].name.strip(), table[-1].m), ('first', 'm0'))
+        table.close()
+
+    def test_failed_row_keeps_no_memos(self):
+        for kind in ('db3', 'vfp'):
+            table = self.make_table('failed_row_' + kind, 'name C(10); m M; n N(6,0)', [('first', 'm0', 0)], dbf_type=kind)
+            memo = table._meta.memo
+            expected = self.make_table('expected_' + kind, 'name C(10); m M; n N(6,0)', [('first', 'm0', 0), ('ok', 'kept', 1)], dbf_type=kind)
+            self.assertRaises(Exception, table.extend, [('ok', 'kept', 1), ('bad', 'x' * 2000, 'x')])
+            self.assertEqual(memo.nextmemo, expected._meta.memo.nextmemo)
+            table.append(('after', 'after memo', 2))
+            table = self.reopen(table)
+            self.assertEqual(table._meta.memo.nextmemo, memo.nextmemo)
+            self.assertEqual([(r.name.strip(), r.m) for r in table], [('first', 'm0'), ('ok', 'kept'), ('after', 'after memo')])
+            table.close()
+            expected.close()
+
+    def test_failed_write_keeps_no_memos(self):
+        table = self.make_table('failed_write', 'name C(10); m M; n N(6,0)', [('first', 'm0', 0)])
+        memo = table._meta.memo
+        before = memo.nextmemo
+        def broken(meta, offset, data):
+            raise IOError('disk full')
+        write_at = dbf._write_at
+        dbf._write_at = broken
+        try:
+            self.assertRaises(IOError, table.extend, [('lost%d' % i, 'memo %d' % i, i) for i in range(5)])
+        finally:
+            dbf._write_at = write_at
+        self.assertEqual((len(table), memo.nextmemo), (1, before))
+        self.assertEqual(table.extend([('ok', 'kept', 1)]), 1)
+        table = self.reopen(table)
+        self.assertEqual(table._meta.memo.nextmemo, memo.nextmemo)
+        self.assertEqual([(r.name.strip(), r.m) for r in table], [('first', 'm0'), ('ok', 'kept')])
+        table.close()
+
+    def test_in_memory(self):
+        table = Table(':memory:', 'x N(5,1)', on_disk=False)
+        table.open(READ_WRITE)
+        self.assertEqual(table.extend([(1, ), (2, )]), 2)
+        self.assertEqual([r.x for r in table], [1, 2])
+        table.close()
+
+
+class TestMemoCache(DbfTestCase):
+    "memo reads are cached, and memo writes are buffered until flushed"
+
+    def setUp(self):
+        DbfTestCase.setUp(self)
+        self.memo_cache_size = dbf.memo_cache_size
+
+    def tearDown(self):
+        dbf.memo_cache_size = self.memo_cache_size
+        DbfTestCase.tearDown(self)
+
+    def test_round_trip(self):
+        big = 'x' * 511 + 'y' * 3000
+        for kind in ('db3', 'fp', 'vfp'):
+            table = self.make_table('memo_' + kind, 'a M; b M', dbf_type=kind)
+            for i in range(30):
+                table.append(('m%d' % i * i, big if i % 7 == 0 else ''))
+            table.extend([('e%d' % i, 'f%d' % i) for i in range(20)])
+            self.assertEqual((table[7].b, table[35].b), (big, 'f5'))
+            table.close()
+            self.assertEqual(table._meta.memo.pending, [])
+            for size in (0, 100, 10 ** 6):
+                dbf.memo_cache_size = size
+                table = Table(table.filename)
+                table.open(READ_ONLY)
+                self.assertEqual([r.a for r in table][:3], ['', 'm1', 'm2m2'])
+                self.assertEqual((table[29].a, table[14].b, table[49].b), ('m29' * 29, big, 'f19'))
+                self.assertTrue(table._meta.memo.cache.size <= size)
+                table.close()
+
+    def test_cached_reads(self):
+        table = self.make_table('cached', 'a M', [('memo %d' % i, ) for i in range(20)])
+        table = self.reopen(table, READ_ONLY)
+        memo = table._meta.memo
+        reads = []
+        get_memo = memo._get_memo
+        memo._get_memo = lambda block: reads.append(block) or get_memo(block)
+        for _ in range(3):
+            self.assertEqual([r.a for r in table], ['memo %d' % i for i in range(20)])
+        self.assertEqual(len(reads), 20)
+        table.close()
+
+    def test_terminator_across_blocks(self):
+        dbf.memo_cache_size = 0
+        table = self.make_table('straddle', 'a M', [('z' * 511, ), ('q' * 510, )])
+        table = self.reopen(table, READ_ONLY)
+        self.assertEqual((table[0].a, table[1].a), ('z' * 511, 'q' * 510))
+        table.close()
+
+
+class TestExport(DbfTestCase):
+    "export() streams rows, optionally in parallel, in its usual format"
+
+    def setUp(self):
+        DbfTestCase.setUp(self)
+        self.table = self.make_table(
+                'export', 'name C(10); n N(6,0); f N(8,2); dt D; ok L; m M',
+                [('n,"%d"' % i, i, i / 4.0, Date(2020, 1, 1 + i % 28), i % 2 == 0, 'memo%d' % i) for i in range(2000)],
+                )
+
+    def tearDown(self):
+        self.table.close()
+        DbfTestCase.tearDown(self)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as fh:
+            return fh.read()
+
+    def test_csv(self):
+        self.assertEqual(dbf.export(self.table, self.path('serial.csv')), 2000)
+        if sys.version_info[0] < 3:
+            source = open(self.path('serial.csv'), 'rb')
+        else:
+            source = open(self.path('serial.csv'), 'r', newline='')
+        with source:
+            rows = list(csv.reader(source))
+        self.assertEqual(len(rows), 2001)
+        self.assertEqual(rows[0], ['NAME', 'N', 'F', 'DT', 'OK', 'M'])
+        self.assertEqual(rows[4][0].strip(), 'n,"3"')
+        self.assertEqual(float(rows[4][2]), 0.75)
+        self.assertEqual(rows[4][5], 'memo3')
+        self.assertEqual(dbf.export((r for r in self.table if r.n < 10), self.path('some.csv')), 10)
+
+    def test_parallel_matches_serial(self):
+        for format, ext in (('csv', '.csv'), ('tab', '.tab'), ('fixed', '.txt')):
+            self.assertEqual(dbf.export(self.table, self.path('serial'), format=format), 2000)
+            self.assertEqual(dbf.export(self.table, self.path('parallel'), format=format, processes=3), 2000)
+            self.assertEqual(self.read('serial' + ext), self.read('parallel' + ext))
+        self.assertTrue('Total Records in file: 2000' in self.read('parallel_layout.txt').decode('ascii'))
+
+    def test_same_bytes_as_before(self):
+        table = self.make_table(
+                'before', 'name C(12); n N(6,2); born D; ok L; note M',
+                [
+                    ('plain', 1.5, Date(2001, 2, 3), True, 'memo'),
+                    ('say "hi"', -2, None, False, 'a,b'),
+                    ('', 0, Date(1999, 12, 31), None, ''),
+                    (u'caf\xe9', None, None, None, 'x\ty'),
+                    ],
+                codepage='cp1252',
+                )
+        rows = (
+                b'"plain       ",1.5,2001-02-03,True,"memo"\n'
+                b'"say ""hi""    ",-2.0,,False,"a,b"\n'
+                b'"            ",0.0,1999-12-31,,\n'
+                b'"caf\xe9        ",,,,"x\ty"\n'
+                )
+        dbf.export(table, self.path('before'))
+        self.assertEqual(self.read('before.csv'), b'NAME,N,BORN,OK,NOTE\n' + rows)
+        dbf.export(table, self.path('before'), header=['A', 'B', 'C', 'D', 'E'])
+        self.assertEqual(self.read('before.csv'), b'A,B,C,D,E\n' + rows)
+        dbf.export(table, self.path('before'), field_names='note, name', header=False)
+        self.assertEqual(
+                self.read('before.csv'),
+                b'"memo","plain       "\n"a,b","say ""hi""    "\n,"            "\n"x\ty","caf\xe9        "\n',
+                )
+        rows = (
+                b'plain       \t1.5\t2001-02-03\tTrue\tmemo\n'
+                b'say "hi"    \t-2.0\tNone\tFalse\ta,b\n'
+                b'            \t0.0\t1999-12-31\tNone\t\n'
+                b'caf\xe9        \tNone\tNone\tNone\tx\ty\n'
+                )
+        dbf.export(table, self.path('before'), format='tab')
+        self.assertEqual(self.read('before.tab'), b'NAME\tN\tBORN\tOK\tNOTE\n' + rows)
+        dbf.export(table, self.path('before'), format='tab', header=['A', 'B', 'C', 'D', 'E'])
+        self.assertEqual(self.read('before.tab'), b'A,B,C,D,E' + rows)
+        dbf.export(table, self.path('before'), format='fixed')
+        self.assertEqual(
+                self.read('before.txt'),
+                b'plain       1.5   2001-02-03Truememo      \n'
+                b'say "hi"    -2.0  None      Falsea,b       \n'
+                b'            0.0   1999-12-31None          \n'
+                b'caf\xe9        None  None      Nonex\ty       \n',
+                )
+        table.close()
+
+
+class TestPlanner(DbfTestCase):
+    "queries on indexed fields search the index instead of every record"
+
+    queries = [
+            "select * where n == 7",
+            "select * where n >= 10 and n < 12 and f > 100",
+            "select * where 5 < n <= 6",
+            "select * where name.startswith('b1') and n != 3",
+            "select * where n == 7 or n == 8",
+            "select * where f < 3",
+            "select * where n == 70",
+            ]
+
+    def test_same_results(self):
+        table = self.make_table(
+                'plan', 'name C(10); n N(6,0); f N(8,2)',
+                [('%s%d' % ('abc'[i % 3], i), i % 50, i / 4.0) for i in range(3000)],
+                )
+        scanned = [[recno(r) for r in table.query(q)] for q in self.queries]
+        self.assertTrue(all(scanned[:-1]))
+        # held here, as a table only keeps weak references to its indexes
+        by_n = table.create_index('n')
+        by_name = table.create_index('name')
+        self.assertEqual(len(dbf.pql_plan(table, 'n == 7')), 60)
+        self.assertEqual(len(dbf.pql_plan(table, "name.startswith('b1')")), len([r for r in table if r.name.startswith('b1')]))
+        self.assertTrue(dbf.pql_plan(table, 'f < 3') is None)
+        self.assertEqual([[recno(r) for r in table.query(q)] for q in self.queries], scanned)
+        # indexes follow changes
+        with table[0] as record:
+            record.n = 70
+        self.assertEqual([recno(r) for r in table.query('select * where n == 70')], [0])
+        table.close()
+
+    def test_duplicate_keys_after_updates(self):
+        table = self.make_table('dups', 'n N(3,0)', [(n, ) for n in (1, 1, 1, 2, 1)])
+        # held here, as a table only keeps weak references to its indexes
+        index = table.create_index('n')
+        with table[1] as record:
+            record.n = 9
+        self.assertEqual([recno(r) for r in table.query('select * where n == 1')], [0, 2, 4])
+        with table[1] as record:
+            record.n = 1
+        with table[4] as record:
+            record.n = 2
+        self.assertEqual([recno(r) for r in table.query('select * where n == 1')], [0, 1, 2])
+        self.assertEqual([recno(r) for r in table.query('select * where n == 2')], [3, 4])
+        self.assertEqual(index._rec_by_val, [0, 1, 2, 3, 4])
+        index._purge(1)
+        self.assertEqual([recno(r) for r in index.search(1)], [0, 2])
+        table.close()
+
+    def test_saved_field_index(self):
+        table = self.make_table('saved', 'name C(10); n N(5,0)', [('n%03d' % (i % 50), i) for i in range(200)])
+        filename = self.path('saved.idx')
+        index = table.create_index('n', filename=filename)
+        self.assertTrue('_values' in index.__dict__)
+        index = table.create_index('n', filename=filename)
+        self.assertFalse('_values' in index.__dict__)
+        self.assertEqual(index[0].n, 0)
+        index = table.create_index('name', filename=filename)
+        self.assertTrue('_values' in index.__dict__)
+        table.close()
+
+
+class TestCompileCache(DbfTestCase):
+    "compiled pql criteria and commands are reused for the same text"
+
+    def setUp(self):
+        DbfTestCase.setUp(self)
+        self.pql_cache_size = dbf.pql_cache_size
+        self.table = self.make_table('cache', 'name C(10); n N(6,0)', [('x%d' % i, i) for i in range(100)])
+        dbf.pql_cache_clear()
+
+    def tearDown(self):
+        self.table.close()
+        dbf.pql_cache_size = self.pql_cache_size
+        dbf.pql_cache_clear()
+        dbf.pql_user_functions.pop('small', None)
+        DbfTestCase.tearDown(self)
+
+    def test_reuse(self):
+        for _ in range(5):
+            self.assertEqual(len(self.table.query('select * where n < 10')), 10)
+        self.assertEqual(dbf.pql_cache_info()[:3], (4, 1, 1))
+        self.assertEqual(len(self.table.query('select * where n >= 10')), 90)
+        self.assertEqual(dbf.pql_cache_info()[:3], (4, 2, 2))
+
+    def test_user_functions_are_not_stale(self):
+        dbf.pql_user_functions['small'] = lambda v: v < 3
+        self.assertEqual(len(self.table.query('select * where small(n)')), 3)
+        dbf.pql_user_functions['small'] = lambda v: v < 5
+        self.assertEqual(len(self.table.query('select * where small(n)')), 5)
+
+    def test_replaced_user_functions_are_not_reused(self):
+        # each replaced function is freed at once, so its id may be reused
+        for limit in range(1, 30):
+            dbf.pql_user_functions['small'] = eval('lambda v: v < %d' % limit)
+            self.assertEqual(len(self.table.query('select * where small(n)')), limit)
+
+    def test_disabled(self):
+        dbf.pql_cache_size = 0
+        dbf.pql_cache_clear()
+        self.assertEqual(len(self.table.query('select * where n < 10')), 10)
+        self.assertEqual(len(self.table.query('select * where n < 10')), 10)
+        self.assertEqual(dbf.pql_cache_info()[:3], (0, 0, 0))
+
+
+class TestAggregates(DbfTestCase):
+    "COUNT, SUM, MIN, MAX, and AVG are computed in one pass, optionally per group"
+
+    def setUp(self):
+        DbfTestCase.setUp(self)
+        self.table = self.make_table(
+                'aggregate', 'name C(5); n N(6,0); f N(8,2)',
+                [('g%d' % (i % 3), i, None if i % 10 == 0 else i / 2.0) for i in range(300)],
+                )
+
+    def tearDown(self):
+        self.table.close()
+        DbfTestCase.tearDown(self)
+
+    def test_functions(self):
+        query = self.table.query
+        rows = query('count')
+        self.assertEqual(rows, [(300, )])
+        self.assertEqual(rows.field_names, ['count(*)'])
+        self.assertEqual(query('count where n < 10'), [(10, )])
+        self.assertEqual(query('count f'), [(270, )])
+        self.assertEqual(query('sum n'), [(sum(range(300)), )])
+        self.assertEqual(query('min n, f where n > 5'), [(6, 3.0)])
+        self.assertEqual(query('max n'), [(299, )])
+        self.assertEqual(query('avg n'), [(149.5, )])
+        self.assertEqual(query('sum n where n > 1000'), [(None, )])
+
+    def test_group_by(self):
+        rows = self.table.query('select name, count(*), sum(n), avg(f) where n >= 0 group by name')
+        self.assertEqual(rows.field_names, ['NAME', 'count(*)', 'sum(N)', 'avg(F)'])
+        self.assertEqual([(r[0], r[1], r[2]) for r in rows], [
+                ('g0   ', 100, sum(range(0, 300, 3))),
+                ('g1   ', 100, sum(range(1, 300, 3))),
+                ('g2   ', 100, sum(range(2, 300, 3))),
+                ])
+        self.assertEqual(self.table.query('count group by name'), [(r[0], 100) for r in rows])
+        self.assertEqual(self.table.query('count where n > 1000 group by name'), [])
+        self.assertRaises(DbfError, self.table.query, 'select name, n group by name')
+
+    def test_fields_required(self):
+        for function in ('sum', 'min', 'max', 'avg'):
+            for command in (function, '%s where n > 5' % function, 'select %s(*)' % function):
+                try:
+                    self.table.query(command)
+                except DbfError:
+                    self.assertEqual(str(sys.exc_info()[1]), '%s requires a field' % function.upper())
+                else:
+                    self.fail('%r accepted' % command)
+        self.assertEqual(self.table.query('count where n > 5'), [(294, )])
+
+
+def _range_sum(table, start, stop):
+    return start, stop, sum(r.n for r in table[start:stop])
+
+
+def _range_status(table, start, stop):
+    return table.status
+
+
+class TestParallel(DbfTestCase):
+    "map_ranges and parallel queries match the serial results"
+
+    def setUp(self):
+        DbfTestCase.setUp(self)
+        self.table = self.make_table(
+                'parallel', 'name C(5); n N(6,0); f N(8,2)',
+                [('g%d' % (i % 4), i, i / 2.0) for i in range(4000)],
+                )
+
+    def tearDown(self):
+        self.table.close()
+        DbfTestCase.tearDown(self)
+
+    def test_map_ranges(self):
+        serial = self.table.map_ranges(_range_sum, workers=1, chunks=5)
+        parallel = self.table.map_ranges(_range_sum, workers=3, chunks=5)
+        self.assertEqual(serial, parallel)
+        self.assertEqual([r[0] for r in parallel], [0, 800, 1600, 2400, 3200])
+        self.assertEqual(sum(r[2] for r in parallel), sum(range(4000)))
+
+    def test_workers_open_read_only(self):
+        statuses = self.table.map_ranges(_range_status, workers=2)
+        self.assertEqual(set(statuses), set([READ_ONLY]))
+        self.assertEqual(self.table.status, READ_WRITE)
+
+    def test_parallel_query(self):
+        table = self.table
+        serial = [recno(r) for r in table.query('select * where n % 7 == 0')]
+        parallel = [recno(r) for r in table.query('select * where n % 7 == 0', parallel=3)]
+        self.assertEqual(serial, parallel)
+        self.assertEqual(len(parallel), 572)
+        command = 'select name, count(*), sum(n), min(f), max(n), avg(f) where n > 10 group by name'
+        self.assertEqual(table.query(command), table.query(command, parallel=4))
+
+    def test_parallel_export_leaves_other_files(self):
+        target = self.path('out[1].csv')
+        bystander = target + '.part0'
+        with open(bystander, 'w') as fh:
+            fh.write('not ours')
+        self.assertEqual(dbf.export(self.table, target, processes=3), 4000)
+        self.assertEqual(dbf.export(self.table, self.path('serial.csv')), 4000)
+        with open(target, 'rb') as parallel, open(self.path('serial.csv'), 'rb') as serial:
+            self.assertEqual(parallel.read(), serial.read())
+        self.assertTrue(os.path.exists(bystander))
+        self.assertEqual(
+                sorted(os.listdir(self.tempdir)),
+                sorted(['out[1].csv', 'out[1].csv.part0', os.path.basename(self.table.filename), 'serial.csv']),
+                )
+
+
+class TestOrderBy(DbfTestCase):
+    "ORDER BY sorts SELECT results, and LIMIT keeps only the first rows"
+
+    def setUp(self):
+        DbfTestCase.setUp(self)
+        rng = random.Random(5)
+        self.table = self.make_table(
+                'order', 'name C(5); n N(6,0); f N(8,2)',
+                [('g%d' % (i % 4), rng.randint(0, 500), None if i % 17 == 0 else i / 2.0) for i in range(3000)],
+                )
+        self.records = list(self.table)
+
+    def tearDown(self):
+        self.table.close()
+        DbfTestCase.tearDown(self)
+
+    def rec_nums(self, command, **kwds):
+        return [recno(r) for r in self.table.query(command, **kwds)]
+
+    def expected(self, key, descending=False, limit=None, where=lambda r: True):
+        records = [r for r in self.records if where(r)]
+        return [recno(r) for r in sorted(records, key=key, reverse=descending)][:limit]
+
+    def check(self):
+        self.assertEqual(
+                self.rec_nums('select * where n > 100 order by n limit 20'),
+                self.expected(lambda r: r.n, False, 20, lambda r: r.n > 100),
+                )
+        self.assertEqual(self.rec_nums('select * order by n desc limit 50'), self.expected(lambda r: r.n, True, 50))
+        self.assertEqual(self.rec_nums('select * where n < 50 order by n'), self.expected(lambda r: r.n, where=lambda r: r.n < 50))
+        self.assertEqual(
+                self.rec_nums("select * where name == 'g1   ' order by n desc limit 7"),
+                self.expected(lambda r: r.n, True, 7, lambda r: r.name == 'g1   '),
+                )
+        self.assertEqual(
+                self.rec_nums('select * order by name desc, n limit 30'),
+                [recno(r) for r in sorted(sorted(self.records, key=lambda r: r.n), key=lambda r: r.name, reverse=True)][:30],
+                )
+
+    def test_order_and_limit(self):
+        self.check()
+        self.assertEqual(self.rec_nums('select * limit 5'), [0, 1, 2, 3, 4])
+        # blank values sort first
+        self.assertEqual(self.rec_nums('select * order by f limit 3'), [0, 17, 34])
+        self.assertEqual(
+                self.rec_nums('select * where n % 3 == 0 order by n desc limit 9', parallel=2),
+                self.expected(lambda r: r.n, True, 9, lambda r: r.n % 3 == 0),
+                )
+
+    def test_with_index(self):
+        # a single order field with a LIMIT walks the index
+        index = self.table.create_index('n')
+        self.check()
+
+    def test_with_index_after_updates(self):
+        table = self.make_table('order_dups', 'n N(3,0)', [(1, ), (1, ), (1, ), (5, )])
+        # held here, as a table only keeps weak references to its indexes
+        index = table.create_index('n')
+        with table[1] as record:
+            record.n = 9
+        self.assertEqual([recno(r) for r in table.query('select * order by n limit 2')], [0, 2])
+        with table[0] as record:
+            record.n = 5
+        with table[0] as record:
+            record.n = 1
+        self.assertEqual([recno(r) for r in table.query('select * order by n limit 2')], [0, 2])
+        self.assertEqual([recno(r) for r in table.query('select * order by n desc limit 3')], [1, 3, 0])
+        table.close()
+
+    def test_keywords_in_literals(self):
+        table = self.make_table('order_words', 'name C(20); n N(3,0)', [
+                ('x limit 3', 4), ('x order by n', 2), ("it's a group by", 7), ('plain', 1), ('x limit 3', 3),
+                ])
+        rows = table.query("select * where name.strip() == 'x limit 3' order by n")
+        self.assertEqual([recno(r) for r in rows], [4, 0])
+        rows = table.query('select * where name.strip() == "x order by n" limit 1')
+        self.assertEqual([recno(r) for r in rows], [1])
+        rows = table.query("select * where name.strip() == 'it\\'s a group by'")
+        self.assertEqual([recno(r) for r in rows], [2])
+        rows = table.query("select name, count(*) where ' group by ' not in name group by name order by name")
+        self.assertEqual([(r[0].strip(), r[1]) for r in rows], [('plain', 1), ('x limit 3', 2), ('x order by n', 1)])
+        table.close()
+
+    def test_aggregates(self):
+        rows = self.table.query('select name, count(*) group by name order by name desc limit 2')
+        self.assertEqual([r[0] for r in rows], ['g3   ', 'g2   '])
+        rows = self.table.query('count group by name order by count(*) desc, name')
+        self.assertEqual([r[1] for r in rows], [750] * 4)
+        self.assertRaises(DbfError, self.table.query, 'delete * where n > 4 limit 3')
+        self.assertRaises(DbfError, self.table.query, 'select * limit -1')
+
+
+class TestProjection(DbfTestCase):
+    "SELECT with projection returns a ResultSet of namedtuples"
+
+    def setUp(self):
+        DbfTestCase.setUp(self)
+        self.table = self.make_table(
+                'projection', 'name C(5); n N(6,0); age N(3,0); dt D; m M',
+                [('p%d' % (i % 5), i, (i * 37) % 101, Date(2021, 1, 1 + i % 28), 'memo %d' % i) for i in range(500)],
+                )
+
+    def tearDown(self):
+        self.table.close()
+        DbfTestCase.tearDown(self)
+
+    def test_rows(self):
+        rows = self.table.query('select name, n, m where n >= 490', projection=True)
+        self.assertTrue(isinstance(rows, dbf.ResultSet))
+        self.assertEqual(rows.field_names, ['NAME', 'N', 'M'])
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(rows[0], ('p0   ', 490, 'memo 490'))
+        self.assertEqual(rows[0].m, 'memo 490')
+        copy = pickle.loads(pickle.dumps(rows, 2))
+        self.assertEqual(copy, rows)
+        self.assertEqual(copy[3].n, 493)
+
+    def test_matches_records(self):
+        records = self.table.query('select * where age < 10')
+        rows = self.table.query('select n, dt where age < 10', projection=True)
+        self.assertEqual(list(rows), [(r.n, r.dt) for r in records])
+        parallel = self.table.query('select n, dt where age < 10', projection=True, parallel=3)
+        self.assertEqual(parallel, rows)
+
+    def test_order_by_unprojected_field(self):
+        rows = self.table.query('select name where n < 100 order by age desc limit 5', projection=True)
+        records = sorted([r for r in self.table if r.n < 100], key=lambda r: r.age, reverse=True)[:5]
+        self.assertEqual(rows.field_names, ['NAME'])
+        self.assertEqual(list(rows), [(r.name, ) for r in records])
+        rows = self.table.query('select n order by age, n desc', projection=True)
+        self.assertEqual([r.n for r in rows], [r.n for r in sorted(self.table, key=lambda r: (r.age, -r.n))])
+
+    def test_order_by_projected_field(self):
+        rows = self.table.query('select n, age where n < 3 order by n desc', projection=True)
+        self.assertEqual(list(rows), [(2, 74), (1, 37), (0, 0)])
+        self.assertEqual(len(self.table.query('select n limit 7', projection=True)), 7)
+
+
+class TestHashIndex(DbfTestCase):
+    "HashIndex answers equality lookups, and keeps up with changes and packs"
+
+    def setUp(self):
+        DbfTestCase.setUp(self)
+        self.table = self.make_table('hash', 'code C(6); n N(6,0)', [('c%d' % (i % 50), i) for i in range(1000)])
+        self.index = self.table.create_index('code', kind='hash')
+
+    def tearDown(self):
+        self.table.close()
+        DbfTestCase.tearDown(self)
+
+    def rec_nums(self, code):
+        return [recno(r) for r in self.index.search(code.ljust(6))]
+
+    def test_search(self):
+        self.assertTrue(isinstance(self.index, dbf.HashIndex))
+        self.assertEqual(len(self.index), 1000)
+        self.assertEqual(self.rec_nums('c7'), list(range(7, 1000, 50)))
+        self.assertTrue(('c7    ', ) in self.index)
+        self.assertEqual(self.rec_nums('zz'), [])
+        self.assertRaises(dbf.NotFoundError, self.index.__getitem__, 'zz')
+
+    def test_changes(self):
+        for rec_num in (957, 7, 507):
+            with self.table[rec_num] as record:
+                record.code = 'new'
+        self.assertEqual(self.rec_nums('new'), [7, 507, 957])
+        self.assertEqual(self.rec_nums('c7'), [r for r in range(57, 1000, 50) if r not in (507, 957)])
+        self.table.extend([('c7', 5001), ('other', 1)])
+        self.table.append(('c7', 5002))
+        self.assertEqual(self.rec_nums('c7')[-2:], [1000, 1002])
+        self.assertEqual(len(self.index), 1003)
+
+    def test_buckets_stay_sorted(self):
+        rng = random.Random(17)
+        for _ in range(300):
+            with self.table[rng.randrange(1000)] as record:
+                record.code = 'c%d' % rng.randrange(5)
+        for value, bucket in self.index._buckets.items():
+            self.assertEqual(bucket, sorted(bucket))
+            self.assertEqual(bucket, [recno(r) for r in self.table if (r.code, ) == value])
+
+    def test_pack(self):
+        for record in self.table:
+            if record.n % 3 == 0:
+                delete(record)
+        self.table.pack()
+        self.assertEqual(len(self.index), 666)
+        kept = [r for r in range(1000) if r % 3]
+        expected = [kept.index(r) for r in range(7, 1000, 50) if r % 3]
+        self.assertEqual(self.rec_nums('c7'), expected)
+        self.assertEqual([self.table[r].n for r in expected], [r for r in range(7, 1000, 50) if r % 3])
+
+    def test_planner(self):
+        plan = dbf.pql_plan(self.table, "code == 'c7    ' and n > 100")
+        self.assertEqual([recno(r) for r in plan], list(range(7, 1000, 50)))
+        records = self.table.query("select * where code == 'c7    ' and n > 100")
+        self.assertEqual([recno(r) for r in records], list(range(107, 1000, 50)))
+
+
+class TestPrefixIndex(DbfTestCase):
+    "PrefixIndex finds the records whose key starts with a prefix"
+
+    names = ['SMITH', 'SMILEY', 'SMIT', 'SMYTHE', 'JONES', 'SMI', 'ADAMS', 'SMJ']
+
+    def setUp(self):
+        DbfTestCase.setUp(self)
+        self.table = self.make_table(
+                'prefix', 'name C(12); n N(6,0)',
+                [(self.names[i % len(self.names)] + str(i % 3), i) for i in range(800)],
+                )
+        self.index = self.table.create_index('name', kind='prefix')
+
+    def tearDown(self):
+        self.table.close()
+        DbfTestCase.tearDown(self)
+
+    def starting(self, prefix):
+        return sorted(recno(r) for r in self.table if r.name.startswith(prefix))
+
+    def test_search(self):
+        for prefix in ('SMI', 'SM', 'JONES1', 'SMITH', 'Z', ''):
+            found = self.index.search(prefix, partial=True)
+            self.assertEqual(sorted(recno(r) for r in found), self.starting(prefix))
+            self.assertEqual([r.name for r in found], sorted(r.name for r in found))
+        self.assertEqual(len(self.index.search('JONES1'.ljust(12))), len([r for r in self.table if r.name == 'JONES1'.ljust(12)]))
+        self.assertEqual(len(self.index.search('JONES1')), 0)
+        self.assertTrue(self.index.index_search('SMY', partial=True))
+        self.assertFalse(self.index.index_search('SMZ', nearest=True))
+
+    def test_changes_and_queries(self):
+        self.table.append(('SMIXX', 5))
+        self.assertEqual(len(self.index.search('SMI', partial=True)), 401)
+        self.assertEqual(
+                sorted(recno(r) for r in self.table.query("select * where name.startswith('SMI')")),
+                self.starting('SMI'),
+                )
+        self.assertEqual(
+                len(self.table.query("select * where name == 'SMJ2        '")),
+                len([r for r in self.table if r.name == 'SMJ2'.ljust(12)]),
+                )
+
+    def test_saved(self):
+        self.table.create_index('name', filename=self.path('name.idx'), kind='prefix')
+        self.table.close()
+        self.table.open(READ_WRITE)
+        index = self.table.create_index('name', filename=self.path('name.idx'), kind='prefix')
+        self.assertTrue('_values' not in index.__dict__)
+        self.assertEqual(sorted(recno(r) for r in index.search('SMY', partial=True)), self.starting('SMY'))
+
+
+class TestThreads(DbfTestCase):
+    "threads share a table, reading and writing records by position"
+
+    def setUp(self):
+        DbfTestCase.setUp(self)
+        table = self.make_table('threads', 'name C(10); n N(8,0); m M', [('t%d' % i, i, 'memo %d' % i) for i in range(2000)])
+        table.close()
+        self.filename = table.filename
+        self.errors = []
+
+    def run_threads(self, target, args):
+        threads = [threading.Thread(target=target, args=(a, )) for a in args]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.errors, [])
+
+    def test_readers(self):
+        for mmap in (False, True):
+            table = Table(self.filename, mmap=mmap)
+            table.open(READ_ONLY)
+            def read(seed):
+                try:
+                    rng = random.Random(seed)
+                    for _ in range(1000):
+                        i = rng.randrange(2000)
+                        record = table[i]
+                        self.assertEqual((record.n, record.name, record.m), (i, ('t%d' % i).ljust(10), 'memo %d' % i))
+                except Exception:
+                    self.errors.append(sys.exc_info()[1])
+            self.run_threads(read, range(8))
+            stats = table.stats()
+            self.assertEqual(stats['bytes_read'], stats['record_reads'] * table.record_length)
+            table.close()
+
+    def test_writers(self):
+        table = Table(self.filename)
+        table.open(READ_WRITE)
+        def write(base):
+            try:
+                for i in range(base, 2000, 4):
+                    with table[i] as record:
+                        record.n = -i
+            except Exception:
+                self.errors.append(sys.exc_info()[1])
+        self.run_threads(write, range(4))
+        table = self.reopen(table, READ_ONLY)
+        self.assertEqual([r.n for r in table], [-i for i in range(2000)])
+        table.close()
+
+    @unittest.skipIf(dbf._pwrite is None, 'writes are buffered without os.pwrite')
+    def test_writes_reach_the_file(self):
+        # nothing waits in a buffer, so another reader sees the writes at once
+        for dbf_type in ('db3', 'vfp'):
+            table = self.make_table('direct_' + dbf_type, 'name C(10); n N(8,0)', [('a', 1)], dbf_type=dbf_type)
+            with table[0] as record:
+                record.n = 7
+            table.append(('b', 2))
+            header = table._meta.header
+            with open(table.filename, 'rb') as fh:
+                data = fh.read()
+            self.assertEqual(struct.unpack('<L', data[4:8])[0], 2)
+            first = data[header.start:header.start + header.record_length]
+            self.assertEqual(bytearray(first), bytearray(table[0]._data))
+            table.close()
+
+
+def _append_rows(filename, base, count):
+    dbf.lock_files = True
+    table = Table(filename)
+    table.open(READ_WRITE)
+    try:
+        for start in range(base, base + count, 10):
+            table.extend([('w%d' % n, n, 'memo %d' % n) for n in range(start, start + 5)], batch_size=2)
+            for n in range(start + 5, start + 10):
+                table.append(('w%d' % n, n, 'memo %d' % n))
+    finally:
+        table.close()
+
+
+class TestLocking(DbfTestCase):
+    "with lock_files set, writers in several processes share a table"
+
+    def setUp(self):
+        DbfTestCase.setUp(self)
+        self.lock_files = dbf.lock_files
+
+    def tearDown(self):
+        dbf.lock_files = self.lock_files
+        DbfTestCase.tearDown(self)
+
+    def test_refresh(self):
+        table = self.make_table('tail', 'name C(10); n N(8,0); m M', [('r%d' % i, i, 'm%d' % i) for i in range(10)])
+        table.close()
+        reader = Table(table.filename)
+        reader.open(READ_ONLY)
+        self.assertEqual(reader.refresh(), 0)
+        dbf.lock_files = True
+        writer = Table(table.filename)
+        writer.open(READ_WRITE)
+        writer.extend([('x%d' % i, 100 + i, 'xm%d' % i) for i in range(5)])
+        writer.append(('single', 200, 'sm'))
+        self.assertEqual(reader.refresh(), 6)
+        self.assertEqual(len(reader), 16)
+        self.assertEqual(reader[14].m, 'xm4')
+        self.assertEqual(reader[15].name, 'single    ')
+        with writer.lock():
+            with writer.lock(shared=True):
+                pass
+        self.assertEqual(writer._meta.file_locks, [0, 0])
+        writer.close()
+        reader.close()
+
+    @unittest.skipIf(dbf.fcntl is None, 'fcntl not available')
+    def test_waiting_for_the_lock_keeps_io_free(self):
+        table = self.make_table('waiting', 'name C(10)', [('a', )])
+        other = open(table.filename, 'rb')
+        dbf.fcntl.flock(other.fileno(), dbf.fcntl.LOCK_EX)
+        locked = threading.Event()
+        def lock():
+            with table.lock():
+                locked.set()
+        thread = threading.Thread(target=lock)
+        thread.start()
+        try:
+            self.assertFalse(locked.wait(0.2))
+            # the thread waits in flock without holding io_lock
+            io_lock = table._meta.io_lock
+            self.assertTrue(io_lock.acquire(False))
+            io_lock.release()
+        finally:
+            dbf.fcntl.flock(other.fileno(), dbf.fcntl.LOCK_UN)
+            other.close()
+            thread.join()
+        self.assertTrue(locked.is_set())
+        self.assertEqual(table._meta.file_locks, [0, 0])
+        table.close()
+
+    @unittest.skipIf(dbf.fcntl is None, 'fcntl not available')
+    def test_appenders_in_several_processes(self):
+        table = self.make_table('shared', 'name C(10); n N(8,0); m M', [('r0', -1, 'first')])
+        table.close()
+        workers = [
+                multiprocessing.Process(target=_append_rows, args=(table.filename, base, 200))
+                for base in (0, 200, 400)
+                ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+        table.open(READ_ONLY)
+        self.assertEqual(len(table), 601)
+        self.assertEqual(sorted(r.n for r in table), list(range(-1, 600)))
+        for record in table:
+            if record.n >= 0:
+                self.assertEqual((record.name, record.m), (('w%d' % record.n).ljust(10), 'memo %d' % record.n))
+        self.assertEqual(table[0].m, 'first')
+        table.close()
+
+
+class TestPack(DbfTestCase):
+    "pack() moves the live records up in one pass and returns where they went"
+
+    def test_mapping(self):
+        for kind in ('db3', 'vfp'):
+            table = self.make_table('pack_' + kind, 'name C(10); n N(8,0); m M', [('r%d' % i, i, 'm%d' % i) for i in range(3000)], dbf_type=kind)
+            by_n = table.create_index('n')
+            by_name = table.create_index('name', kind='hash')
+            kept, gone = table[5], table[7]
+            records = dbf.List(table[i] for i in range(0, 30, 3))
+            for i in list(range(0, 3000, 7)) + [2999]:
+                delete(table[i])
+            mapping = table.pack()
+            survivors = [i for i in range(3000) if i % 7 and i != 2999]
+            self.assertEqual(len(mapping), 3000)
+            self.assertEqual([mapping[i] for i in (0, 5, 7, 8)], [-1, 4, -1, 6])
+            self.assertEqual([r.n for r in table], survivors)
+            self.assertEqual([r.m for r in table], ['m%d' % i for i in survivors])
+            self.assertEqual((recno(kept), recno(gone)), (4, -1))
+            self.assertTrue(table[4] is kept)
+            self.assertEqual([recno(r) for r in by_n.search((15, ))], [mapping[15]])
+            self.assertEqual(list(by_name._rec_nums(('r16'.ljust(10), ))), [mapping[16]])
+            self.assertEqual((len(by_n), len(by_name)), (len(survivors), len(survivors)))
+            records.remap(table, mapping)
+            self.assertEqual([r.n for r in records], [3, 6, 9, 12, 15, 18, 24, 27])
+            dbf.write(kept, n=1005)
+            table = self.reopen(table)
+            header = table._meta.header
+            self.assertEqual(
+                    os.path.getsize(table.filename),
+                    header.start + len(table) * header.record_length + (kind == 'db3'),
+                    )
+            self.assertEqual([r.n for r in table][3:7], [4, 1005, 6, 8])
+            self.assertEqual(list(table.pack()), list(range(len(table))))
+            table.close()
+
+    def test_in_memory(self):
+        table = Table(':memory:', 'n N(4,0)', on_disk=False)
+        table.open(READ_WRITE)
+        table.extend([(i, ) for i in range(10)])
+        delete(table[0])
+        delete(table[5])
+        self.assertEqual(list(table.pack()), [-1, 0, 1, 2, 3, -1, 4, 5, 6, 7])
+        self.assertEqual([r.n for r in table], [1, 2, 3, 4, 6, 7, 8, 9])
+        table.close()
+
+
+class TestRestructure(DbfTestCase):
+    "add_fields, delete_fields, and resize_field copy the records in one pass"
+
+    def rows(self, count=300):
+        return [('r%d' % i, i, 'memo %d' % i, Date(2020, 1, 1 + i % 28)) for i in range(count)]
+
+    def check_memos(self, table, count=300):
+        for i in (0, 1, count // 2, count - 1):
+            self.assertEqual(table[i].m, 'memo %d' % i)
+
+    def test_add_fields_keeps_memos(self):
+        for kind in ('db3', 'fp', 'vfp'):
+            table = self.make_table('add_' + kind, 'name C(10); n N(8,0); m M; d D', self.rows(), dbf_type=kind)
+            table.add_fields('extra C(5); amt N(6,2)')
+            self.check_memos(table)
+            table = self.reopen(table)
+            self.assertEqual(len(table), 300)
+            self.assertEqual(table[9].extra, '     ')
+            self.assertEqual(table[9].n, 9)
+            self.check_memos(table)
+            table.close()
+
+    def test_delete_fields_keeps_memos(self):
+        for kind in ('db3', 'fp', 'vfp'):
+            table = self.make_table('del_' + kind, 'name C(10); n N(8,0); m M; d D', self.rows(), dbf_type=kind)
+            delete(table[3])
+            table.delete_fields('n')
+            self.check_memos(table)
+            table = self.reopen(table)
+            self.assertEqual(table.field_names, ['name', 'm', 'd'])
+            self.assertTrue(is_deleted(table[3]))
+            self.assertEqual(table[12].d, Date(2020, 1, 13))
+            self.check_memos(table)
+            table.close()
+
+    def test_resize_field_keeps_memos(self):
+        for kind in ('db3', 'fp', 'vfp'):
+            table = self.make_table('resize_' + kind, 'name C(10); n N(8,0); m M; d D', self.rows(), dbf_type=kind)
+            table.resize_field('name', 20)
+            self.check_memos(table)
+            table = self.reopen(table)
+            self.assertEqual(table.field_info('name').length, 20)
+            self.assertEqual(table[299].name, 'r299'.ljust(20))
+            self.check_memos(table)
+            table.resize_field('name', 4)
+            table = self.reopen(table)
+            self.assertEqual(table[299].name, 'r299')
+            self.check_memos(table)
+            table.close()
+
+    def test_memo_fields_come_and_go(self):
+        table = self.make_table('memos', 'name C(10); n N(8,0); m M; d D', self.rows())
+        table.delete_fields('m')
+        self.assertFalse(os.path.exists(table._meta.memoname))
+        table.add_fields('note M')
+        with table[12] as record:
+            record.note = 'fresh'
+        table = self.reopen(table)
+        self.assertEqual(table[12].note, 'fresh')
+        self.assertEqual(table[13].note, '')
+        table.close()
+
+    def test_failure_restores_layout(self):
+        table = self.make_table('fail', 'name C(10); n N(8,0); m M; d D', self.rows())
+        structure = table.structure()
+        read_at = dbf._read_at
+        def broken(*args):
+            raise IOError('disk went away')
+        dbf._read_at = broken
+        try:
+            self.assertRaises(IOError, table.add_fields, 'extra C(5)')
+            self.assertRaises(IOError, table.delete_fields, 'm')
+            self.assertRaises(IOError, table.resize_field, 'name', 20)
+        finally:
+            dbf._read_at = read_at
+        self.assertEqual(table.structure(), structure)
+        self.assertEqual(table[7].name, 'r7'.ljust(10))
+        self.check_memos(table)
+        self.assertFalse(os.path.exists(table.filename + '.tmp'))
+        table = self.reopen(table)
+        self.assertEqual(table.structure(), structure)
+        self.check_memos(table)
+        table.add_fields('extra C(5)')
+        self.check_memos(table)
+        table.close()
+
+    def test_shrink_that_does_not_fit(self):
+        table = self.make_table('shrink', 'name C(10); n N(8,0); m M; d D', self.rows())
+        self.assertRaises(dbf.DataOverflowError, table.resize_field, 'name', 2)
+        self.assertEqual(table.field_info('name').length, 10)
+        self.assertEqual(table[11].name, 'r11'.ljust(10))
+        table.close()
+
+
+class TestRecordCache(DbfTestCase):
+    "with record_cache_size set, the most recently used records stay alive"
+
+    def setUp(self):
+        DbfTestCase.setUp(self)
+        self.record_cache_size = dbf.record_cache_size
+
+    def tearDown(self):
+        dbf.record_cache_size = self.record_cache_size
+        DbfTestCase.tearDown(self)
+
+    def make_cached(self, size):
+        table = self.make_table('rc', 'name C(10); n N(8,0)', [('r%d' % i, i) for i in range(500)])
+        table.close()
+        dbf.record_cache_size = size
+        table.open(READ_WRITE)
+        return table
+
+    def test_bounded(self):
+        table = self.make_cached(50)
+        cache = table._table
+        for record in table:
+            pass
+        self.assertEqual(len(cache._recent), 50)
+        self.assertEqual(list(cache._recent)[-1], 499)
+        table.close()
+
+    def test_kept_after_last_reference(self):
+        table = self.make_cached(50)
+        cache = table._table
+        record = table[7]
+        del record
+        self.assertTrue(7 in cache._recent)
+        again = table[7]
+        self.assertTrue(again is cache._recent[7])
+        self.assertEqual(list(cache._recent)[-1], 7)
+        for i in range(100):
+            table[i + 100]
+        # pushed out of the recent list, but still alive through `again`
+        self.assertFalse(7 in cache._recent)
+        self.assertTrue(table[7] is again)
+        table.close()
+
+    def test_pack_renumbers(self):
+        table = self.make_cached(50)
+        cache = table._table
+        # held so it stays in the cache across the pack
+        kept = table[7]
+        for i in range(400, 450):
+            table[i]
+        delete(table[1])
+        delete(table[498])
+        table.pack()
+        self.assertEqual(kept._recnum, 6)
+        self.assertTrue(table[6] is kept)
+        self.assertEqual(kept.n, 7)
+        for rec_num, record in cache._recent.items():
+            self.assertEqual(rec_num, recno(record))
+        self.assertEqual((table[447].n, len(table)), (448, 498))
+        table.close()
+
+    def test_size_zero(self):
+        table = self.make_cached(0)
+        for record in table:
+            pass
+        self.assertEqual(len(table._table._recent), 0)
+        self.assertTrue(len(table._table._weakref_list) <= 1)
+        table.close()
+
+    def test_per_table(self):
+        table = self.make_cached(50)
+        table.close()
+        dbf.record_cache_size = 20
+        small = Table(table.filename, record_cache_size=5)
+        small.open(READ_ONLY)
+        default = Table(table.filename)
+        default.open(READ_ONLY)
+        for records in zip(small, default):
+            pass
+        self.assertEqual((len(small._table._recent), len(default._table._recent)), (5, 20))
+        small.close()
+        default.close()
+
+
+class TestStats(DbfTestCase):
+    "Table.stats() counts the work done, and stats_hook sees it on close"
+
+    def setUp(self):
+        DbfTestCase.setUp(self)
+        self.stats_hook = dbf.stats_hook
+        self.record_cache_size = dbf.record_cache_size
+        dbf.record_cache_size = 0
+
+    def tearDown(self):
+        dbf.stats_hook = self.stats_hook
+        dbf.record_cache_size = self.record_cache_size
+        DbfTestCase.tearDown(self)
+
+    def test_counters(self):
+        table = self.make_table('st', 'name C(10); n N(8,0); m M')
+        table.extend([('r%d' % i, i, 'memo%d' % i) for i in range(100)])
+        # held so the index is updated by the write below
+        index = table.create_index('n')
+        stats = table.stats(reset=True)
+        self.assertEqual((stats['record_writes'], stats['memo_writes'], stats['index_updates']), (100, 100, 0))
+        self.assertTrue(stats['bytes_written'] >= 100 * table._meta.header.record_length)
+        self.assertEqual(table.stats()['record_writes'], 0)
+        record, same = table[5], table[5]
+        self.assertEqual(table[5].m, 'memo5')
+        stats = table.stats()
+        self.assertEqual((stats['cache_misses'], stats['record_reads'], stats['memo_reads']), (1, 1, 0))
+        self.assertTrue(stats['cache_hits'] >= 2)
+        dbf.write(record, n=500)
+        stats = table.stats(reset=True)
+        self.assertEqual(stats['record_writes'], 1)
+        self.assertTrue(stats['index_updates'] >= 1)
+        self.assertEqual(index.search(500)[0], record)
+        query = "select where n > 50 and n < %d" % id(self)
+        table.query(query)
+        compiles = table.stats()['pql_compiles']
+        self.assertTrue(compiles >= 1)
+        table.query(query)
+        self.assertEqual(table.stats()['pql_compiles'], compiles)
+        table.close()
+
+    def test_update_compiles_are_counted(self):
+        table = self.make_table('st_update', 'name C(10); n N(8,0)', [('r%d' % i, i) for i in range(10)])
+        table.stats(reset=True)
+        table.query("update name = 'changed' where n < %d" % id(self))
+        # the criteria and the command
+        self.assertEqual(table.stats()['pql_compiles'], 2)
+        table.close()
+
+    def test_threads_lose_no_counts(self):
+        table = self.make_table('st_threads', 'name C(10)', [('r%d' % i, ) for i in range(10)])
+        # held so every lookup below is a cache hit
+        records = list(table)
+        table.stats(reset=True)
+        def read():
+            for _ in range(20000):
+                table[3]
+        threads = [threading.Thread(target=read) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(table.stats()['cache_hits'], 8 * 20000)
+        table.close()
+
+    def test_hook_called_once_on_close(self):
+        seen = []
+        dbf.stats_hook = lambda name, stats: seen.append((name, stats))
+        table = self.make_table('hook', 'name C(10)', [('r%d' % i, ) for i in range(20)])
+        table = self.reopen(table, READ_ONLY)
+        del seen[:]
+        [r.name for r in table]
+        table.close()
+        table.close()
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(seen[0][0], table.filename)
+        self.assertEqual(seen[0][1]['record_reads'], 20)
+
+
+class TestBench(DbfTestCase):
+    "dbf.bench times each operation on a generated table"
+
+    def test_bench_table(self):
+        from dbf import bench
+        for kind in ('db3', 'vfp'):
+            result = bench.bench_table(self.path('bench_' + kind), kind, bench.field_mixes[kind], 200, 3)
+            self.assertEqual(
+                    sorted(result['seconds']),
+                    sorted([
+                        'append', 'export', 'extend', 'index', 'open', 'pack', 'pql_count',
+                        'pql_index', 'pql_scan', 'process_update', 'random_access', 'scan',
+                        ]),
+                    )
+            self.assertTrue(all(t >= 0 for t in result['seconds'].values()))
+            self.assertTrue(result['stats']['record_writes'] > 0)
+
+    def test_queries_are_timed_cold(self):
+        from dbf import bench
+        table = self.make_table('cold', 'name C(10)', [('word%d' % i, ) for i in range(100)])
+        # held here, as a table only keeps weak references to its indexes
+        index = table.create_index('name', kind='prefix')
+        for _ in range(2):
+            bench._time_query(table, "select where name.startswith('word1')")
+            # the plan and the criteria were both compiled while timed
+            self.assertEqual(dbf.pql_cache_info()[:2], (0, 2))
+        dbf.pql_cache_clear()
+        table.close()
+
+    def test_index_outlives_creation(self):
+        table = self.make_table('prefix', 'name C(10)', [('word%d' % i, ) for i in range(100)])
+        index = table.create_index('name', kind='prefix')
+        self.assertTrue(dbf.pql_plan(table, "name.startswith('word1')") is not None)
+        self.assertEqual(len(table.query("select where name.startswith('word1')")), 11)
+        del index
+        self.assertTrue(dbf.pql_plan(table, "name.startswith('word1')") is None)
+        table.close()
+
+
+if __name__ == '__main__':
+    main()